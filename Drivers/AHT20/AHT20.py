@@ -1,5 +1,7 @@
 from smbus2 import SMBus
-import time
+
+from Modules.Clock import clock
+from Modules.Histogram import Histogram
 from Drivers.AHT20.crc8_helper import AHT20_crc8_check
 
 
@@ -14,47 +16,94 @@ AHT20_CMD_INITIALIZE = [0xBE, 0x08, 0x00]
 AHT20_CMD_MEASURE = [0xAC, 0x33, 0x00]
 AHT20_STATUSBIT_BUSY = 7  # The 7th bit is the Busy indication bit. 1 = Busy, 0 = not.
 AHT20_STATUSBIT_CALIBRATED = 3  # The 3rd bit is the CAL (calibration) Enable bit. 1 = Calibrated, 0 = not
+AHT20_CRC_RETRIES = 3  # Extra measures to try when the CRC fails before giving up
+
+TRANSACTION_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100]
+MEASURE_BUCKETS_MS = [80, 100, 120, 160, 200, 250, 320, 500, 1000]
+
+
+class AHT20ZeroFrame(RuntimeError):
+    # The sensor answered with an all-zero frame, usually after a brown out, rather than a corrupted measure
+    pass
+
+
+class AHT20Stats:
+    # Performance counters for one sensor, updated by the driver on every bus transaction
+
+    def __init__(self):
+        self.transaction_latency = Histogram(TRANSACTION_BUCKETS_MS)  # Single I2C read/write, ms
+        self.measure_latency = Histogram(MEASURE_BUCKETS_MS)  # Measure command to data read, ms
+        self.transactions = 0
+        self.transaction_errors = 0
+        self.measures = 0
+        self.busy_waits = 0  # Extra 80 ms waits because the busy bit was still set
+        self.crc_failures = 0
+        self.crc_retries = 0
+        self.zero_frames = 0
+
+    def snapshot(self):
+        return {
+            "transactions": self.transactions,
+            "transaction_errors": self.transaction_errors,
+            "measures": self.measures,
+            "busy_waits": self.busy_waits,
+            "crc_failures": self.crc_failures,
+            "crc_retries": self.crc_retries,
+            "zero_frames": self.zero_frames,
+            "transaction_latency_ms": self.transaction_latency.snapshot(),
+            "measure_latency_ms": self.measure_latency.snapshot(),
+        }
 
 
 class AHT20:
     # I2C communication driver for AHT20, using only smbus2
 
-    def __init__(self, BusNum=1):
+    def __init__(self, BusNum=1, address=AHT20_I2CADDR):
         # Initialize AHT20
         self.BusNum = BusNum
+        self.address = address
+        self.stats = AHT20Stats()
         self.cmd_soft_reset()
 
         # Check for calibration, if not done then do and wait 10 ms
         if not self.get_status_calibrated == 1:
             self.cmd_initialize()
             while not self.get_status_calibrated() == 1:
-                time.sleep(0.01)
+                clock.sleep(0.01)
+
+    def _transaction(self, operation, *args):
+        # Run one bus transaction and record its latency
+        start = clock.monotonic()
+        self.stats.transactions += 1
+        try:
+            with SMBus(self.BusNum) as i2c_bus:
+                return getattr(i2c_bus, operation)(self.address, *args)
+        except OSError:
+            self.stats.transaction_errors += 1
+            raise
+        finally:
+            self.stats.transaction_latency.observe((clock.monotonic() - start) * 1000)
 
     def cmd_soft_reset(self):
         # Send the command to soft reset
-        with SMBus(self.BusNum) as i2c_bus:
-            i2c_bus.write_i2c_block_data(AHT20_I2CADDR, 0x0, AHT20_CMD_SOFTRESET)
-        time.sleep(0.04)  # Wait 40 ms after poweron
+        self._transaction("write_i2c_block_data", 0x0, AHT20_CMD_SOFTRESET)
+        clock.sleep(0.04)  # Wait 40 ms after poweron
         return True
 
     def cmd_initialize(self):
         # Send the command to initialize (calibrate)
-        with SMBus(self.BusNum) as i2c_bus:
-            i2c_bus.write_i2c_block_data(AHT20_I2CADDR, 0x0, AHT20_CMD_INITIALIZE)
+        self._transaction("write_i2c_block_data", 0x0, AHT20_CMD_INITIALIZE)
         return True
 
     def cmd_measure(self):
         # Send the command to measure
-        with SMBus(self.BusNum) as i2c_bus:
-            i2c_bus.write_i2c_block_data(AHT20_I2CADDR, 0, AHT20_CMD_MEASURE)
-        time.sleep(0.08)  # Wait 80 ms after measure
+        self._transaction("write_i2c_block_data", 0, AHT20_CMD_MEASURE)
+        clock.sleep(0.08)  # Wait 80 ms after measure
         return True
 
     def get_status(self):
         # Get the full status byte
-        with SMBus(self.BusNum) as i2c_bus:
-            return i2c_bus.read_i2c_block_data(AHT20_I2CADDR, 0x0, 1)[0]
-        return True
+        return self._transaction("read_i2c_block_data", 0x0, 1)[0]
 
     def get_status_calibrated(self):
         # Get the calibrated bit
@@ -67,29 +116,54 @@ class AHT20:
     def get_measure(self):
         # Get the full measure
 
+        start = clock.monotonic()
+        self.stats.measures += 1
+
         # Command a measure
         self.cmd_measure()
 
         # Check if busy bit = 0, otherwise wait 80 ms and retry
         while self.get_status_busy() == 1:
-            time.sleep(0.08)  # Wait 80 ns
-
-        # TODO: do CRC check
+            self.stats.busy_waits += 1
+            clock.sleep(0.08)  # Wait 80 ms
 
         # Read data and return it
-        with SMBus(self.BusNum) as i2c_bus:
-            return i2c_bus.read_i2c_block_data(AHT20_I2CADDR, 0x0, 7)
+        data = self._transaction("read_i2c_block_data", 0x0, 7)
+        self.stats.measure_latency.observe((clock.monotonic() - start) * 1000)
+        return data
 
     def get_measure_CRC8(self):
         """
         This function will calculate crc8 code with G(x) = x8 + x5 + x4 + 1 -> 0x131(0x31), Initial value = 0xFF. No XOROUT.
         return: all_data (1 bytes status + 2.5 byes humidity + 2.5 bytes temperature + 1 bytes crc8 code), isCRC8_pass
+        raise: AHT20ZeroFrame if every byte of the frame is zero
         """
         all_data = self.get_measure()
+        if not any(all_data):
+            # Would fail the CRC too, but retrying won't help and the caller counts it separately
+            self.stats.zero_frames += 1
+            raise AHT20ZeroFrame("Sensor returned an all-zero frame")
         isCRC8_pass = AHT20_crc8_check(all_data)
+        if not isCRC8_pass:
+            self.stats.crc_failures += 1
 
         return all_data, isCRC8_pass
 
+    def get_humidity_temperature(self, retries=AHT20_CRC_RETRIES):
+        # Get humidity (%) and temperature (°C) from a single CRC checked measure
+        measure, isCRC8Pass = self.get_measure_CRC8()
+        for _ in range(retries):
+            if isCRC8Pass:
+                break
+            self.stats.crc_retries += 1
+            clock.sleep(80 * 10 ** -3)
+            measure, isCRC8Pass = self.get_measure_CRC8()
+        if not isCRC8Pass:
+            raise RuntimeError(f"CRC check failed after {retries} retries")
+        humidity = (measure[1] << 12) | (measure[2] << 4) | (measure[3] >> 4)
+        temperature = ((measure[3] & 0xF) << 16) | (measure[4] << 8) | measure[5]
+        return humidity * 100 / pow(2, 20), temperature / (pow(2, 20)) * 200 - 50
+
     def get_temperature(self):
         # Get a measure, select proper bytes, return converted data
         measure = self.get_measure()
@@ -101,7 +175,7 @@ class AHT20:
         isCRC8Pass = False
         while (not isCRC8Pass):
             measure, isCRC8Pass = self.get_measure_CRC8()
-            time.sleep(80 * 10 ** -3)
+            clock.sleep(80 * 10 ** -3)
         measure = ((measure[3] & 0xF) << 16) | (measure[4] << 8) | measure[5]
         measure = measure / (pow(2, 20)) * 200 - 50
         return measure
@@ -117,7 +191,7 @@ class AHT20:
         isCRC8Pass = False
         while (not isCRC8Pass):
             measure, isCRC8Pass = self.get_measure_CRC8()
-            time.sleep(80 * 10 ** -3)
+            clock.sleep(80 * 10 ** -3)
         measure = (measure[1] << 12) | (measure[2] << 4) | (measure[3] >> 4)
         measure = measure * 100 / pow(2, 20)
         return measure
\ No newline at end of file
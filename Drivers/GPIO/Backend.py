@@ -0,0 +1,351 @@
+import asyncio
+import json
+import os
+import select
+import threading
+
+from loguru import logger as logging
+
+from Modules.Clock import clock
+from Modules.Decorators import background
+
+# Physical (BOARD) header pin -> BCM line offset on the 40 pin header
+BOARD_TO_BCM = {
+    3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23, 18: 24, 19: 10, 21: 9, 22: 25,
+    23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26, 38: 20, 40: 21,
+}
+
+LOW = 0
+HIGH = 1
+
+PULL_NONE = "none"
+PULL_UP = "up"
+PULL_DOWN = "down"
+
+EDGE_RISING = "rising"
+EDGE_FALLING = "falling"
+EDGE_BOTH = "both"
+
+
+class GPIOBackend:
+    """
+    Interface the hardware modules use to drive pins, pins are always physical (BOARD) header numbers.
+    Edge callbacks are called as callback(pin, timestamp_ns, rising) where timestamp_ns is on the monotonic clock
+    """
+
+    name = "none"
+
+    def setup_output(self, pin, initial=LOW):
+        raise NotImplementedError
+
+    def setup_outputs(self, levels):
+        """Set up several outputs at once, {pin: initial level}"""
+        for pin, level in levels.items():
+            self.setup_output(pin, level)
+
+    def setup_input(self, pin, pull=PULL_DOWN, edge=None, callback=None):
+        raise NotImplementedError
+
+    def setup_inputs(self, inputs):
+        """Set up several inputs at once, {pin: (pull, edge, callback)}"""
+        for pin, (pull, edge, callback) in inputs.items():
+            self.setup_input(pin, pull, edge, callback)
+
+    def read(self, pin):
+        raise NotImplementedError
+
+    def write(self, pin, level):
+        self.write_many({pin: level})
+
+    def write_many(self, levels):
+        """Set several outputs at once, {pin: level}"""
+        raise NotImplementedError
+
+
+class RPiGPIOBackend(GPIOBackend):
+    """RPi.GPIO, one call per pin and edges timestamped when its callback thread gets to them"""
+
+    name = "rpigpio"
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.GPIO.setmode(GPIO.BOARD)
+
+    def setup_output(self, pin, initial=LOW):
+        self.GPIO.setup(pin, self.GPIO.OUT, initial=self.GPIO.HIGH if initial else self.GPIO.LOW)
+
+    def setup_input(self, pin, pull=PULL_DOWN, edge=None, callback=None):
+        pulls = {PULL_NONE: self.GPIO.PUD_OFF, PULL_UP: self.GPIO.PUD_UP, PULL_DOWN: self.GPIO.PUD_DOWN}
+        self.GPIO.setup(pin, self.GPIO.IN, pull_up_down=pulls[pull])
+        if edge is None or callback is None:
+            return
+        edges = {EDGE_RISING: self.GPIO.RISING, EDGE_FALLING: self.GPIO.FALLING, EDGE_BOTH: self.GPIO.BOTH}
+
+        def on_edge(channel):
+            timestamp = clock.monotonic_ns()
+            rising = edge == EDGE_RISING or (edge == EDGE_BOTH and self.GPIO.input(channel) == self.GPIO.HIGH)
+            callback(channel, timestamp, rising)
+
+        self.GPIO.add_event_detect(pin, edges[edge], callback=on_edge)
+
+    def read(self, pin):
+        return self.GPIO.input(pin)
+
+    def write_many(self, levels):
+        for pin, level in levels.items():
+            self.GPIO.output(pin, self.GPIO.HIGH if level else self.GPIO.LOW)
+
+
+class GpiodBackend(GPIOBackend):
+    """
+    Linux GPIO character device through the libgpiod v2 bindings. Outputs set up together with setup_outputs()
+    share one line request so write_many() sets them with a single ioctl; requests are never released and made
+    again, that would let the lines of relays already running float for a moment. Inputs work the same way with
+    setup_inputs(), each input request's fd delivers kernel timestamped edge events to the asyncio loop (or to a
+    poll thread when there was no loop running), and an input set up again is reconfigured in place.
+    """
+
+    name = "gpiod"
+
+    def __init__(self, chip="/dev/gpiochip0", consumer="RoomControlSatellite"):
+        import gpiod
+        from gpiod.line import Bias, Direction, Edge, Value
+        if not hasattr(gpiod, "request_lines"):
+            raise ImportError("libgpiod v2 python bindings required")
+        self.gpiod = gpiod
+        self.Bias, self.Direction, self.Edge, self.Value = Bias, Direction, Edge, Value
+        self.chip = chip
+        self.consumer = consumer
+        self.lock = threading.RLock()
+        self.outputs = {}  # offset -> level
+        self.inputs = {}  # offset -> (pull, edge, callback, pin)
+        self.output_requests = {}  # offset -> the line request holding it, shared by outputs set up together
+        self.input_requests = {}  # offset -> the line request holding it, shared by inputs set up together
+        self.polled = []  # Input requests read by the poll thread instead of the asyncio loop
+        self.poll_thread = None
+
+    @staticmethod
+    def offset(pin):
+        if pin not in BOARD_TO_BCM:
+            raise ValueError(f"Pin {pin} is not a GPIO pin on the header")
+        return BOARD_TO_BCM[pin]
+
+    def request_outputs(self, levels):
+        # Lines can't be added to an existing request, new outputs get a request of their own
+        settings = self.gpiod.LineSettings(direction=self.Direction.OUTPUT)
+        request = self.gpiod.request_lines(
+            self.chip, consumer=self.consumer, config={tuple(levels): settings},
+            output_values={offset: self.Value.ACTIVE if level else self.Value.INACTIVE
+                           for offset, level in levels.items()})
+        for offset, level in levels.items():
+            self.outputs[offset] = level
+            self.output_requests[offset] = request
+
+    def input_settings(self, pull, edge):
+        edges = {None: self.Edge.NONE, EDGE_RISING: self.Edge.RISING, EDGE_FALLING: self.Edge.FALLING,
+                 EDGE_BOTH: self.Edge.BOTH}
+        biases = {PULL_NONE: self.Bias.DISABLED, PULL_UP: self.Bias.PULL_UP, PULL_DOWN: self.Bias.PULL_DOWN}
+        return self.gpiod.LineSettings(direction=self.Direction.INPUT, bias=biases[pull], edge_detection=edges[edge])
+
+    def request_inputs(self, inputs):
+        # Like the outputs, new inputs get a request of their own and the live ones are never released
+        request = self.gpiod.request_lines(self.chip, consumer=self.consumer,
+                                           config={offset: self.input_settings(pull, edge)
+                                                   for offset, (pull, edge, _, _) in inputs.items()})
+        for offset, config in inputs.items():
+            self.inputs[offset] = config
+            self.input_requests[offset] = request
+        self.attach_fd(request)
+
+    def reconfigure_inputs(self, request):
+        # Every line of the request is passed, lines left out would fall back to the request's defaults
+        request.reconfigure_lines({offset: self.input_settings(pull, edge)
+                                   for offset, (pull, edge, _, _) in self.inputs.items()
+                                   if self.input_requests[offset] is request})
+
+    def setup_output(self, pin, initial=LOW):
+        self.setup_outputs({pin: initial})
+
+    def setup_outputs(self, levels):
+        with self.lock:
+            new = {}
+            for pin, level in levels.items():
+                if self.offset(pin) in self.output_requests:
+                    self.write(pin, level)  # Already requested, e.g. by a host that set up all its pins at once
+                else:
+                    new[self.offset(pin)] = level
+            if new:
+                self.request_outputs(new)
+
+    def setup_input(self, pin, pull=PULL_DOWN, edge=None, callback=None):
+        self.setup_inputs({pin: (pull, edge, callback)})
+
+    def setup_inputs(self, inputs):
+        with self.lock:
+            new = {}
+            changed = []  # Requests with lines whose bias or edge detection changed
+            for pin, (pull, edge, callback) in inputs.items():
+                offset = self.offset(pin)
+                config = (pull, edge if callback else None, callback, pin)
+                if offset not in self.input_requests:
+                    new[offset] = config
+                    continue
+                if self.inputs[offset][:2] != config[:2] and self.input_requests[offset] not in changed:
+                    changed.append(self.input_requests[offset])
+                self.inputs[offset] = config  # A new callback alone needs nothing from the kernel
+            for request in changed:
+                self.reconfigure_inputs(request)
+            if new:
+                self.request_inputs(new)
+
+    def read(self, pin):
+        offset = self.offset(pin)
+        with self.lock:
+            if offset in self.outputs:
+                return self.outputs[offset]
+            if offset not in self.input_requests:
+                raise ValueError(f"Pin {pin} is not set up")
+            return HIGH if self.input_requests[offset].get_value(offset) == self.Value.ACTIVE else LOW
+
+    def write_many(self, levels):
+        with self.lock:
+            offsets = {self.offset(pin): level for pin, level in levels.items()}
+            unknown = [pin for pin in levels if self.offset(pin) not in self.output_requests]
+            if unknown:
+                raise ValueError(f"Pins {unknown} are not set up as outputs")
+            requests = {}  # id -> (request, values), one ioctl per request
+            for offset, level in offsets.items():
+                request = self.output_requests[offset]
+                requests.setdefault(id(request), (request, {}))[1][offset] = \
+                    self.Value.ACTIVE if level else self.Value.INACTIVE
+            for request, values in requests.values():
+                request.set_values(values)
+            self.outputs.update(offsets)
+
+    def attach_fd(self, request):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            loop.add_reader(request.fd, self.read_edges, request)
+            return
+        self.polled.append(request)
+        if self.poll_thread is None:
+            self.poll_thread = self.poll_edges()
+
+    def read_edges(self, request):
+        # An input request's fd is readable, hand every queued event to its pin's callback
+        with self.lock:
+            try:
+                events = request.read_edge_events()
+            except OSError as e:
+                logging.error(f"GpiodBackend: Failed to read edge events - {e}")
+                return
+        for event in events:
+            _, _, callback, pin = self.inputs.get(event.line_offset, (None, None, None, None))
+            if callback is not None:
+                rising = event.event_type == self.gpiod.EdgeEvent.Type.RISING_EDGE
+                callback(pin, event.timestamp_ns, rising)
+
+    @background
+    def poll_edges(self):
+        # Used when no asyncio loop was running when the inputs were requested
+        poller = select.poll()
+        requests = {}  # fd -> request
+        while True:
+            with self.lock:
+                added = [request for request in self.polled if request.fd not in requests]
+            for request in added:
+                requests[request.fd] = request
+                poller.register(request.fd, select.POLLIN)
+            for fd, _ in poller.poll(1000):
+                self.read_edges(requests[fd])
+
+
+class FakeBackend(GPIOBackend):
+    """In-memory pins for simulations and machines without GPIO, inputs are driven with inject()"""
+
+    name = "fake"
+
+    def __init__(self):
+        self.levels = {}
+        self.watchers = {}  # pin -> [(edge, callback)], several simulated satellites may share a pin
+        self.lock = threading.Lock()
+        self.stats = {"reads": 0, "writes": 0, "write_calls": 0, "edges": 0}
+
+    def setup_output(self, pin, initial=LOW):
+        self.levels[pin] = initial
+
+    def setup_input(self, pin, pull=PULL_DOWN, edge=None, callback=None):
+        self.levels.setdefault(pin, HIGH if pull == PULL_UP else LOW)
+        if edge is not None and callback is not None:
+            with self.lock:
+                self.watchers.setdefault(pin, []).append((edge, callback))
+
+    def read(self, pin):
+        self.stats["reads"] += 1
+        return self.levels.get(pin, LOW)
+
+    def write_many(self, levels):
+        self.stats["write_calls"] += 1
+        self.stats["writes"] += len(levels)
+        self.levels.update(levels)
+
+    def inject(self, pin, level):
+        """Drive an input and fire the edge callbacks watching it"""
+        level = HIGH if level else LOW
+        if self.levels.get(pin, LOW) == level:
+            return
+        self.levels[pin] = level
+        self.stats["edges"] += 1
+        timestamp = clock.monotonic_ns()
+        rising = level == HIGH
+        with self.lock:
+            watchers = list(self.watchers.get(pin, []))
+        for edge, callback in watchers:
+            if edge == EDGE_BOTH or (edge == EDGE_RISING) == rising:
+                try:
+                    callback(pin, timestamp, rising)
+                except Exception as e:
+                    logging.error(f"FakeBackend: Error in edge callback for pin {pin}: {e}")
+
+
+backend = None
+backend_loaded = False
+
+
+def use_backend(new_backend):
+    """Force a backend, e.g. a FakeBackend for a simulation, must be called before the hardware modules load"""
+    global backend, backend_loaded
+    backend = new_backend
+    backend_loaded = True
+
+
+def get_backend():
+    """
+    The GPIO backend chosen by Configs/GPIO.json ("auto", "gpiod", "rpigpio" or "fake"), "auto" prefers the
+    character device and falls back to RPi.GPIO
+    :return: The shared GPIOBackend or None if no GPIO is available
+    """
+    global backend, backend_loaded
+    if backend_loaded:
+        return backend
+    backend_loaded = True
+    config = json.load(open("Configs/GPIO.json")) if os.path.exists("Configs/GPIO.json") else {}
+    choice = config.get("backend", "auto")
+    candidates = {
+        "gpiod": lambda: GpiodBackend(config.get("chip", "/dev/gpiochip0")),
+        "rpigpio": RPiGPIOBackend,
+        "fake": FakeBackend,
+    }
+    order = ["gpiod", "rpigpio"] if choice == "auto" else [choice]
+    for name in order:
+        try:
+            backend = candidates[name]()
+            logging.info(f"GPIO: Using {name} backend")
+            return backend
+        except (ImportError, OSError, RuntimeError) as e:
+            logging.warning(f"GPIO: {name} backend not available - {e}")
+    return None
@@ -0,0 +1,35 @@
+from smbus2 import SMBus
+
+TCA9548A_I2CADDR = 0x70
+TCA9548A_CHANNELS = 8
+TCA9548A_DISABLED = -1  # Cached channel once every channel has been disconnected
+
+
+class TCA9548A:
+    # I2C communication driver for the TCA9548A 1-to-8 I2C multiplexer, using only smbus2
+
+    def __init__(self, BusNum=1, address=TCA9548A_I2CADDR):
+        self.BusNum = BusNum
+        self.address = address
+        self.channel = None  # Last channel selected, None = unknown, TCA9548A_DISABLED = all disconnected
+
+    def select_channel(self, channel):
+        # Route the downstream bus to a single channel, skip the write if it is already selected
+        if channel == self.channel:
+            return True
+        if not 0 <= channel < TCA9548A_CHANNELS:
+            raise ValueError(f"TCA9548A channel {channel} out of range")
+        with SMBus(self.BusNum) as i2c_bus:
+            i2c_bus.write_byte(self.address, 1 << channel)
+        self.channel = channel
+        return True
+
+    def disable_all(self):
+        # Disconnect all downstream channels, skip the write if they already are
+        if self.channel == TCA9548A_DISABLED:
+            return True
+        self.channel = None  # Unknown until the write succeeds
+        with SMBus(self.BusNum) as i2c_bus:
+            i2c_bus.write_byte(self.address, 0x0)
+        self.channel = TCA9548A_DISABLED
+        return True
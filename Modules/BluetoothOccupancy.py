@@ -1,16 +1,21 @@
-import datetime
 import json
+import multiprocessing
 import os
-import sqlite3
+import select
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import psutil
 from loguru import logger as logging
 
+from Modules.Clock import clock
 from Modules.Decorators import background
+from Modules.Histogram import Histogram
 from Modules.RoomModule import RoomModule
 from Modules.RoomObject import RoomObject
+from Modules.TimerWheel import timer_wheel
 
 try:
     import bluetooth
@@ -24,34 +29,305 @@ except ImportError:
     logging.error("Bluetooth LE not available")
     bluetoothLE = None
 
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None  # Resolvable private addresses can't be resolved, only fixed addresses are matched
+
+SCAN_DURATION_BUCKETS = [1, 2, 5, 10, 20, 30, 60]  # Seconds
+
+PRESENT = "present"
+LEAVING = "leaving"  # Missed enough probes to be suspect, still counted as in the room until the grace expires
+ABSENT = "absent"
+
 
 class BluetoothDetector(RoomModule):
 
-    def __init__(self, room_controller):
+    def __init__(self, room_controller, isolated=None):
+        """
+        :param isolated: Run the scan engine in a worker process, defaults to the "workerProcess" setting
+        """
         super().__init__(room_controller)
         self.room_controller = room_controller
-        blue_stalker = BlueStalker()
+        if isolated is None:
+            isolated = BlueStalker.load_settings()["workerProcess"]
+        if isolated and os.name == "posix":
+            blue_stalker = BlueStalkerWorker(room_controller=room_controller)
+        else:
+            blue_stalker = BlueStalker(room_controller=room_controller)
 
         self.room_controller.attach_object(blue_stalker)
 
 
+class AddressResolver:
+    """
+    Maps advertised BLE addresses to targets. Fixed addresses (the target's own and any "bleAddresses") are in a
+    lookup table built up front, resolvable private addresses are checked against the targets' IRKs once and the
+    answer is cached, so each rotating address costs a handful of AES blocks at most once.
+    """
+
+    cache_size = 4096
+
+    def __init__(self, occupancy_data):
+        self.table = {}  # Lower case address -> target address, None for addresses known not to be a target
+        self.irks = []  # (IRK, target address)
+        for address, data in occupancy_data.items():
+            self.table[address.lower()] = address
+            for alias in data.get("bleAddresses", []):
+                self.table[alias.lower()] = address
+            if data.get("irk"):
+                # Most significant byte first, note BlueZ stores IRKs least significant byte first
+                self.irks.append((bytes.fromhex(data["irk"].replace(":", "")), address))
+        self.fixed = len(self.table)
+        if self.irks and Cipher is None:
+            logging.warning("BlueStalker: cryptography not available, IRKs will not be used")
+
+    @staticmethod
+    def ah(irk, prand):
+        # Random address hash function from the Bluetooth core spec (Vol 3, Part H, 2.2.2)
+        encryptor = Cipher(algorithms.AES(irk), modes.ECB()).encryptor()
+        return (encryptor.update(bytes(13) + prand) + encryptor.finalize())[-3:]
+
+    def resolve(self, address, addr_type=None):
+        """:return: The target address the advertisement belongs to or None"""
+        address = address.lower()
+        if address in self.table:
+            return self.table[address]
+        target = None
+        raw = bytes.fromhex(address.replace(":", ""))
+        if Cipher is not None and self.irks and raw[0] >> 6 == 0b01:  # Resolvable private address
+            for irk, candidate in self.irks:
+                if self.ah(irk, raw[:3]) == raw[3:]:
+                    target = candidate
+                    break
+        if len(self.table) - self.fixed >= self.cache_size:
+            # Drop the learned entries, phones rotate their addresses every ~15 minutes so most are stale anyway
+            self.table = {key: value for i, (key, value) in enumerate(self.table.items()) if i < self.fixed}
+        self.table[address] = target
+        return target
+
+
+class PresenceTracker:
+    """
+    Per target presence state machine. A sighting makes a target present at once, miss_threshold consecutive misses
+    move it to leaving and it only becomes absent if it isn't seen again within leaving_grace seconds, so one lost
+    probe doesn't flap occupancy. The set of targets in the room is kept incrementally and on_transition is only
+    called for real state changes.
+    """
+
+    def __init__(self, targets, miss_threshold=2, leaving_grace=120, on_transition=None):
+        self.miss_threshold = miss_threshold
+        self.leaving_grace = leaving_grace
+        self.on_transition = on_transition  # Called as on_transition(address, old state, new state)
+        self.states = {address: None for address in targets}  # None until the first probe result
+        self.misses = {address: 0 for address in targets}
+        self.since = {address: None for address in targets}  # When the current state was entered
+        self.entered = {address: None for address in targets}  # When the target last came into the room
+        self.left = {address: None for address in targets}  # When the target last left the room
+        self.in_room = set()  # Targets that are present or leaving
+        self.timers = {}
+        self.lock = threading.RLock()
+
+    def observe(self, address, seen):
+        """Feed one probe result or sighting"""
+        with self.lock:
+            if address not in self.states:
+                return
+            state = self.states[address]
+            if seen:
+                self.misses[address] = 0
+                if state != PRESENT:
+                    self.cancel_timer(address)
+                    self.transition(address, PRESENT)
+                return
+            self.misses[address] += 1
+            if self.misses[address] < self.miss_threshold:
+                return
+            if state == PRESENT:
+                self.transition(address, LEAVING)
+                self.timers[address] = timer_wheel.schedule(self.leaving_grace, self.grace_expired, address)
+            elif state is None:
+                self.transition(address, ABSENT)  # Nothing to leave at startup
+
+    def settled(self, address):
+        """:return: True if the target is present with no misses counted, so another sighting changes nothing"""
+        with self.lock:
+            return self.states.get(address) == PRESENT and not self.misses.get(address)
+
+    def grace_expired(self, address):
+        with self.lock:
+            self.timers.pop(address, None)
+            if self.states[address] == LEAVING:
+                self.transition(address, ABSENT)
+
+    def cancel_timer(self, address):
+        timer = self.timers.pop(address, None)
+        if timer is not None:
+            timer.cancel()
+
+    def transition(self, address, new):
+        old = self.states[address]
+        now = clock.time()
+        self.states[address] = new
+        self.since[address] = now
+        if new == PRESENT and address not in self.in_room:
+            self.in_room.add(address)
+            self.entered[address] = now
+        elif new == ABSENT and address in self.in_room:
+            self.in_room.discard(address)
+            self.left[address] = now
+        if self.on_transition is not None:
+            self.on_transition(address, old, new)
+
+    def snapshot(self, address):
+        return {
+            "state": self.states[address],
+            "since": self.since[address],
+            "entered": self.entered[address],
+            "left": self.left[address],
+            "misses": self.misses[address],
+        }
+
+
+class SocketWatcher:
+    """
+    One thread waits on every open RFCOMM socket for the kernel to report a hangup or error (epoll, or poll where
+    epoll isn't available) and calls on_lost(address, sock) the moment it does, instead of checking each socket with
+    getpeername() on a timer.
+    """
+
+    def __init__(self, on_lost):
+        self.on_lost = on_lost
+        self.lock = threading.Lock()
+        self.watched = {}  # fd -> (address, sock)
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.mask = select.EPOLLRDHUP | select.EPOLLHUP | select.EPOLLERR
+            self.timeout = None  # epoll picks up registrations made while it waits
+        else:
+            self.poller = select.poll()
+            self.mask = select.POLLHUP | select.POLLERR | getattr(select, "POLLRDHUP", 0)
+            self.timeout = 1000  # ms, poll only sees new registrations on its next call
+        self.started = False
+
+    @staticmethod
+    def fileno(sock):
+        try:
+            return sock.fileno()
+        except OSError:
+            return -1
+
+    def watch(self, address, sock):
+        """:return: False if the socket has no file descriptor to wait on"""
+        fd = self.fileno(sock)
+        if fd < 0:
+            return False
+        with self.lock:
+            self.watched[fd] = (address, sock)
+            self.poller.register(fd, self.mask)
+            if not self.started:
+                self.started = True
+                self.run()
+        return True
+
+    def unwatch(self, sock):
+        fd = self.fileno(sock)
+        with self.lock:
+            if fd >= 0 and self.watched.get(fd, (None, None))[1] is sock:
+                del self.watched[fd]
+                try:
+                    self.poller.unregister(fd)
+                except (OSError, KeyError, ValueError):
+                    pass
+
+    def is_watched(self, sock):
+        with self.lock:
+            return self.watched.get(self.fileno(sock), (None, None))[1] is sock
+
+    @background
+    def run(self):
+        logging.info("BlueStalker: Socket watcher started")
+        while True:
+            try:
+                events = self.poller.poll(self.timeout)
+            except InterruptedError:
+                continue
+            for fd, _ in events:
+                with self.lock:
+                    address, sock = self.watched.pop(fd, (None, None))
+                    if sock is not None:
+                        try:
+                            self.poller.unregister(fd)
+                        except (OSError, KeyError, ValueError):
+                            pass
+                if sock is not None:
+                    try:
+                        self.on_lost(address, sock)
+                    except Exception as e:
+                        logging.error(f"BlueStalker: Error handling lost connection to {address}: {e}")
+
+
 class BlueStalker(RoomObject):
     object_type = "BlueStalker"
 
-    def __init__(self, high_frequency_scan_enabled: bool = False):
+    # Most controllers page one device at a time, extra concurrent connects only queue up in the kernel and make
+    # every one of them slower, so the worker pool is sized to the adapter rather than the target list
+    default_settings = {
+        "maxConcurrentConnects": 1,
+        "scanDeadline": 30,  # Seconds a whole scan may take, targets not probed by then wait for the next scan
+        "connectTimeout": 8,  # Seconds a single connect may block for
+        "bleEnabled": True,  # Listen for advertisements, targets seen recently aren't probed over RFCOMM
+        "bleInterface": 0,  # hci device number
+        "bleMinRssi": -90,  # Weaker advertisements are ignored (probably outside the room)
+        "bleFreshness": 60,  # Seconds a sighting counts as presence before an RFCOMM probe has to confirm it
+        "blePublishInterval": 10,  # Seconds between published sightings
+        "missThreshold": 2,  # Consecutive failed probes before a present target is considered leaving
+        "leavingGrace": 120,  # Seconds a leaving target has to be seen again before it is marked absent
+        "uncertainInterval": 15,  # Seconds between scans while a target is leaving or not yet known
+        "maxOccupiedInterval": 300,  # Backoff limit while the room stays occupied
+        "maxEmptyInterval": 600,  # Backoff limit while the room stays empty
+        "motionSensors": [],  # PinWatchers whose triggers start a scan
+        "motionLockout": 20,  # Seconds after a scan during which motion doesn't start another one
+        "workerProcess": False,  # Scan in a supervised child process instead of threads of the satellite
+        "workerHeartbeat": 5,  # Seconds between health reports from the worker
+        "workerHangTimeout": 30,  # Seconds without a report, or past the scan deadline, before the worker is killed
+        "workerRadioRestart": 300,  # Seconds the radio may stay unresponsive before the worker is restarted
+        "workerMaxBackoff": 1800,  # Longest wait between restarts of a worker that keeps failing
+    }
+
+    @classmethod
+    def load_settings(cls):
+        settings = dict(cls.default_settings)
+        if os.path.exists("Configs/BlueStalkerSettings.json"):
+            settings.update(json.load(open("Configs/BlueStalkerSettings.json")))
+        return settings
+
+    def __init__(self, high_frequency_scan_enabled: bool = False, room_controller=None, auto_reboot=True):
         # Target file is a json file that contains bluetooth addresses, name, and role
         super().__init__("BlueStalker2", "BlueStalker")
 
-        self.sockets = {}
+        self.settings = self.load_settings()
+
+        self.sockets = {}  # Address -> open RFCOMM socket, only touched through the *_socket methods
+        self.sockets_lock = threading.Lock()
+        self.watcher = SocketWatcher(self.socket_lost)
+        self.scan_lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=self.settings["maxConcurrentConnects"],
+                                       thread_name_prefix="BlueStalker")
+        self.scan_durations = Histogram(SCAN_DURATION_BUCKETS)
+        self.scan_stats = {"scans": 0, "probes": 0, "connect_timeouts": 0, "deadline_misses": 0, "skipped": 0,
+                           "last_duration": None}
         self.high_frequency_scan_enabled = high_frequency_scan_enabled
 
         self.last_checkup = 0
         self.last_scan = 0
         self.scanning = False
+        self.scan_started = None  # Monotonic start of the scan in progress
 
         self.enabled = True
         self.scan_lockout_time = 0
 
+        self.auto_reboot = auto_reboot  # A worker process is restarted by its supervisor instead
         self.reboot_locked_out = False
         self.reboot_timer = None
 
@@ -77,7 +353,17 @@ class BlueStalker(RoomObject):
         self.set_value("occupied", None)
         self.set_value("high_frequency_scan_enabled", self.high_frequency_scan_enabled)
 
-        self.attach_event_callback(self.should_scan, "scan")
+        self.attach_event_callback("scan", self.should_scan)
+
+        # Adaptive scheduling, the periodic interval backs off while presence is stable and resets on any change
+        self.base_interval = 30 if self.high_frequency_scan_enabled else 60
+        self.scan_interval = self.base_interval
+        self.changed_since_scan = False
+        self.scan_reasons = {"periodic": 0, "uncertain": 0, "motion": 0, "request": 0}
+        self.last_scan_reason = None
+        if room_controller is not None:
+            for sensor in self.settings["motionSensors"]:
+                room_controller.get_object(sensor).attach_event_callback(self.on_motion, "on_triggered_update")
 
         if bluetooth is None or bluetoothLE is None:
             self.reboot_locked_out = True
@@ -86,6 +372,20 @@ class BlueStalker(RoomObject):
         self.heartbeat_alive = False  # If the heartbeat device is alive
         self.heartbeat_failed_attempts = 0
 
+        self.presence = PresenceTracker(self.target_mac_addresses, self.settings["missThreshold"],
+                                        self.settings["leavingGrace"], self.presence_changed)
+        self.occupants = {}  # UUID -> {"name", "address"} of the targets in the room
+        self.set_value("presence", {address: self.presence.snapshot(address)
+                                    for address in self.target_mac_addresses})
+
+        self.resolver = AddressResolver(self.occupancy_data)
+        self.sightings = {}  # Target address -> {"rssi", "last_seen"} from BLE advertisements
+        self.ble_stats = {"adverts": 0, "matched": 0, "weak": 0, "restarts": 0}
+        self.last_sightings_publish = 0
+        self.sightings_lock = threading.Lock()  # The listener thread writes these while probes and publishes read them
+        if self.settings["bleEnabled"] and bluetoothLE is not None and os.name == "posix":
+            self.listen()
+
         if bluetooth is not None:
             self.online = True
             self.fault = False
@@ -119,16 +419,41 @@ class BlueStalker(RoomObject):
                 return
             elif self.reboot_timer is None:
                 logging.warning("BlueStalker: Bluetooth failed, rebooting in 5 minutes")
-                self.reboot_timer = datetime.datetime.now().timestamp() + 300
+                self.reboot_timer = clock.time() + 300
             else:
                 # Check if the reboot timer has expired
-                if self.reboot_timer < datetime.datetime.now().timestamp():
+                if self.reboot_timer < clock.time():
                     logging.warning("BlueStalker: Rebooting")
                     # Run the reboot command with a 1 minute delay to allow the log to be written
                     self.reboot_locked_out = True
                     os.system("sudo shutdown -r +1")
                     return
 
+    def on_motion(self, triggered):
+        # A local motion sensor fired, someone may just have walked in
+        if not triggered or not self.enabled or not self.online:
+            return
+        if clock.time() - self.last_scan < self.settings["motionLockout"]:
+            logging.debug("BlueStalker: Motion ignored, scanned recently")
+            return
+        logging.info("BlueStalker: Scanning on motion")
+        self.scan("motion")
+
+    def uncertain(self):
+        """True while any target is leaving or hasn't been placed yet"""
+        return any(state in (LEAVING, None) for state in self.presence.states.values())
+
+    def next_interval(self):
+        # Called after each scan, the interval doubles while nothing changes
+        if self.uncertain():
+            self.scan_interval = self.settings["uncertainInterval"]
+        elif self.changed_since_scan:
+            self.scan_interval = self.base_interval
+        else:
+            limit = self.settings["maxOccupiedInterval"] if self.presence.in_room else self.settings["maxEmptyInterval"]
+            self.scan_interval = min(max(self.scan_interval * 2, self.base_interval), limit)
+        self.changed_since_scan = False
+
     def should_scan(self):
         """Called externally to tell that it is time to scan"""
         if not self.enabled:
@@ -136,60 +461,206 @@ class BlueStalker(RoomObject):
         if not self.online:
             logging.warning("Bluetooth is offline, scan request rejected")
             return False
-        if self.scan_lockout_time > datetime.datetime.now().timestamp():
+        if self.scan_lockout_time > clock.time():
             logging.warning("Scan lockout time has not expired, scan request rejected")
             return False
         logging.info("BlueStalker: Scanning on request")
-        self.scan()
-        self.scan_lockout_time = datetime.datetime.now().timestamp() + 5
+        self.scan("request")
+        self.scan_lockout_time = clock.time() + 5
+
+    def get_socket(self, address):
+        with self.sockets_lock:
+            return self.sockets.get(address)
+
+    def add_socket(self, address, sock):
+        with self.sockets_lock:
+            previous = self.sockets.get(address)
+            self.sockets[address] = sock
+        if previous is not None and previous is not sock:
+            self.close_socket(previous)
+        self.watcher.watch(address, sock)
+
+    def drop_socket(self, address, sock=None):
+        """Forget and close the socket to address (only if it is still sock, when given), the one place they close"""
+        with self.sockets_lock:
+            if sock is not None and self.sockets.get(address) is not sock:
+                sock_to_close = sock  # Already replaced, just make sure the stale one is closed
+            else:
+                sock_to_close = self.sockets.pop(address, None)
+        if sock_to_close is not None:
+            self.close_socket(sock_to_close)
+
+    def close_socket(self, sock):
+        self.watcher.unwatch(sock)
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def socket_lost(self, address, sock):
+        # Called by the watcher as soon as the kernel reports the connection hung up or failed
+        logging.debug(f"BlueStalker: Connection to {address} lost")
+        with self.sockets_lock:
+            current = self.sockets.get(address) is sock
+        self.drop_socket(address, sock)
+        if not current:
+            return
+        if address == self.heartbeat_device:
+            self.heartbeat_alive = False
+        else:
+            self.update_occupancy(address, False)
 
-    @background
     def life_check(self):
-        """Check if connections are alive, but doesn't run connect"""
+        """Check the connections the watcher can't wait on (no file descriptor), but doesn't run connect"""
         if not self.enabled:
             return
         logging.debug("BlueStalker: Starting Life Check")
+        with self.sockets_lock:
+            open_sockets = [(address, sock) for address, sock in self.sockets.items()
+                            if address in self.target_mac_addresses]
+        for address, sock in open_sockets:
+            if not self.watcher.is_watched(sock):
+                self.conn_is_alive(sock, address)  # getpeername() doesn't block, no thread needed
 
-        heartbeat_was_alive = self.heartbeat_alive
-
-        if not self.heartbeat_alive and heartbeat_was_alive:
-            logging.error("BlueStalker: Heartbeat device lost, delaying next scan")
-            return
-        for target in self.target_mac_addresses:
-            if conn := self.sockets.get(target):  # If the socket is already open
-                self.conn_is_alive(conn, target)  # Check if the connection is still alive
-
-        self.last_checkup = datetime.datetime.now().timestamp()
+        self.last_checkup = clock.time()
 
     @background
-    def scan(self):
-        logging.debug("BlueStalker: Scanning for bluetooth devices")
+    def scan(self, reason="periodic"):
+        logging.debug(f"BlueStalker: Scanning for bluetooth devices ({reason})")
 
-        if self.scanning:
-            logging.warning("BlueStalker: Scan already in progress")
-            return
-
-        self.scanning = True
-        conn_threads = []
-        for target in self.target_mac_addresses:
-            if self.sockets.get(target) is None:  # If the socket is already open
-                conn_threads.append(self.connect(target))  # Else attempt to connect to the device
+        with self.scan_lock:
+            if self.scanning:
+                logging.warning("BlueStalker: Scan already in progress")
+                return
+            self.scanning = True
+        self.scan_reasons[reason] = self.scan_reasons.get(reason, 0) + 1
+        self.last_scan_reason = reason
 
+        started = self.scan_started = clock.monotonic()
+        deadline = started + self.settings["scanDeadline"]
+        # Targets advertising recently are known to be here, RFCOMM only confirms the rest
+        probes = [(target, False) for target in self.target_mac_addresses
+                  if self.get_socket(target) is None and not self.recently_seen(target)]
         try:
             # Check if the heartbeat device is still connected
-            if self.heartbeat_alive and self.sockets.get(self.heartbeat_device):
-                self.conn_is_alive(self.sockets[self.heartbeat_device], self.heartbeat_device, is_heartbeat=True)
+            heartbeat_socket = self.get_socket(self.heartbeat_device)
+            if self.heartbeat_alive and heartbeat_socket:
+                if not self.watcher.is_watched(heartbeat_socket):
+                    self.conn_is_alive(heartbeat_socket, self.heartbeat_device, is_heartbeat=True)
             else:
-                self.connect(self.heartbeat_device, is_heartbeat=True)
+                probes.insert(0, (self.heartbeat_device, True))  # First, it tells whether the radio works at all
         except Exception as e:
             logging.error(f"BlueStalker: Error checking heartbeat device: {e}")
             logging.exception(e)
             self.heartbeat_alive = False
 
-        for thread in conn_threads:
-            thread.join()
-        self.scanning = False
-        self.last_scan = datetime.datetime.now().timestamp()  # Update the last update time
+        # Probes run on the bounded pool, the scan waits for them until the deadline at the latest
+        finished = threading.Event()
+        outstanding = [len(probes)]
+        outstanding_lock = threading.Lock()
+
+        def probe_done(_):
+            with outstanding_lock:
+                outstanding[0] -= 1
+                if outstanding[0] == 0:
+                    finished.set()
+
+        if not probes:
+            finished.set()
+        jobs = []
+        for address, is_heartbeat in probes:
+            job = self.pool.submit(self.connect, address, is_heartbeat, deadline)
+            job.add_done_callback(probe_done)
+            jobs.append(job)
+        clock.wait(finished, max(deadline - clock.monotonic(), 0))
+
+        skipped = sum(1 for job in jobs if job.cancel())  # Probes that never got a worker before the deadline
+        if not finished.is_set():
+            self.scan_stats["deadline_misses"] += 1
+            logging.warning(f"BlueStalker: Scan deadline of {self.settings['scanDeadline']}s passed, "
+                            f"{skipped} probes skipped")
+        duration = clock.monotonic() - started
+        self.scan_durations.observe(duration)
+        self.scan_stats["scans"] += 1
+        self.scan_stats["probes"] += len(probes) - skipped
+        self.scan_stats["skipped"] += skipped
+        self.scan_stats["last_duration"] = round(duration, 3)
+        super().set_value("scan_stats", dict(self.scan_stats, duration=self.scan_durations.snapshot()),
+                          block_event=True)
+
+        self.last_scan = clock.time()  # Update the last update time
+        self.next_interval()
+        super().set_value("scan_schedule", {"interval": self.scan_interval, "reasons": dict(self.scan_reasons),
+                                            "last_reason": reason, "next_scan": self.last_scan + self.scan_interval},
+                          block_event=True)
+        with self.scan_lock:
+            self.scanning = False
+            self.scan_started = None
+
+    def recently_seen(self, address):
+        with self.sightings_lock:
+            sighting = self.sightings.get(address)
+        return sighting is not None and clock.time() - sighting["last_seen"] < self.settings["bleFreshness"]
+
+    def sighting(self, entry):
+        """Called from the BLE listener for every advertisement"""
+        target = self.resolver.resolve(entry.addr, entry.addrType)
+        publish = None
+        with self.sightings_lock:
+            self.ble_stats["adverts"] += 1
+            if target is None or target not in self.occupancy_data:
+                return
+            if entry.rssi < self.settings["bleMinRssi"]:
+                self.ble_stats["weak"] += 1
+                return
+            self.ble_stats["matched"] += 1
+            self.sightings[target] = {"rssi": entry.rssi, "last_seen": clock.time()}
+            if clock.time() - self.last_sightings_publish > self.settings["blePublishInterval"]:
+                # Advertisements arrive several times a second per device, the values are only refreshed periodically
+                self.last_sightings_publish = clock.time()
+                publish = ({address: dict(sighting) for address, sighting in self.sightings.items()},
+                           dict(self.ble_stats))
+        if not self.presence.settled(target):
+            # Most adverts come from targets already present, only the ones that change something reach the tracker
+            self.update_occupancy(target, True)
+        if publish is not None:
+            super().set_value("sightings", publish[0], block_event=True)
+            super().set_value("ble_stats", publish[1], block_event=True)
+
+    @background
+    def listen(self):
+        """Passive BLE scan that runs for the lifetime of the satellite, restarted with a backoff if the stack fails"""
+        stalker = self
+
+        class Delegate(bluetoothLE.DefaultDelegate):
+            def handleDiscovery(self, scanEntry, isNewDev, isNewData):
+                try:
+                    stalker.sighting(scanEntry)
+                except Exception as e:
+                    logging.error(f"BlueStalker: Error handling advertisement from {scanEntry.addr}: {e}")
+
+        backoff = 1
+        while True:
+            scanner = None
+            try:
+                scanner = bluetoothLE.Scanner(self.settings["bleInterface"]).withDelegate(Delegate())
+                scanner.start(passive=True)
+                logging.info("BlueStalker: Listening for BLE advertisements")
+                backoff = 1
+                while True:
+                    scanner.process(1.0)
+            except Exception as e:  # bluepy raises BTLEException subclasses and plain errors from its helper
+                logging.error(f"BlueStalker: BLE listener failed - {e}, restarting in {backoff}s")
+                with self.sightings_lock:
+                    self.ble_stats["restarts"] += 1
+            finally:
+                if scanner is not None:
+                    try:
+                        scanner.stop()
+                    except Exception:
+                        pass
+            clock.sleep(backoff)
+            backoff = min(backoff * 2, 300)
 
     def determine_health(self):
         # if self.route_lost:
@@ -205,14 +676,15 @@ class BlueStalker(RoomObject):
         else:
             # If the heartbeat device is not alive and there are no other devices connected
             # Then the bluetooth detector is offline
-            if len(self.sockets) == 0:
+            if not self.sockets:
                 self.fault = True
                 self.online = False
                 if self.reboot_locked_out:
                     self.fault_message = "Radio Failure"
                 else:
                     self.fault_message = "Radio Unresponsive"
-                self.auto_reboot_check()
+                if self.auto_reboot:
+                    self.auto_reboot_check()
             else:
                 self.fault = True
                 self.online = True
@@ -233,60 +705,57 @@ class BlueStalker(RoomObject):
             try:
                 self.determine_health()
                 self.life_check()
-                if self.enabled:
-                    if self.high_frequency_scan_enabled:
-                        if self.last_scan + 30 < datetime.datetime.now().timestamp():
-                            self.scan()
-                    else:
-                        if self.last_scan + 60 < datetime.datetime.now().timestamp():
-                            self.scan()
+                if self.enabled and self.last_scan + self.scan_interval <= clock.time():
+                    self.scan("uncertain" if self.scan_interval < self.base_interval else "periodic")
                 self.determine_health()
-                time.sleep(15)
+                clock.sleep(min(15, self.settings["uncertainInterval"]))
             except Exception as e:
                 logging.error(f"BluetoothOccupancy: Refresh loop failed with error {e}")
                 break
         self.fault = True
         self.fault_message = "Refresh loop exited"
 
-    @background
-    def connect(self, address, is_heartbeat=False):
+    def connect(self, address, is_heartbeat=False, deadline=None):
+        """Probe one address, runs on the scan pool"""
         if bluetooth is None:
             self.fault = True
             self.fault_message = "Bluetooth not available"
             return
+        timeout = self.settings["connectTimeout"]
+        if deadline is not None:
+            timeout = min(timeout, deadline - clock.monotonic())
+            if timeout <= 0:
+                return  # The scan's deadline passed while this probe was queued
         sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        sock.setblocking(True)  # Set the socket to non-blocking
+        sock.settimeout(timeout)
         try:
             logging.debug(f"BlueStalker: Connecting to {address}, timeout {sock.gettimeout()}")
-            sock.connect((address, 1))  # Start the connection (Will fail with EINPROGRESS)
+            sock.connect((address, 1))
         except bluetooth.btcommon.BluetoothError as e:
             if e.__str__() == "[Errno 111] Connection refused":
                 # Connection refused still counts as a device being present because in order to refuse a connection
                 # the device must be in range and have a working radio
                 logging.error(f"BlueStalker: Connection to address {address} refused, device is in range")
+                self.close_socket(sock)
                 if not is_heartbeat:
                     self.update_occupancy(address, True)
                 else:
                     self.heartbeat_alive = True
                     self.heartbeat_failed_attempts = 0
                 return
-            elif e.__str__() == "[Errno 115] Operation now in progress":  # This is the error we expect to see
-                logging.debug(f"BlueStalker: Connection to {address} is in progress")
-                if not is_heartbeat:
-                    self.update_occupancy(address, False)
-                else:
-                    self.heartbeat_failed_attempts += 1
-                self.sockets[address] = sock  # Add the socket to the list of sockets
-                time.sleep(2.5)  # Wait for the connection to complete
-                self.conn_is_alive(sock, address)  # Check if the connection is still alive
-                return
             elif e.__str__() == "[Errno 113] No route to host":
                 # Happens when the Bluetooth adapter is not available
                 logging.error(f"BlueStalker: No route to host, bluetooth offline")
+                self.close_socket(sock)
                 self.route_lost = True
                 return
-            else:  # Any other error is unexpected
-                logging.error(f"BlueStalker: Connection to address {address} failed with error {e}")
+            else:  # Timed out (device out of range) or an unexpected error
+                if "timed out" in e.__str__():
+                    self.scan_stats["connect_timeouts"] += 1
+                    logging.debug(f"BlueStalker: Connection to address {address} timed out after {timeout:.1f}s")
+                else:
+                    logging.error(f"BlueStalker: Connection to address {address} failed with error {e}")
+                self.close_socket(sock)
                 if not is_heartbeat:
                     self.update_occupancy(address, False)
                 else:
@@ -294,6 +763,7 @@ class BlueStalker(RoomObject):
                 return
         except OSError as e:  # Any additional errors that the OS throws are caught here
             logging.error(f"BlueStalker: Failed to connect to {address} with error {e}")
+            self.close_socket(sock)
             if not is_heartbeat:
                 self.update_occupancy(address, False)
             else:
@@ -301,7 +771,8 @@ class BlueStalker(RoomObject):
             return
         else:
             logging.debug(f"BlueStalker: Connected to {address}")
-            self.sockets[address] = sock
+            sock.settimeout(None)
+            self.add_socket(address, sock)
             self.route_lost = False
             if not is_heartbeat:
                 self.update_occupancy(address, True)
@@ -311,23 +782,21 @@ class BlueStalker(RoomObject):
             logging.error("BlueStalker: Heartbeat device failed 3 connection attempts, marking as dead")
             self.heartbeat_alive = False
 
-    @background
-    def conn_is_alive(self, connection, address):
+    def conn_is_alive(self, connection, address, is_heartbeat=False):
         logging.debug(f"BlueStalker: Checking if {address} is alive")
         try:
             connection.getpeername()
-        except bluetooth.BluetoothError as e:
+        except OSError as e:  # BluetoothError is an OSError
             logging.debug(f"BlueStalker: Connection to {address} is dead, reason: {e}")
-            self.update_occupancy(address, False)
-            self.sockets.pop(address)
-        except OSError as e:
-            logging.debug(f"BlueStalker: Connection to {address} is dead, reason: {e}")
-            connection.close()
-            self.update_occupancy(address, False)
-            self.sockets.pop(address)
+            self.drop_socket(address, connection)
+            if is_heartbeat:
+                self.heartbeat_alive = False
+            else:
+                self.update_occupancy(address, False)
         else:
             # logging.info(f"Connection to {address} is alive")
-            self.update_occupancy(address, True)
+            if not is_heartbeat:
+                self.update_occupancy(address, True)
 
     def get_targets(self):
         return {
@@ -338,16 +807,33 @@ class BlueStalker(RoomObject):
         }
 
     def update_occupancy(self, address, in_room):
-        # Get the UUID of the mac address
-        # Check if an occupancy entry exists for the address
-        self.occupancy_data[address]["present"] = in_room
-        self.set_value("occupants", {
-            int(data["uuid"]): {
-                "name": data["name"],
-                "address": address
-            } for uuid, data in self.occupancy_data.items() if data["present"] is True
-        })
-        self.set_value("occupied", len([data for data in self.occupancy_data.values() if data["present"] is True]) > 0)
+        """Feed a probe result or sighting into the presence state machine"""
+        if not in_room and self.recently_seen(address):
+            return  # A failed probe doesn't outweigh a fresh advertisement
+        self.presence.observe(address, in_room)
+
+    def presence_changed(self, address, old, new):
+        # Called by the PresenceTracker on real transitions only
+        data = self.occupancy_data[address]
+        logging.info(f"BlueStalker: {data['name']} is now {new} (was {old})")
+        self.changed_since_scan = True
+        # Don't sit out a long backoff once things start changing
+        limit = self.settings["uncertainInterval"] if new == LEAVING else self.base_interval
+        self.scan_interval = min(self.scan_interval, limit)
+        data["present"] = address in self.presence.in_room
+        super().set_value("presence", {**(self.get_value("presence") or {}),
+                                       address: self.presence.snapshot(address)}, block_event=True)
+        uuid = int(data["uuid"])
+        if data["present"] and uuid not in self.occupants:
+            self.occupants = {**self.occupants, uuid: {"name": data["name"], "address": address}}
+            super().emit_event("occupant_entered", uuid, self.presence.entered[address])
+        elif not data["present"] and uuid in self.occupants:
+            self.occupants = {key: value for key, value in self.occupants.items() if key != uuid}
+            super().emit_event("occupant_left", uuid, self.presence.left[address])
+        elif old is not None:
+            return
+        self.set_value("occupants", self.occupants)
+        self.set_value("occupied", bool(self.presence.in_room))
 
     def get_health(self):
         return {
@@ -355,3 +841,193 @@ class BlueStalker(RoomObject):
             "fault": self.fault,
             "reason": self.fault_message
         }
+
+
+def scan_worker(conn, high_frequency_scan_enabled, heartbeat_interval):
+    """
+    Entry point of the worker process, runs a BlueStalker and relays its value changes and events to the parent
+    over conn. The parent's commands ("scan", "motion") arrive on the same pipe.
+    """
+    send_lock = threading.Lock()
+
+    def send(*message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (OSError, ValueError):
+                os._exit(0)  # The parent is gone
+
+    RoomObject.add_value_hook(
+        lambda room_object, key, value: send("value", key, value) if isinstance(room_object, BlueStalker) else None)
+    stalker = BlueStalker(high_frequency_scan_enabled, auto_reboot=False)
+    stalker.network_event_hook(
+        lambda room_object, event_name, *args, **kwargs: send("event", event_name, args, kwargs))
+
+    @background
+    def report():
+        while True:
+            started = stalker.scan_started
+            send("health", stalker.get_health(), None if started is None else clock.monotonic() - started)
+            clock.sleep(heartbeat_interval)
+
+    report()
+    while True:
+        try:
+            command, *args = conn.recv()
+        except (EOFError, OSError):
+            return
+        if command == "scan":
+            stalker.should_scan()
+        elif command == "motion":
+            stalker.on_motion(*args)
+        elif command == "stop":
+            return
+
+
+class BlueStalkerWorker(RoomObject):
+    """
+    Stands in for a BlueStalker that runs in a child process, so blocking Bluetooth calls and a hung adapter can't
+    stall the rest of the satellite. The worker's value changes and events are replayed on this object as they
+    arrive, and the worker is killed and started again when it stops reporting, a scan outlives its deadline or
+    the radio stays unresponsive. Restarting the process closes every socket it had open and recovers far faster
+    than the host reboot an in process BlueStalker falls back to.
+    """
+
+    object_type = "BlueStalker"
+
+    def __init__(self, high_frequency_scan_enabled: bool = False, room_controller=None):
+        super().__init__("BlueStalker2", "BlueStalker")
+        self.settings = BlueStalker.load_settings()
+        self.high_frequency_scan_enabled = high_frequency_scan_enabled
+        self.context = multiprocessing.get_context("spawn")  # Forking a process with threads running isn't safe
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.health = {"online": False, "fault": True, "reason": "Worker starting"}
+        self.last_report = None  # Monotonic time of the last message from the worker
+        self.scan_age = None  # Seconds the worker's current scan has been running for
+        self.unresponsive_since = None  # Monotonic time the worker's radio went offline
+        self.backoff = 1
+        self.worker_stats = {"pid": None, "restarts": 0, "last_restart_reason": None, "started": None}
+
+        self.attach_event_callback("scan", self.should_scan)
+        if room_controller is not None:
+            for sensor in self.settings["motionSensors"]:
+                room_controller.get_object(sensor).attach_event_callback(self.on_motion, "on_triggered_update")
+        self.supervise()
+
+    def send(self, *message):
+        with self.send_lock:
+            if self.conn is None:
+                return False
+            try:
+                self.conn.send(message)
+            except (OSError, ValueError):
+                return False
+        return True
+
+    def should_scan(self):
+        """Called externally to tell that it is time to scan"""
+        return self.send("scan")
+
+    def on_motion(self, triggered):
+        if triggered:
+            self.send("motion", triggered)
+
+    def start_worker(self):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=scan_worker, name="BlueStalkerWorker", daemon=True,
+                                       args=(child_conn, self.high_frequency_scan_enabled,
+                                             self.settings["workerHeartbeat"]))
+        process.start()
+        child_conn.close()
+        with self.send_lock:
+            self.process, self.conn = process, conn
+        self.last_report = clock.monotonic()
+        self.scan_age = None
+        self.unresponsive_since = None
+        self.worker_stats["pid"] = process.pid
+        self.worker_stats["started"] = clock.time()
+        super().set_value("worker", dict(self.worker_stats), block_event=True)
+        logging.info(f"BlueStalker: Worker process started with pid {process.pid}")
+
+    def stop_worker(self):
+        with self.send_lock:
+            process, conn = self.process, self.conn
+            self.process = self.conn = None
+        if process is None:
+            return  # Never started or already stopped
+        conn.close()
+        process.terminate()
+        process.join(2)
+        if process.is_alive():
+            process.kill()  # Stuck in the kernel, e.g. in a connect to a hung adapter
+            process.join(5)
+
+    def handle(self, message):
+        kind, *args = message
+        self.last_report = clock.monotonic()
+        if kind == "value":
+            key, value = args
+            # The worker already emitted on_<key>_update if it wanted to, it arrives as its own message
+            super().set_value(key, value, block_event=True)
+        elif kind == "event":
+            event_name, event_args, event_kwargs = args
+            super().emit_event(event_name, *event_args, **event_kwargs)
+        elif kind == "health":
+            self.health, self.scan_age = args
+            if self.health["online"]:
+                self.backoff = 1  # Working again, the next failure is retried quickly
+            # Like the reboot it replaces, only an unresponsive radio is restarted, a missing stack won't come back
+            if self.health["reason"] != "Radio Unresponsive":
+                self.unresponsive_since = None
+            elif self.unresponsive_since is None:
+                self.unresponsive_since = clock.monotonic()
+
+    def hang_reason(self):
+        """:return: Why the worker has to be restarted, None if it is fine"""
+        if not self.process.is_alive():
+            return f"Exited with code {self.process.exitcode}"
+        now = clock.monotonic()
+        if now - self.last_report > self.settings["workerHangTimeout"]:
+            return f"No report for {self.settings['workerHangTimeout']}s"
+        if self.scan_age is not None and \
+                self.scan_age > self.settings["scanDeadline"] + self.settings["workerHangTimeout"]:
+            return f"Scan running for {self.scan_age:.0f}s"
+        if self.unresponsive_since is not None and now - self.unresponsive_since > self.settings["workerRadioRestart"]:
+            return f"Radio unresponsive for {self.settings['workerRadioRestart']}s"
+        return None
+
+    def restart(self, reason):
+        logging.warning(f"BlueStalker: Restarting worker process ({reason}), retrying in {self.backoff}s")
+        self.stop_worker()
+        self.health = {"online": False, "fault": True, "reason": f"Worker restarting: {reason}"}
+        self.worker_stats["restarts"] += 1
+        self.worker_stats["last_restart_reason"] = reason
+        self.worker_stats["pid"] = None
+        super().set_value("worker", dict(self.worker_stats), block_event=True)
+        clock.sleep(self.backoff)
+        self.backoff = min(self.backoff * 2, self.settings["workerMaxBackoff"])
+
+    @background
+    def supervise(self):
+        while True:
+            try:
+                if self.process is None:
+                    self.start_worker()
+                try:
+                    if self.conn.poll(1.0):
+                        while self.conn.poll(0):
+                            self.handle(self.conn.recv())
+                except (EOFError, OSError):
+                    pass  # The worker died, is_alive() tells why
+                reason = self.hang_reason()
+                if reason is not None:
+                    self.restart(reason)
+            except Exception as e:
+                logging.error(f"BlueStalker: Worker supervisor failed with error {e}")
+                logging.exception(e)
+                clock.sleep(self.backoff)
+
+    def get_health(self):
+        return self.health
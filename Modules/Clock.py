@@ -0,0 +1,55 @@
+import time
+
+
+class SystemClock:
+    """The real wall and monotonic clocks, used unless a simulation swaps in another source"""
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def monotonic_ns(self):
+        return time.monotonic_ns()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, timeout=None):
+        """
+        Wait for a threading.Event to be set or for the timeout to pass
+        :return: True if the event was set, False on timeout
+        """
+        return event.wait(timeout)
+
+
+class Clock:
+    """
+    Injectable clock shared by every module, all loops should sleep and read the time through this instead of
+    calling the time module directly so that a simulation can run them on virtual time
+    """
+
+    def __init__(self, source=None):
+        self.source = source or SystemClock()
+
+    def set_source(self, source):
+        self.source = source
+
+    def time(self):
+        return self.source.time()
+
+    def monotonic(self):
+        return self.source.monotonic()
+
+    def monotonic_ns(self):
+        return self.source.monotonic_ns()
+
+    def sleep(self, seconds):
+        self.source.sleep(seconds)
+
+    def wait(self, event, timeout=None):
+        return self.source.wait(event, timeout)
+
+
+clock = Clock()
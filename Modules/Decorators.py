@@ -17,8 +17,12 @@ def background(func):
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):  # replaces original function...
-        # ...and launches the original in a thread
-        thread = Thread(target=func, args=args, kwargs=kwargs, daemon=True)
+        # ...and launches the original in a thread named after the job, so thread dumps and profiles show what it is
+        name = func.__qualname__
+        owner = getattr(args[0], "object_name", None) if args else None
+        if isinstance(owner, str):
+            name = f"{name}({owner})"
+        thread = Thread(target=func, args=args, kwargs=kwargs, daemon=True, name=name)
         thread.start()
         return thread
 
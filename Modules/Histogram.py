@@ -0,0 +1,34 @@
+import bisect
+import threading
+
+
+class Histogram:
+    """
+    Fixed bucket histogram, cheap enough to observe on every transaction. Buckets are upper bounds, anything above
+    the last bound lands in the overflow (+Inf) bucket
+    """
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "buckets": self.buckets + ["+Inf"],
+                "counts": list(self.counts),
+                "count": self.count,
+                "sum": round(self.sum, 3),
+                "max": round(self.max, 3),
+            }
@@ -1,12 +1,21 @@
 import asyncio
+import hmac
+import json
+import os
+import threading
 
 import aiohttp
 from aiohttp import web
 
+from Modules.Histogram import Histogram
+from Modules.Metrics import CONTENT_TYPE, MetricsRegistry
+from Modules.Profiler import dump_threads, memory_tracer, profiler
 from Modules.RoomModule import RoomModule
 from loguru import logger as logging
 import netifaces
 
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # Seconds
+
 
 def get_host_names(filter_local=True):
     """
@@ -39,7 +48,23 @@ class LinkHost(RoomModule):
         self.app = web.Application()
         self.app.add_routes([web.post('/downlink', self.downlink),
                              web.get('/uplink', self.uplink),
-                             web.post('/event', self.event)])
+                             web.post('/event', self.event),
+                             web.get('/history', self.history),
+                             web.get('/metrics', self.metrics_endpoint),
+                             web.get('/debug/threads', self.debug_threads),
+                             web.get('/debug/loop', self.debug_loop),
+                             web.get('/debug/profile', self.debug_profile_status),
+                             web.post('/debug/profile/start', self.debug_profile_start),
+                             web.post('/debug/profile/stop', self.debug_profile_stop),
+                             web.get('/debug/memory', self.debug_memory_status),
+                             web.post('/debug/memory/start', self.debug_memory_start),
+                             web.post('/debug/memory/snapshot', self.debug_memory_snapshot),
+                             web.get('/debug/memory/snapshot/{snapshot_id}', self.debug_memory_download),
+                             web.get('/debug/memory/diff', self.debug_memory_diff),
+                             web.post('/debug/memory/stop', self.debug_memory_stop)])
+        self.debug_token = None
+        if os.path.exists("Configs/Debug.json"):
+            self.debug_token = json.load(open("Configs/Debug.json")).get("token")
 
         self.room_modules = []
         self.room_objects = []
@@ -52,6 +77,25 @@ class LinkHost(RoomModule):
         self.runner = web.AppRunner(self.app)
         self.loop = asyncio.get_event_loop()
 
+        self.uplink_latency = Histogram(LATENCY_BUCKETS)
+        self.event_latency = Histogram(LATENCY_BUCKETS)
+        self.event_stats = {"queued": 0, "sent": 0, "failed": 0}
+        self.event_stats_lock = threading.Lock()  # Events are fired from whichever thread changed a value
+        self.metrics = MetricsRegistry()
+        self.metrics.register("satellite_event_queue_depth", "gauge", "Events waiting to be sent to the master",
+                              self.event_queue_depth)
+        self.metrics.register("satellite_events_sent", "counter", "Events sent to the master",
+                              lambda: self.event_stats["sent"])
+        self.metrics.register("satellite_events_failed", "counter", "Events that failed to send",
+                              lambda: self.event_stats["failed"])
+        self.metrics.register("satellite_uplink_latency_seconds", "histogram", "Uplink POST round trip time",
+                              self.uplink_latency.snapshot)
+        self.metrics.register("satellite_event_latency_seconds", "histogram", "Event POST round trip time",
+                              self.event_latency.snapshot)
+        self.metrics.register("satellite_threads", "gauge", "Live threads", threading.active_count)
+        self.metrics.register("satellite_loop_lag_seconds", "gauge", "How late the event loop last ran a timer",
+                              self.loop_lag)
+
         asyncio.create_task(self.main())
 
     async def get_site(self):
@@ -85,8 +129,10 @@ class LinkHost(RoomModule):
                     room_object._network_hook = self.fire_event
                 # logging.info("Sending uplink")
                 # print(self.generate_payload())
+                started = self.loop.time()
                 async with self.session.post(f"http://{self.host_address}:47670/uplink",
                                              json=self.generate_payload()) as response:
+                    self.uplink_latency.observe(self.loop.time() - started)
                     if response.status != 200:
                         logging.warning(f"Failed to send uplink: {response.status}")
                     else:
@@ -97,11 +143,19 @@ class LinkHost(RoomModule):
             finally:
                 await asyncio.sleep(15)
 
+    def event_queue_depth(self):
+        with self.event_stats_lock:
+            return self.event_stats["queued"] - self.event_stats["sent"] - self.event_stats["failed"]
+
     def fire_event(self, room_object, event_name, *args, **kwargs):
         logging.info(f"Firing event {event_name} for {room_object.object_name}")
+        with self.event_stats_lock:
+            self.event_stats["queued"] += 1
         self.loop.create_task(self.send_event(room_object, event_name, *args, **kwargs))
 
     async def send_event(self, room_object, event_name, *args, **kwargs):
+        sent = False
+        started = self.loop.time()
         try:
             async with self.session.post(f"http://{self.host_address}:47670/event",
                                          json={"name": self.room_controller.name,
@@ -111,13 +165,23 @@ class LinkHost(RoomModule):
                                                "args": args,
                                                "kwargs": kwargs,
                                                "auth": self.room_controller.auth}) as response:
+                self.event_latency.observe(self.loop.time() - started)
                 if response.status != 200:
                     logging.warning(f"Failed to send event: {response.status}")
                 else:
+                    sent = True
                     logging.info("Event sent")
         except Exception as e:
             logging.error(f"Error sending event: {e}")
             logging.exception(e)
+        finally:
+            with self.event_stats_lock:
+                self.event_stats["sent" if sent else "failed"] += 1
+
+    def loop_lag(self):
+        # Measured by the LoopMonitor, whose full lag histogram is exported with its values
+        host = self.room_controller.get_module("LoopMonitorHost")
+        return host.monitor.last_lag if host is not None and host.monitor is not None else None
 
     async def downlink(self, request):
         data = await request.json()
@@ -147,3 +211,133 @@ class LinkHost(RoomModule):
             logging.error(f"Error processing event: {e}")
             logging.exception(e)
             return web.Response(text="Error processing event", status=500)
+
+    async def metrics_endpoint(self, request):
+        """OpenMetrics exposition of every value, health flag and the link's own counters"""
+        body = self.metrics.render(self.room_controller.get_all_objects())
+        return web.Response(body=body.encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    def debug_authorized(self, request):
+        """Debug requests carry the token from Configs/Debug.json as a bearer token, never in the logged URL"""
+        header = request.headers.get("Authorization", "")
+        if not header.startswith("Bearer "):
+            return False
+        return hmac.compare_digest(header[len("Bearer "):].encode(), str(self.debug_token).encode())
+
+    @staticmethod
+    def attachment(body, filename, content_type="text/plain"):
+        if isinstance(body, str):
+            body = body.encode()
+        return web.Response(body=body, headers={"Content-Type": content_type,
+                                                "Content-Disposition": f'attachment; filename="{filename}"'})
+
+    async def debug_endpoint(self, request, handler):
+        if not self.debug_token:
+            return web.Response(text="Not found", status=404)  # Debugging is off unless a token is configured
+        if not self.debug_authorized(request):
+            logging.warning(f"Rejected unauthorized debug request {request.path} from {request.remote}")
+            return web.Response(text="Unauthorized", status=401)
+        try:
+            return await handler()
+        except (KeyError, ValueError) as e:
+            return web.Response(text=f"Bad debug request: {e}", status=400)
+        except Exception as e:
+            logging.error(f"Error processing debug request {request.path}: {e}")
+            logging.exception(e)
+            return web.Response(text="Error processing debug request", status=500)
+
+    async def debug_threads(self, request):
+        async def handler():
+            return self.attachment(dump_threads(), f"{self.room_controller.name}-threads.txt")
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_loop(self, request):
+        async def handler():
+            host = self.room_controller.get_module("LoopMonitorHost")
+            if host is None or host.monitor is None:
+                return web.Response(text="Event loop is not monitored", status=404)
+            return web.json_response(host.monitor.get_stalls())
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_profile_status(self, request):
+        async def handler():
+            return web.json_response(profiler.status())
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_profile_start(self, request):
+        async def handler():
+            duration = request.query.get("duration")
+            started = profiler.start(float(request.query.get("interval", 0.01)),
+                                     float(duration) if duration else None)
+            return web.json_response(dict(profiler.status(), started_now=started))
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_profile_stop(self, request):
+        async def handler():
+            return self.attachment(profiler.stop(), f"{self.room_controller.name}-profile.folded")
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_memory_status(self, request):
+        async def handler():
+            return web.json_response(memory_tracer.status())
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_memory_start(self, request):
+        async def handler():
+            started = memory_tracer.start(int(request.query.get("frames", 10)))
+            return web.json_response(dict(memory_tracer.status(), started_now=started))
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_memory_snapshot(self, request):
+        async def handler():
+            # Snapshots of a big heap take a while, keep them off the loop
+            snapshot_id = await self.loop.run_in_executor(None, memory_tracer.snapshot)
+            if snapshot_id is None:
+                return web.Response(text="Not tracing, start tracing first", status=409)
+            top = await self.loop.run_in_executor(None, memory_tracer.top, snapshot_id,
+                                                  int(request.query.get("limit", 30)))
+            return web.json_response({"id": snapshot_id, "top": top})
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_memory_download(self, request):
+        async def handler():
+            snapshot_id = int(request.match_info["snapshot_id"])
+            body = await self.loop.run_in_executor(None, memory_tracer.dump, snapshot_id)
+            return self.attachment(body, f"{self.room_controller.name}-{snapshot_id}.snapshot",
+                                   "application/octet-stream")
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_memory_diff(self, request):
+        async def handler():
+            query = request.query
+            text = await self.loop.run_in_executor(None, memory_tracer.diff, int(query["old"]), int(query["new"]),
+                                                   int(query.get("limit", 30)), query.get("group_by", "lineno"))
+            return self.attachment(text, f"{self.room_controller.name}-{query['old']}-{query['new']}.diff.txt")
+        return await self.debug_endpoint(request, handler)
+
+    async def debug_memory_stop(self, request):
+        async def handler():
+            memory_tracer.stop()
+            return web.json_response(memory_tracer.status())
+        return await self.debug_endpoint(request, handler)
+
+    async def history(self, request):
+        """Historical values from the local time series store, used by the master to backfill after an outage"""
+        time_series = self.room_controller.get_module("TimeSeriesHost")
+        if time_series is None:
+            return web.Response(text="History not available", status=404)
+        try:
+            query = request.query
+            start = float(query["start"]) if "start" in query else None
+            end = float(query["end"]) if "end" in query else None
+            resolution = query.get("resolution", "raw")
+            points = await self.loop.run_in_executor(None, time_series.query, query["object"], query["key"],
+                                                     start, end, resolution, query.get("limit"))
+            return web.json_response({"object": query["object"], "key": query["key"],
+                                      "resolution": resolution, "points": points})
+        except (KeyError, ValueError) as e:
+            return web.Response(text=f"Bad history request: {e}", status=400)
+        except Exception as e:
+            logging.error(f"Error processing history request: {e}")
+            logging.exception(e)
+            return web.Response(text="Error processing history request", status=500)
@@ -0,0 +1,140 @@
+import asyncio
+import collections
+import socket
+import sys
+import threading
+import traceback
+
+from loguru import logger as logging
+
+from Modules.Clock import clock
+from Modules.Histogram import Histogram
+from Modules.RoomModule import RoomModule
+from Modules.RoomObject import RoomObject
+
+LAG_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]  # Seconds
+
+
+class LoopMonitorHost(RoomModule):
+
+    def __init__(self, room_controller):
+        super().__init__(room_controller)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            logging.warning("LoopMonitorHost: No running event loop, not monitoring")
+            self.monitor = None
+            return
+        self.monitor = LoopMonitor(f"loop_monitor-{socket.gethostname()}", loop)
+        self.room_controller.attach_object(self.monitor)
+        self.monitor.start()
+
+
+class LoopMonitor(RoomObject):
+    """
+    Watches the asyncio loop the web servers and uplink run on. A timer is scheduled every interval seconds and
+    how late it runs is the loop lag, kept in a histogram. A watchdog thread checks on the timer and once it is
+    more than threshold seconds overdue the loop is stuck in a callback, so it grabs the loop thread's stack right
+    then; that is the handler or task step that blocks. Stalls are kept with their duration and stack and served on
+    /debug/loop, only the lag, its histogram and the stall count are published as values.
+    """
+
+    is_promise = False
+    is_sensor_only = True
+    interval = 0.25  # Seconds between lag timers
+    threshold = 0.1  # Seconds a timer may be overdue before the callback holding the loop counts as slow
+    publish_interval = 10  # Seconds between published lag values, the stall count is published as each one ends
+    max_stalls = 20  # Recent stalls kept for get_stalls
+    stack_depth = 12  # Innermost frames kept per stall
+
+    def __init__(self, name, loop):
+        super().__init__(name, "LoopMonitor")
+        self.loop = loop
+        self.loop_thread = None  # Ident of the thread running the loop
+        self.lag = Histogram(LAG_BUCKETS)
+        self.last_lag = 0.0
+        self.next_tick = None  # Loop time the next lag timer is due at
+        self.stall = None  # The stall in progress, filled in by the watchdog
+        self.stalls = collections.deque(maxlen=self.max_stalls)
+        self.slow_callbacks = 0
+        self.last_publish = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.loop.call_soon(self.tick, None)
+        threading.Thread(target=self.watch, name=f"LoopMonitor.watch({self.object_name})", daemon=True).start()
+
+    def tick(self, scheduled):
+        # Runs on the loop, loop.time() is the monotonic clock the loop schedules with
+        now = self.loop.time()
+        self.loop_thread = threading.get_ident()
+        if scheduled is not None:
+            self.last_lag = max(now - scheduled, 0.0)
+            self.lag.observe(self.last_lag)
+        with self.lock:
+            stall, self.stall = self.stall, None
+            self.next_tick = now + self.interval
+        if stall is None and self.last_lag >= self.threshold:
+            stall = {"started": scheduled, "detected_after": None, "stack": []}  # Ended between watchdog checks
+        if stall is not None:
+            self.stall_ended(stall, self.last_lag)
+        if now - self.last_publish >= self.publish_interval:
+            self.last_publish = now
+            self.publish()
+        self.loop.call_at(self.next_tick, self.tick, self.next_tick)
+
+    def watch(self):
+        # Runs on its own thread, a blocked loop can't notice that it is blocked
+        while not self.loop.is_closed():
+            clock.sleep(self.threshold / 2)
+            with self.lock:
+                if self.next_tick is None or self.stall is not None:
+                    continue
+                overdue = self.loop.time() - self.next_tick
+                if overdue < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = traceback.format_stack(frame)[-self.stack_depth:] if frame is not None else []
+                del frame
+                self.stall = {"started": self.next_tick, "detected_after": round(overdue, 3), "stack": stack}
+
+    def stall_ended(self, stall, lag):
+        self.slow_callbacks += 1
+        where = stall["stack"][-1].strip().splitlines()[0] if stall["stack"] else "unknown"
+        logging.warning(f"LoopMonitor ({self.object_name}): Event loop blocked for {lag * 1000:.0f}ms at {where}")
+        self.stalls.append({
+            "time": clock.time(),
+            "duration": round(lag, 3),
+            "detected_after": stall["detected_after"],
+            "stack": [line.rstrip() for line in stall["stack"]],
+        })
+        self.publish()
+
+    def publish(self):
+        super().set_value("lag", round(self.last_lag, 4), block_event=True)
+        super().set_value("lag_histogram", self.lag.snapshot(), block_event=True)
+        super().set_value("slow_callbacks", self.slow_callbacks, block_event=True)
+
+    def get_stalls(self):
+        """:return: The recent stalls, oldest first, each with its duration and the loop thread's stack"""
+        return {
+            "slow_callbacks": self.slow_callbacks,
+            "threshold": self.threshold,
+            "stalls": list(self.stalls),
+        }
+
+    def get_state(self):
+        return {
+            "lag": self.last_lag,
+            "slow_callbacks": self.slow_callbacks
+        }
+
+    def get_health(self):
+        return {
+            "online": True,
+            "fault": False,
+            "reason": ""
+        }
+
+    def get_type(self):
+        return "LoopMonitor"
@@ -0,0 +1,157 @@
+import math
+import threading
+
+from Modules.RoomObject import RoomObject
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+VALUES = "satellite_value"  # Numeric RoomObject values, dict values are flattened into a field label
+HISTOGRAMS = "satellite_value_histogram"  # RoomObject values that are Histogram snapshots
+HEALTH_ONLINE = "satellite_health_online"
+HEALTH_FAULT = "satellite_health_fault"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def labels(**label_values):
+    if not label_values:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in label_values.items()) + "}"
+
+
+def number(value):
+    """:return: The value as an OpenMetrics number, None if it isn't one"""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return None
+
+
+def is_histogram(value):
+    return isinstance(value, dict) and {"buckets", "counts", "count", "sum"} <= value.keys()
+
+
+def render_histogram(name, snapshot, **label_values):
+    """Render a Histogram.snapshot(), whose counts are per bucket, as cumulative OpenMetrics buckets"""
+    lines = []
+    total = 0
+    for bound, count in zip(snapshot["buckets"], snapshot["counts"]):
+        total += count
+        lines.append(f"{name}_bucket{labels(**label_values, le=bound)} {total}\n")
+    lines.append(f"{name}_count{labels(**label_values)} {snapshot['count']}\n")
+    lines.append(f"{name}_sum{labels(**label_values)} {number(snapshot['sum'])}\n")
+    return "".join(lines)
+
+
+def flatten(value, field=""):
+    """:return: (field, number) pairs for every numeric leaf of a value, dict keys are joined with dots"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not is_histogram(item):
+                yield from flatten(item, f"{field}.{key}" if field else str(key))
+        return
+    rendered = number(value)
+    if rendered is not None:
+        yield field, rendered
+
+
+class MetricsRegistry:
+    """
+    Keeps the /metrics exposition rendered. Each (object, key) value is one cached fragment of its family; the
+    value hook only records which values changed, and a scrape re-renders just those before joining the
+    fragments, so a scrape of an idle satellite is a join of cached strings. The computed_values an object works out
+    in get_values() never reach the hook and are re-read on every scrape. Health and the registered internal
+    metrics are read on every scrape since nothing notifies on their changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirty = {}  # (object name, key) -> value changed since the last scrape
+        self.families = {VALUES: {}, HISTOGRAMS: {}}  # Family -> {(object name, key): rendered fragment}
+        self.seen = set()  # Names of the objects whose existing values have been loaded
+        self.internals = []  # (name, type, help, function returning a number or Histogram snapshot)
+        RoomObject.add_value_hook(self.value_changed)
+
+    def value_changed(self, room_object, key, value):
+        # Called on every value change on every object, kept to a dict store
+        with self.lock:
+            self.dirty[(room_object.object_name, key)] = value
+
+    def register(self, name, metric_type, help_text, function):
+        """
+        Expose an internal metric, read on every scrape
+        :param metric_type: "gauge", "counter" (name without _total) or "histogram" (function returns a snapshot)
+        """
+        self.internals.append((name, metric_type, help_text, function))
+
+    def render_value(self, object_name, key, value):
+        for family in self.families.values():
+            family.pop((object_name, key), None)
+        if is_histogram(value):
+            self.families[HISTOGRAMS][(object_name, key)] = render_histogram(HISTOGRAMS, value, object=object_name,
+                                                                             key=key)
+            return
+        fragment = "".join(
+            f"{VALUES}{labels(object=object_name, key=key, **({'field': field} if field else {}))} {rendered}\n"
+            for field, rendered in flatten(value))
+        if isinstance(value, dict):
+            # Histograms nested in a dict value, e.g. scan_stats and its duration histogram
+            histograms = "".join(render_histogram(HISTOGRAMS, item, object=object_name, key=f"{key}.{name}")
+                                 for name, item in value.items() if is_histogram(item))
+            if histograms:
+                self.families[HISTOGRAMS][(object_name, key)] = histograms
+        if fragment:
+            self.families[VALUES][(object_name, key)] = fragment
+
+    def render(self, room_objects):
+        """:return: The exposition text for room_objects and the internal metrics"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        for room_object in room_objects:
+            if room_object.object_name not in self.seen:
+                # Values set before the registry existed (or before the object was attached) never hit the hook
+                self.seen.add(room_object.object_name)
+                for key, value in dict(room_object.get_values() or {}).items():
+                    dirty.setdefault((room_object.object_name, key), value)
+            elif room_object.computed_values:
+                values = room_object.get_values() or {}
+                for key in room_object.computed_values:
+                    dirty[(room_object.object_name, key)] = values.get(key)
+        for (object_name, key), value in dirty.items():
+            self.render_value(object_name, key, value)
+
+        parts = [f"# TYPE {VALUES} gauge\n# HELP {VALUES} Numeric RoomObject values\n",
+                 *self.families[VALUES].values(),
+                 f"# TYPE {HISTOGRAMS} histogram\n# HELP {HISTOGRAMS} RoomObject values that are histograms\n",
+                 *self.families[HISTOGRAMS].values()]
+        online = [f"# TYPE {HEALTH_ONLINE} gauge\n# HELP {HEALTH_ONLINE} 1 if the object reports online\n"]
+        fault = [f"# TYPE {HEALTH_FAULT} gauge\n# HELP {HEALTH_FAULT} 1 if the object reports a fault\n"]
+        for room_object in room_objects:
+            health = room_object.get_health()
+            if not isinstance(health, dict):
+                continue
+            object_labels = labels(object=room_object.object_name, type=room_object.object_type)
+            if "online" in health:
+                online.append(f"{HEALTH_ONLINE}{object_labels} {number(bool(health['online']))}\n")
+            if "fault" in health:
+                fault.append(f"{HEALTH_FAULT}{object_labels} {number(bool(health['fault']))}\n")
+        parts += online + fault
+
+        for name, metric_type, help_text, function in self.internals:
+            parts.append(f"# TYPE {name} {metric_type}\n# HELP {name} {help_text}\n")
+            value = function()
+            if metric_type == "histogram":
+                parts.append(render_histogram(name, value))
+            elif number(value) is not None:
+                parts.append(f"{name}{'_total' if metric_type == 'counter' else ''} {number(value)}\n")
+        parts.append("# EOF\n")
+        return "".join(parts)
@@ -0,0 +1,231 @@
+import collections
+import io
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+import traceback
+
+from loguru import logger as logging
+
+from Modules.Clock import clock
+
+
+def thread_names():
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+def fold(frame):
+    """:return: The stack of frame as a root first ;-joined string, the folded format flame graph tools read"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler across every thread: a background thread reads sys._current_frames() every interval
+    seconds and counts each thread's stack, nothing is hooked into the profiled code so the cost is one walk of
+    each stack per sample. The result is in the folded format (thread;frame;frame count) that flamegraph.pl
+    and speedscope load. A run stops by itself after max_duration seconds in case it is never stopped.
+    """
+
+    max_duration = 600
+    min_interval = 0.001  # Shorter intervals turn the sampler into a busy loop
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stacks = collections.Counter()
+        self.running = False
+        self.samples = 0
+        self.interval = None
+        self.started = None
+        self.stopped = None
+        self.generation = 0  # Lets a stale sampler thread notice it was stopped and restarted
+
+    def start(self, interval=0.01, duration=None):
+        """:raise ValueError: For an interval under min_interval or a duration that isn't positive"""
+        if not interval >= self.min_interval:  # Also rejects NaN
+            raise ValueError(f"interval must be at least {self.min_interval}s")
+        if duration is not None and not duration > 0:
+            raise ValueError("duration must be positive")
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.interval = interval
+            self.started = clock.time()
+            self.stopped = None
+            self.running = True
+            self.generation += 1
+            generation = self.generation
+        duration = min(duration or self.max_duration, self.max_duration)
+        thread = threading.Thread(target=self.sample, args=(generation, interval, clock.monotonic() + duration),
+                                  name="SamplingProfiler", daemon=True)
+        thread.start()
+        logging.info(f"SamplingProfiler: Started, sampling every {interval * 1000:.0f}ms for up to {duration}s")
+        return True
+
+    def stop(self):
+        with self.lock:
+            if self.running:
+                self.running = False
+                self.stopped = clock.time()
+                logging.info(f"SamplingProfiler: Stopped after {self.samples} samples")
+        return self.folded()
+
+    def sample(self, generation, interval, deadline):
+        own = threading.get_ident()
+        try:
+            while clock.monotonic() < deadline:
+                with self.lock:
+                    if not self.running or self.generation != generation:
+                        return
+                names = thread_names()
+                frames = sys._current_frames()
+                stacks = [f"{names.get(ident, ident)};{fold(frame)}" for ident, frame in frames.items()
+                          if ident != own]
+                del frames  # Don't keep every thread's frames alive until the next sample
+                with self.lock:
+                    self.stacks.update(stacks)
+                    self.samples += 1
+                clock.sleep(interval)
+        except Exception as e:
+            logging.error(f"SamplingProfiler: Sampler failed: {e}")
+        finally:
+            # However the sampler ends, the run is over and a new one can start
+            with self.lock:
+                if self.running and self.generation == generation:
+                    self.running = False
+                    self.stopped = clock.time()
+
+    def folded(self):
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def status(self):
+        with self.lock:
+            return {
+                "running": self.running,
+                "samples": self.samples,
+                "interval": self.interval,
+                "started": self.started,
+                "stopped": self.stopped,
+                "stacks": len(self.stacks),
+            }
+
+
+class MemoryTracer:
+    """
+    tracemalloc snapshots kept by id so two can be diffed later, e.g. one at startup and one after a day to find
+    what keeps growing. Only max_snapshots are kept, the oldest are dropped first.
+    """
+
+    max_snapshots = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = collections.OrderedDict()  # Id -> (wall time, Snapshot)
+        self.next_id = 1
+
+    def start(self, frames=10):
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(frames)
+        logging.info(f"MemoryTracer: Tracing allocations with {frames} frames")
+        return True
+
+    def stop(self):
+        # Tracing costs memory and time on every allocation, stopping also frees the traces
+        tracemalloc.stop()
+        with self.lock:
+            self.snapshots.clear()
+        logging.info("MemoryTracer: Stopped tracing allocations")
+
+    def snapshot(self):
+        """:return: The id of a new snapshot, None if tracing isn't running"""
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        with self.lock:
+            snapshot_id = self.next_id
+            self.next_id += 1
+            self.snapshots[snapshot_id] = (clock.time(), snapshot)
+            while len(self.snapshots) > self.max_snapshots:
+                self.snapshots.popitem(last=False)
+        return snapshot_id
+
+    def get(self, snapshot_id):
+        with self.lock:
+            if snapshot_id not in self.snapshots:
+                raise KeyError(f"No snapshot {snapshot_id}, have {list(self.snapshots)}")
+            return self.snapshots[snapshot_id][1]
+
+    def top(self, snapshot_id, limit=30, group_by="lineno"):
+        snapshot = self.get(snapshot_id)
+        stats = snapshot.statistics(group_by)
+        total = sum(stat.size for stat in stats)
+        lines = [f"Snapshot {snapshot_id}: {total / 1024:.1f} KiB in {len(stats)} {group_by} entries\n"]
+        lines += [f"{stat}\n" for stat in stats[:limit]]
+        return "".join(lines)
+
+    def diff(self, old_id, new_id, limit=30, group_by="lineno"):
+        """:return: The allocations that grew most between two snapshots"""
+        stats = self.get(new_id).compare_to(self.get(old_id), group_by)
+        growth = sum(stat.size_diff for stat in stats)
+        lines = [f"Snapshot {old_id} -> {new_id}: {growth / 1024:+.1f} KiB\n"]
+        lines += [f"{stat}\n" for stat in stats[:limit]]
+        return "".join(lines)
+
+    def dump(self, snapshot_id):
+        """:return: The snapshot in tracemalloc's own format, load it with tracemalloc.Snapshot.load()"""
+        snapshot = self.get(snapshot_id)
+        fd, path = tempfile.mkstemp(suffix=".snapshot")
+        os.close(fd)
+        try:
+            snapshot.dump(path)  # Only dumps to a file
+            with open(path, "rb") as file:
+                return file.read()
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def status(self):
+        with self.lock:
+            snapshots = {snapshot_id: taken for snapshot_id, (taken, _) in self.snapshots.items()}
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "tracing": tracemalloc.is_tracing(),
+            "traced": current,
+            "peak": peak,
+            "snapshots": snapshots,
+        }
+
+
+def dump_threads():
+    """:return: Every thread's name (the job @background named it after), ids and current stack as text"""
+    frames = sys._current_frames()
+    out = io.StringIO()
+    threads = sorted(threading.enumerate(), key=lambda thread: thread.name)
+    out.write(f"{len(threads)} threads at {clock.time():.3f}\n")
+    for thread in threads:
+        out.write(f"\n{thread.name} (ident {thread.ident}, native {thread.native_id}"
+                  f"{', daemon' if thread.daemon else ''})\n")
+        frame = frames.get(thread.ident)
+        if frame is not None:
+            out.write("".join(traceback.format_stack(frame)))
+    return out.getvalue()
+
+
+profiler = SamplingProfiler()
+memory_tracer = MemoryTracer()
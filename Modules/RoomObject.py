@@ -6,6 +6,9 @@ class RoomObject:
     is_promise = True
     is_sensor_only = False  # Indicates that this object is only a sensor and does not have any control capabilities
     is_satellite = False  # Indicates that this object comes from a different controller
+    computed_values = ()  # Keys get_values() works out on every read, they never go through set_value or the hooks
+
+    _value_hooks = []  # Called as hook(room_object, key, value) whenever a value on any object changes
 
     def __init__(self, device_name, device_type):
         self.object_name = device_name
@@ -52,9 +55,24 @@ class RoomObject:
         return self._values[key]
 
     def set_value(self, key, value, block_event=False):
-        if self._values.get(key, None) != value and not block_event:
+        changed = self._values.get(key, None) != value
+        if changed and not block_event:
             self.emit_event(f"on_{key}_update", value)
         self._values[key] = value
+        if changed:
+            for hook in RoomObject._value_hooks:
+                try:
+                    hook(self, key, value)
+                except Exception as e:
+                    logging.error(f"Error in value hook {hook} for {key} on {self.object_name}: {e}")
+
+    @staticmethod
+    def add_value_hook(callback):
+        """
+        Attach a callback that is called for every value change on every RoomObject, including blocked events
+        :param callback: The callback function to call with (room_object, key, value)
+        """
+        RoomObject._value_hooks.append(callback)
 
     def attach_event_callback(self, callback, event_name):
         """
@@ -72,17 +90,26 @@ class RoomObject:
         :param args: Any arguments to pass to the callback
         :param kwargs: Any keyword arguments to pass to the callback
         """
+        self.emit_local_event(event_name, *args, **kwargs)
+        if self._network_hook:
+            try:
+                self._network_hook(self, event_name, *args, **kwargs)
+            except Exception as e:
+                logging.error(f"Error in network hook for event {event_name}: {e}")
+
+    def emit_local_event(self, event_name, *args, **kwargs):
+        """
+        Emit an event to the attached callbacks only, without sending it to the network hook
+        :param event_name: The name of the event to emit
+        :param args: Any arguments to pass to the callback
+        :param kwargs: Any keyword arguments to pass to the callback
+        """
         for callback, name in self._callbacks:
             if name == event_name:
                 try:
                     callback(*args, **kwargs)
                 except Exception as e:
                     logging.error(f"Error in callback {callback} for event {event_name}: {e}")
-        if self._network_hook:
-            try:
-                self._network_hook(self, event_name, *args, **kwargs)
-            except Exception as e:
-                logging.error(f"Error in network hook for event {event_name}: {e}")
 
     def remote_event(self, event_name, *args, **kwargs):
         for name, callback in self._callbacks:
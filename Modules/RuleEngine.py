@@ -0,0 +1,287 @@
+import json
+import os
+import socket
+import threading
+
+from loguru import logger as logging
+
+from Modules.Clock import clock
+from Modules.RoomModule import RoomModule
+from Modules.RoomObject import RoomObject
+from Modules.TimerWheel import timer_wheel
+
+OPERATORS = {
+    "equals": lambda value, target: value == target,
+    "not_equals": lambda value, target: value != target,
+    "above": lambda value, target: value is not None and value > target,
+    "below": lambda value, target: value is not None and value < target,
+    "in": lambda value, target: value in target,
+    "changed": lambda value, target: True,
+}
+
+MAX_DEPTH = 8  # Rules triggering rules deeper than this are assumed to be a loop
+
+
+def matches(spec, value):
+    """
+    :param spec: Dict with one or more OPERATORS as keys (all must hold), no operator matches any change
+    """
+    for operator, target in spec.items():
+        if operator in OPERATORS and not OPERATORS[operator](value, target):
+            return False
+    return True
+
+
+class Rule:
+    """
+    A declarative automation, e.g.
+        {"name": "motion_light",
+         "trigger": {"object": "MotionDetector", "key": "triggered", "equals": true},
+         "conditions": [{"object": "BlueStalker", "key": "occupied", "equals": true}],
+         "debounce": 0.5,
+         "actions": [{"object": "Light", "event": "set_on", "args": [true]}],
+         "timeout": {"after": 300, "actions": [{"object": "Light", "event": "set_on", "args": [false]}]}}
+    The trigger must keep matching for debounce seconds before the actions run, the timeout actions run once the
+    trigger hasn't fired again for timeout.after seconds.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config["name"]
+        self.enabled = config.get("enabled", True)
+        self.trigger = config["trigger"]
+        self.conditions = config.get("conditions", [])
+        self.actions = config.get("actions", [])
+        self.debounce = config.get("debounce", 0)
+        self.timeout = config.get("timeout")
+        self.pending = None  # WheelTimer of a debounce in progress
+        self.timeout_timer = None
+        self.stats = {"evaluations": 0, "matches": 0, "fires": 0, "timeouts": 0, "errors": 0,
+                      "last_fired": None, "last_latency_ms": None}
+
+    @property
+    def source(self):
+        return self.trigger["object"], self.trigger["key"]
+
+    def cancel(self):
+        for timer in (self.pending, self.timeout_timer):
+            if timer is not None:
+                timer.cancel()
+        self.pending = self.timeout_timer = None
+
+
+class RuleEngineHost(RoomModule):
+
+    def __init__(self, room_controller):
+        super().__init__(room_controller)
+        self.engine = RuleEngine(f"rule_engine-{socket.gethostname()}", room_controller)
+        self.room_controller.attach_object(self.engine)
+
+
+class RuleEngine(RoomObject):
+    """
+    Runs automations on the satellite so reactions don't round trip through the master. Rules are indexed by their
+    trigger's (object, key) and the engine listens once to each on_<key>_update event, so a value change only
+    evaluates the rules that watch it. Rules come from Configs/Rules.json and from the master with the set_rules,
+    add_rule and remove_rule events; pushed rules are kept in Data/Rules.json to keep working through outages.
+    """
+
+    is_promise = False
+    is_sensor_only = True
+    stats_interval = 30  # Seconds between published rule stats
+
+    def __init__(self, name, room_controller, config_path="Configs/Rules.json", saved_path="Data/Rules.json"):
+        super().__init__(name, "RuleEngine")
+        self.room_controller = room_controller
+        self.saved_path = saved_path
+        self.lock = threading.RLock()
+        self.rules = {}  # type: dict[str, Rule]
+        self.triggers = {}  # type: dict[tuple[str, str], list[Rule]]  # (object, key) -> rules it triggers
+        self.subscribed = set()  # (object, key) pairs the engine is listening to
+        self.depth = threading.local()
+        self.stats = {"events": 0, "evaluations": 0, "fires": 0, "loops_blocked": 0}
+
+        configs = json.load(open(config_path)) if os.path.exists(config_path) else []
+        pushed = []
+        if os.path.exists(saved_path):
+            try:
+                pushed = json.load(open(saved_path))
+            except (OSError, ValueError) as e:
+                logging.error(f"RuleEngine: Failed to load {saved_path} - {e}")
+        self.pushed = {config["name"] for config in pushed}
+        for config in configs + pushed:
+            self.add(config)
+
+        self.attach_event_callback("set_rules", self.set_rules)
+        self.attach_event_callback("add_rule", self.add_rule)
+        self.attach_event_callback("remove_rule", self.remove_rule)
+        self.publish_stats()
+
+    def add(self, config):
+        try:
+            rule = Rule(config)
+        except KeyError as e:
+            logging.error(f"RuleEngine: Rule {config.get('name')} is missing {e}")
+            return False
+        with self.lock:
+            self.remove(rule.name)
+            self.rules[rule.name] = rule
+            self.triggers.setdefault(rule.source, []).append(rule)
+            if rule.source not in self.subscribed:
+                self.subscribed.add(rule.source)
+                object_name, key = rule.source
+                room_object = self.room_controller.get_object(object_name)
+                # One listener per (object, key), it stays when rules are removed and finds no rules in the index
+                room_object.attach_event_callback(
+                    lambda value, source=rule.source: self.on_update(source, value), f"on_{key}_update")
+        logging.info(f"RuleEngine: Loaded rule {rule.name} on {rule.source}")
+        return True
+
+    def remove(self, name):
+        with self.lock:
+            rule = self.rules.pop(name, None)
+            if rule is None:
+                return False
+            rule.cancel()
+            self.triggers[rule.source].remove(rule)
+        return True
+
+    def on_update(self, source, value):
+        # Runs on whichever thread changed the value, only the rules watching this (object, key) are looked at
+        started = clock.monotonic()
+        depth = getattr(self.depth, "value", 0)
+        if depth >= MAX_DEPTH:
+            self.stats["loops_blocked"] += 1
+            logging.error(f"RuleEngine: Rules triggering each other deeper than {MAX_DEPTH}, not evaluating {source}")
+            return
+        self.stats["events"] += 1
+        with self.lock:
+            rules = [rule for rule in self.triggers.get(source, []) if rule.enabled]
+        self.depth.value = depth + 1
+        try:
+            for rule in rules:
+                self.evaluate(rule, value, started)
+        finally:
+            self.depth.value = depth
+
+    def evaluate(self, rule, value, started):
+        self.stats["evaluations"] += 1
+        rule.stats["evaluations"] += 1
+        if not matches(rule.trigger, value):
+            if rule.pending is not None:  # The trigger didn't hold for the debounce
+                rule.pending.cancel()
+                rule.pending = None
+            return
+        rule.stats["matches"] += 1
+        if rule.debounce:
+            if rule.pending is None:
+                rule.pending = timer_wheel.schedule(rule.debounce, self.debounced, rule)
+            return
+        self.fire(rule, started)
+
+    def debounced(self, rule):
+        # Called from the timer wheel, only fire if the trigger still holds
+        rule.pending = None
+        object_name, key = rule.source
+        if matches(rule.trigger, self.room_controller.get_object(object_name).get_value(key)):
+            self.fire(rule, clock.monotonic())
+
+    def conditions_hold(self, rule):
+        for condition in rule.conditions:
+            room_object = self.room_controller.get_object(condition["object"])
+            if not matches(condition, room_object.get_value(condition["key"])):
+                return False
+        return True
+
+    def run_actions(self, rule, actions):
+        for action in actions:
+            try:
+                room_object = self.room_controller.get_object(action["object"], create_if_not_found=False)
+                if room_object is None:
+                    raise KeyError(f"Object {action['object']} not found")
+                room_object.remote_event(action["event"], *action.get("args", []), **action.get("kwargs", {}))
+            except Exception as e:
+                rule.stats["errors"] += 1
+                logging.error(f"RuleEngine: Rule {rule.name} action {action} failed: {e}")
+
+    def fire(self, rule, started):
+        if not self.conditions_hold(rule):
+            return
+        logging.info(f"RuleEngine: Rule {rule.name} fired")
+        self.run_actions(rule, rule.actions)
+        self.stats["fires"] += 1
+        rule.stats["fires"] += 1
+        rule.stats["last_fired"] = clock.time()
+        rule.stats["last_latency_ms"] = round((clock.monotonic() - started) * 1000, 3)
+        if rule.timeout:
+            # Every firing pushes the timeout back, e.g. a light stays on while motion keeps being seen
+            if rule.timeout_timer is not None:
+                rule.timeout_timer.cancel()
+            rule.timeout_timer = timer_wheel.schedule(rule.timeout["after"], self.timed_out, rule)
+
+    def timed_out(self, rule):
+        rule.timeout_timer = None
+        if rule.name not in self.rules:
+            return
+        logging.info(f"RuleEngine: Rule {rule.name} timed out")
+        rule.stats["timeouts"] += 1
+        self.run_actions(rule, rule.timeout.get("actions", []))
+
+    def save(self):
+        with self.lock:
+            pushed = [self.rules[name].config for name in self.pushed if name in self.rules]
+        try:
+            if os.path.dirname(self.saved_path):
+                os.makedirs(os.path.dirname(self.saved_path), exist_ok=True)
+            with open(f"{self.saved_path}.tmp", "w") as file:
+                json.dump(pushed, file)
+            os.replace(f"{self.saved_path}.tmp", self.saved_path)
+        except OSError as e:
+            logging.error(f"RuleEngine: Failed to save {self.saved_path} - {e}")
+
+    def set_rules(self, rules):
+        """Replace every rule pushed by the master, rules from the config file are kept"""
+        with self.lock:
+            for name in list(self.pushed):
+                self.remove(name)
+            self.pushed = {config["name"] for config in rules if self.add(config)}
+        self.save()
+        self.publish_stats(reschedule=False)
+
+    def add_rule(self, rule):
+        if self.add(rule):
+            self.pushed.add(rule["name"])
+            self.save()
+        self.publish_stats(reschedule=False)
+
+    def remove_rule(self, name):
+        if self.remove(name):
+            self.pushed.discard(name)
+            self.save()
+        self.publish_stats(reschedule=False)
+
+    def publish_stats(self, reschedule=True):
+        # Stats change on every evaluation, so they are published periodically rather than on each change
+        with self.lock:
+            rules = {name: dict(rule.stats, enabled=rule.enabled, trigger=list(rule.source))
+                     for name, rule in self.rules.items()}
+        super().set_value("rules", rules, block_event=True)
+        super().set_value("stats", dict(self.stats, rules=len(rules), triggers=len(self.subscribed)),
+                          block_event=True)
+        if reschedule:
+            timer_wheel.schedule(self.stats_interval, self.publish_stats)
+
+    def get_state(self):
+        return {
+            "rules": len(self.rules)
+        }
+
+    def get_health(self):
+        return {
+            "online": True,
+            "fault": False,
+            "reason": ""
+        }
+
+    def get_type(self):
+        return "RuleEngine"
@@ -1,13 +1,15 @@
+import asyncio
+import json
 import socket
 import time
 
+from Modules.Clock import clock
 from Modules.Decorators import background
 from Modules.RoomModule import RoomModule
 from Modules.RoomObject import RoomObject
 
 import psutil
 import os
-import subprocess
 from loguru import logger as logging
 
 
@@ -26,26 +28,224 @@ class SystemMonitor(RoomModule):
             self.room_controller.attach_object(monitor)
 
 
+class Collector:
+    """One group of metrics, sampled every interval seconds by SystemMonitorLocal"""
+
+    def __init__(self, name, interval, sample):
+        self.name = name
+        self.interval = interval
+        self.sample = sample  # Returns a {value key: value} dict
+        self.next_run = 0  # Monotonic time the collector is next due
+
+    def due(self, now):
+        return now >= self.next_run
+
+
+class UpdateChecker:
+    """
+    Works out whether the checked out branch is behind its upstream. HEAD and the refs are read straight from the
+    .git directory, so the periodic local check never forks; git only runs for a fetch every interval seconds
+    (retried after retry_interval, doubling up to interval, when it fails) and to count commits when the local
+    and remote heads differ, which is cached per pair of heads (a pair that fails to count is backed off like the
+    fetch). Both run as asyncio subprocesses that are killed after timeout seconds and never prompt for
+    credentials.
+    """
+
+    def __init__(self, on_result, repository=".", interval=3600, retry_interval=60, local_interval=60, timeout=60):
+        self.on_result = on_result  # Called with the status dict whenever it changes
+        self.repository = repository
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.local_interval = local_interval
+        self.timeout = timeout
+        self.git_dir = self.find_git_dir()
+        self.counts = {}  # (head, upstream) -> (ahead, behind)
+        self.count_failures = {}  # (head, upstream) -> (monotonic time to retry at, next backoff)
+        self.status = None
+        self.last_fetch = None
+        self.last_error = None
+        self.forks = 0
+
+    def find_git_dir(self):
+        git_dir = os.path.join(self.repository, ".git")
+        if os.path.isfile(git_dir):  # Worktrees and submodules point at the real directory
+            with open(git_dir) as file:
+                line = file.read().strip()
+            if line.startswith("gitdir:"):
+                git_dir = os.path.join(self.repository, line[len("gitdir:"):].strip())
+        return git_dir
+
+    def read_ref(self, ref):
+        """:return: The commit a ref points at, from its loose file or packed-refs, None if it doesn't exist"""
+        try:
+            with open(os.path.join(self.git_dir, ref)) as file:
+                value = file.read().strip()
+            if value.startswith("ref:"):
+                return self.read_ref(value[len("ref:"):].strip())
+            return value
+        except OSError:
+            pass
+        try:
+            with open(os.path.join(self.git_dir, "packed-refs")) as file:
+                for line in file:
+                    if line.startswith(("#", "^")):
+                        continue
+                    sha, _, name = line.strip().partition(" ")
+                    if name == ref:
+                        return sha
+        except OSError:
+            pass
+        return None
+
+    def branch(self):
+        try:
+            with open(os.path.join(self.git_dir, "HEAD")) as file:
+                head = file.read().strip()
+        except OSError:
+            return None
+        return head[len("ref: refs/heads/"):] if head.startswith("ref: refs/heads/") else None  # None if detached
+
+    async def git(self, *args):
+        """Run git with a timeout, :return: stdout as text"""
+        self.forks += 1
+        process = await asyncio.create_subprocess_exec("git", *args, cwd=self.repository,
+                                                       env=dict(os.environ, GIT_TERMINAL_PROMPT="0"),
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise TimeoutError(f"git {args[0]} timed out after {self.timeout}s")
+        if process.returncode != 0:
+            raise RuntimeError(f"git {args[0]} failed: {stderr.decode(errors='replace').strip()}")
+        return stdout.decode()
+
+    async def fetch(self, branch):
+        await self.git("fetch", "--quiet", "origin", branch)
+        self.last_fetch = clock.time()
+
+    async def count(self, head, upstream):
+        if head == upstream:
+            return 0, 0
+        pair = (head, upstream)
+        if pair not in self.counts:
+            retry_at, backoff = self.count_failures.get(pair, (0, self.retry_interval))
+            if clock.monotonic() < retry_at:
+                return None, None  # Failed for this pair before, the error is already in last_error
+            try:
+                output = await self.git("rev-list", "--left-right", "--count", f"{head}...{upstream}")
+                ahead, behind = (int(count) for count in output.split())
+            except Exception:
+                self.count_failures = {pair: (clock.monotonic() + backoff, min(backoff * 2, self.interval))}
+                raise
+            self.counts = {pair: (ahead, behind)}  # Only the current pair is ever asked for again
+            self.count_failures = {}
+        return self.counts[pair]
+
+    async def check(self):
+        """Compare HEAD with its upstream from the refs on disk, :return: The status"""
+        branch = self.branch()
+        head = self.read_ref("HEAD")
+        upstream = self.read_ref(f"refs/remotes/origin/{branch}") if branch else None
+        ahead = behind = None
+        if head and upstream:
+            ahead, behind = await self.count(head, upstream)
+        return {
+            "update_available": None if behind is None else behind > 0,
+            "branch": branch,
+            "head": head,
+            "upstream": upstream,
+            "behind": behind,
+            "ahead": ahead,
+            "last_fetch": self.last_fetch,
+            "last_error": self.last_error,
+            "forks": self.forks,
+        }
+
+    async def run(self):
+        next_fetch = 0
+        retry = self.retry_interval
+        while True:
+            branch = self.branch()
+            if branch and clock.monotonic() >= next_fetch:
+                try:
+                    await self.fetch(branch)
+                    self.last_error = None
+                    retry = self.retry_interval
+                    next_fetch = clock.monotonic() + self.interval
+                except Exception as e:  # OSError if git isn't installed
+                    logging.warning(f"UpdateChecker: Fetch failed, retrying in {retry}s - {e}")
+                    self.last_error = str(e)
+                    next_fetch = clock.monotonic() + retry
+                    retry = min(retry * 2, self.interval)
+            try:
+                status = await self.check()
+            except Exception as e:
+                logging.error(f"UpdateChecker: Error checking for updates: {e}")
+                self.last_error = str(e)
+                status = dict(self.status or {}, update_available=None, last_error=self.last_error)
+            if status != self.status:
+                self.status = status
+                self.on_result(dict(status))
+            await asyncio.sleep(self.local_interval)
+
+
 class SystemMonitorLocal(RoomObject):
+    """
+    Reports the host's resource usage. Each metric group is a Collector with its own sampling interval, so cheap
+    and fast moving metrics (CPU, network) are sampled often and slow or expensive ones (disk, temperature,
+    address) rarely. Everything sampled in a cycle is applied as one batch followed by a single
+    system_values_updated event.
+    """
 
-    def __init__(self, room_controller):
+    default_intervals = {  # Seconds between samples of each collector
+        "cpu": 5,
+        "memory": 5,
+        "network": 5,
+        "uptime": 60,
+        "temperature": 30,
+        "disk": 300,
+        "address": 300,
+    }
+    thermal_zone = "/sys/class/thermal/thermal_zone0/temp"
+
+    def __init__(self, room_controller, config_path="Configs/SystemMonitor.json"):
         # Get Hostname
         hostname = socket.gethostname()
         super().__init__(f"RemoteMonitor-{hostname}",
                          "SystemMonitor")
         self.room_controller = room_controller
+        config = json.load(open(config_path)) if os.path.exists(config_path) else {}
+        intervals = dict(self.default_intervals, **config.get("intervals", {}))
+        update_settings = config.get("updateCheck", {})
+
+        self.process = psutil.Process()  # Cached, a fresh handle each cycle costs a few syscalls and resets cpu_percent
+        self.boot_time = psutil.boot_time()
+        self.create_time = self.process.create_time()
+        self.last_network = None  # (monotonic time, {interface: (bytes sent, bytes received)})
+        self.collectors = [Collector(name, intervals[name], getattr(self, f"sample_{name}"))
+                           for name in self.default_intervals if intervals.get(name)]
+
         self.set_value("name", "Master Controller")
         self.set_value("cpu_usage", 0)
         self.set_value("memory_usage", 0)
         self.set_value("disk_usage", 0)
         self.set_value("network_usage", 0)
         self.set_value("address", None)
-        self.last_network_usage = 0
         self.set_value("temperature", 0)
         self.set_value("update_available", None)
-        self.set_value("uptime_system", round(time.time() - psutil.boot_time()))
-        self.set_value("uptime_controller", round(time.time() - psutil.Process().create_time()))
+        self.apply_values(self.sample_uptime())
         self.latest = None
+        self.update_checker = None
+        self.update_task = None  # Kept so the running checker isn't garbage collected
+        if update_settings.get("enabled", True):
+            self.update_checker = UpdateChecker(self.update_checked, update_settings.get("repository", "."),
+                                                update_settings.get("interval", 3600),
+                                                update_settings.get("retryInterval", 60),
+                                                update_settings.get("localInterval", 60),
+                                                update_settings.get("timeout", 60))
         self.check_version()
         self.start_monitoring()
         self.attach_event_callback("reboot", self.reboot)
@@ -81,65 +281,111 @@ class SystemMonitorLocal(RoomObject):
             s.close()
         return IP
 
-    @background
+    def sample_cpu(self):
+        with self.process.oneshot():
+            return {
+                "cpu_usage": psutil.cpu_percent(),  # Since the previous call, never blocks
+                "controller_cpu_usage": self.process.cpu_percent(),
+                "controller_threads": self.process.num_threads(),
+            }
+
+    def sample_memory(self):
+        return {
+            "memory_usage": psutil.virtual_memory().percent,
+            "controller_memory": self.process.memory_info().rss,
+        }
+
+    def sample_network(self):
+        """Bytes per second sent and received by each interface since the previous sample"""
+        now = clock.monotonic()
+        counters = {name: (counter.bytes_sent, counter.bytes_recv)
+                    for name, counter in psutil.net_io_counters(pernic=True).items() if name != "lo"}
+        previous, self.last_network = self.last_network, (now, counters)
+        if previous is None or now <= previous[0]:
+            return {}
+        elapsed = now - previous[0]
+        rates = {}
+        for name, (sent, received) in counters.items():
+            if name not in previous[1]:
+                continue  # Appeared since the last sample
+            last_sent, last_received = previous[1][name]
+            # Counters restart from 0 when an interface is re-created, skip that sample rather than go negative
+            rates[name] = {"sent": round(max(sent - last_sent, 0) / elapsed),
+                           "received": round(max(received - last_received, 0) / elapsed)}
+        return {
+            "network_usage": sum(rate["sent"] for rate in rates.values()),  # Bytes/s sent on all interfaces
+            "network_received": sum(rate["received"] for rate in rates.values()),
+            "network_interfaces": rates,
+        }
+
+    def sample_temperature(self):
+        # The sysfs thermal zone is one small read, sensors_temperatures() walks every hwmon device
+        try:
+            with open(self.thermal_zone) as file:
+                return {"temperature": round(int(file.read()) / 1000)}
+        except (OSError, ValueError):
+            pass
+        cpu_temp = None
+        if hasattr(psutil, "sensors_temperatures"):
+            sys_temp = psutil.sensors_temperatures()
+            if "cpu_thermal" in sys_temp:
+                cpu_temp = round(sys_temp["cpu_thermal"][0].current)
+            elif "coretemp" in sys_temp:
+                cpu_temp = round(sys_temp["coretemp"][0].current)
+        return {"temperature": cpu_temp}
+
+    def sample_disk(self):
+        return {"disk_usage": psutil.disk_usage('/').percent}
+
+    def sample_address(self):
+        return {"address": self.get_ip()}
+
+    def sample_uptime(self):
+        now = time.time()
+        return {
+            "uptime_system": round(now - self.boot_time),
+            "uptime_controller": round(now - self.create_time),
+        }
+
+    def apply_values(self, values):
+        """Set a batch of sampled values, :return: True if any of them changed"""
+        changed = False
+        for key, value in values.items():
+            changed |= self.get_value(key) != value
+            self.set_value(key, value, block_event=True)
+        return changed
+
     def check_version(self):
-        while True:
-            # Check if the current version is the latest (use git to check if the current commit is the latest)
-            try:
-                # Get the branch we are on
-                result = subprocess.run(["git", "branch", "--show-current"], capture_output=True)
-                branch = str(result.stdout).strip().strip("b'").strip("\\n")
-                # Fetch the latest commits
-                subprocess.run(["git", "fetch", "origin", branch])
-                # Check if we are behind the latest commit
-                result = subprocess.run(["git", "rev-list", "--count", f"HEAD..origin/{branch}"], capture_output=True)
-                if str(result.stdout) == b'0\n':
-                    self.latest = False
-                self.latest = True
-            except Exception as e:
-                logging.error(f"Error checking for updates: {e}")
-                self.latest = None
-            finally:
-                time.sleep(60)
-            self.set_value("update_available", self.latest)
+        if self.update_checker is None:
+            return
+        try:
+            self.update_task = asyncio.get_running_loop().create_task(self.update_checker.run())
+        except RuntimeError:  # No event loop in this thread, give the checker one of its own
+            self.update_task = background(asyncio.run)(self.update_checker.run())
+
+    def update_checked(self, status):
+        self.latest = status["update_available"]
+        self.set_value("update_available", self.latest)
+        self.set_value("update_status", status, block_event=True)
 
     @background
     def start_monitoring(self):
         while True:
-            try:
-                cpu_usage = psutil.cpu_percent()
-                memory_usage = psutil.virtual_memory().percent
-                disk_usage = psutil.disk_usage('/').percent
-                if hasattr(psutil, "sensors_temperatures"):
-                    sys_temp = psutil.sensors_temperatures()
-                    # logging.info(sys_temp)
-                    if "cpu_thermal" in sys_temp:
-                        cpu_temp = round(sys_temp["cpu_thermal"][0].current)
-                    elif "coretemp" in sys_temp:
-                        cpu_temp = round(sys_temp["coretemp"][0].current)
-                    else:
-                        cpu_temp = None
-                else:
-                    cpu_temp = None
-                network_usage = psutil.net_io_counters().bytes_sent - self.last_network_usage
-                self.last_network_usage = psutil.net_io_counters().bytes_sent
-
-                self.set_value("cpu_usage", cpu_usage, block_event=True)
-                self.set_value("memory_usage", memory_usage, block_event=True)
-                self.set_value("disk_usage", disk_usage, block_event=True)
-                self.set_value("network_usage", network_usage, block_event=True)
-                self.set_value("temperature", cpu_temp, block_event=True)
-                self.set_value("uptime_system", round(time.time() - psutil.boot_time()), block_event=True)
-                self.set_value("uptime_controller", round(time.time() - psutil.Process().create_time()),
-                               block_event=True)
-                self.set_value("address", self.get_ip(), block_event=True)
+            now = clock.monotonic()
+            values = {}
+            for collector in self.collectors:
+                if not collector.due(now):
+                    continue
+                collector.next_run = now + collector.interval
+                try:
+                    values.update(collector.sample())
+                except Exception as e:
+                    logging.error(f"SystemMonitor: {collector.name} collector failed: {e}")
+                    logging.exception(e)
+            if self.apply_values(values):
                 self.emit_event("system_values_updated")
-
-            except Exception as e:
-                logging.error(f"Error: {e}")
-                logging.exception(e)
-            finally:
-                time.sleep(5)
+            clock.sleep(max(min(collector.next_run for collector in self.collectors) - clock.monotonic(), 0.1)
+                        if self.collectors else 60)
 
     def reboot(self):
         os.system("sudo reboot now")
@@ -149,7 +395,7 @@ class SystemMonitorLocal(RoomObject):
 
     def update_system(self):
         os.system("git pull")
-        time.sleep(5)
+        clock.sleep(5)
         exit(-1)
 
     def restart(self):
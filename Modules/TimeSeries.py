@@ -0,0 +1,234 @@
+import collections
+import json
+import os
+import sqlite3
+import threading
+
+from loguru import logger as logging
+
+from Modules.Clock import clock
+from Modules.Decorators import background
+from Modules.RoomModule import RoomModule
+from Modules.RoomObject import RoomObject
+
+ROLLUPS = {"1m": 60, "1h": 3600}  # Rollup table suffix -> bucket width in seconds
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS raw (ts REAL NOT NULL, object TEXT NOT NULL, key TEXT NOT NULL, "
+    "value REAL, text TEXT)",
+    "CREATE INDEX IF NOT EXISTS raw_series ON raw (object, key, ts)",
+    "CREATE INDEX IF NOT EXISTS raw_ts ON raw (ts)",
+] + [
+    f"CREATE TABLE IF NOT EXISTS rollup_{name} (object TEXT NOT NULL, key TEXT NOT NULL, bucket INTEGER NOT NULL, "
+    f"count INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL, last REAL NOT NULL, "
+    f"PRIMARY KEY (object, key, bucket)) WITHOUT ROWID" for name in ROLLUPS
+]
+
+INSERT_RAW = "INSERT INTO raw (ts, object, key, value, text) VALUES (?, ?, ?, ?, ?)"
+UPSERT_ROLLUP = ("INSERT INTO rollup_{name} (object, key, bucket, count, sum, min, max, last) "
+                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (object, key, bucket) DO UPDATE SET "
+                 "count = count + excluded.count, sum = sum + excluded.sum, min = min(min, excluded.min), "
+                 "max = max(max, excluded.max), last = excluded.last")
+
+
+def to_columns(value):
+    # Split a value into its (numeric, text) columns, numbers and bools are the only values that get rolled up
+    if isinstance(value, bool):
+        return float(value), None
+    if isinstance(value, (int, float)):
+        return float(value), None
+    if value is None:
+        return None, None
+    return None, json.dumps(value, default=str)
+
+
+def is_scalar(value, max_text):
+    # Numbers, bools, None and short strings, the values worth a row on every change
+    if value is None or isinstance(value, (bool, int, float)):
+        return True
+    return isinstance(value, str) and len(value) <= max_text
+
+
+class TimeSeriesHost(RoomModule):
+
+    def __init__(self, room_controller):
+        super().__init__(room_controller)
+        config = {}
+        if os.path.exists("Configs/TimeSeries.json"):
+            config = json.load(open("Configs/TimeSeries.json"))
+        self.store = TimeSeriesStore(config.get("path", "Data/TimeSeries.db"),
+                                     config.get("flushInterval", 30),
+                                     config.get("maxBatch", 500),
+                                     config.get("retention"),
+                                     config.get("structuredKeys"),
+                                     config.get("maxTextLength", 64),
+                                     config.get("maxPending", 50000))
+        RoomObject.add_value_hook(self.store.record)
+        self.store.run()
+
+    def query(self, object_name, key, start=None, end=None, resolution="raw", limit=None):
+        return self.store.query(object_name, key, start, end, resolution, limit)
+
+
+class TimeSeriesStore:
+    """
+    Keeps every RoomObject value change in an SQLite database in WAL mode. Samples are queued in memory and
+    written by one background writer, one transaction per flush, which also folds them into the 1 minute and
+    1 hour rollups and applies the retention policy, so the SD card is written every flush_interval rather than
+    on every sample. At most max_pending samples wait in memory, when the database can't be written the writes are
+    retried with a backoff and the oldest samples are dropped once the queue is full. Only scalars are kept by default, lists, dicts and long strings (stall stacks, histograms,
+    diagnostics) change often and are large, they are stored only for the keys listed in structured_keys.
+    """
+
+    default_retention = {"raw": 2 * 86400, "1m": 30 * 86400, "1h": 365 * 86400}  # Seconds to keep each table
+    prune_interval = 3600
+    max_retry_interval = 600  # Longest wait between writes while the database keeps failing
+
+    def __init__(self, path, flush_interval=30, max_batch=500, retention=None, structured_keys=None, max_text=64,
+                 max_pending=50000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.retention = dict(self.default_retention, **(retention or {}))
+        self.structured_keys = set(structured_keys or [])  # Value keys stored even when not scalar
+        self.max_text = max_text
+        self.pending = collections.deque(maxlen=max_pending)  # (ts, object, key, value, text) for the next flush
+        self.wake = threading.Event()
+        self.last_prune = 0
+        self.samples_written = 0
+        self.samples_dropped = 0
+        self.dropping = False  # Set while the queue is full, so the drop is only logged once
+        self.retry_interval = None  # Seconds until the next write attempt while writes fail
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = self.connect()
+        try:
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+        finally:
+            connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=10, cached_statements=32)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def record(self, room_object, key, value):
+        """Value hook, queues the change for the writer"""
+        if key not in self.structured_keys and not is_scalar(value, self.max_text):
+            return
+        numeric, text = to_columns(value)
+        if len(self.pending) == self.pending.maxlen:
+            self.drop(1)
+        self.pending.append((clock.time(), room_object.object_name, key, numeric, text))
+        if len(self.pending) >= self.max_batch:
+            self.wake.set()
+
+    def drop(self, count):
+        # The oldest samples are lost when the queue is full, the count is only approximate across threads
+        self.samples_dropped += count
+        if not self.dropping:
+            self.dropping = True
+            logging.warning(f"TimeSeriesStore: {self.pending.maxlen} samples waiting, dropping the oldest")
+
+    def flush(self):
+        """Ask the writer to flush now instead of waiting for the interval"""
+        self.wake.set()
+
+    def write_batch(self, connection, batch):
+        rollups = {name: {} for name in ROLLUPS}
+        for ts, object_name, key, numeric, _ in batch:
+            if numeric is None:
+                continue
+            for name, width in ROLLUPS.items():
+                series = (object_name, key, int(ts // width * width))
+                if series not in rollups[name]:
+                    rollups[name][series] = [0, 0.0, numeric, numeric, numeric]
+                bucket = rollups[name][series]
+                bucket[0] += 1
+                bucket[1] += numeric
+                bucket[2] = min(bucket[2], numeric)
+                bucket[3] = max(bucket[3], numeric)
+                bucket[4] = numeric
+
+        with connection:  # One transaction per flush
+            connection.executemany(INSERT_RAW, batch)
+            for name, buckets in rollups.items():
+                connection.executemany(UPSERT_ROLLUP.format(name=name),
+                                       [series + tuple(bucket) for series, bucket in buckets.items()])
+        self.samples_written += len(batch)
+
+    def prune(self, connection):
+        now = clock.time()
+        with connection:
+            connection.execute("DELETE FROM raw WHERE ts < ?", (now - self.retention["raw"],))
+            for name in ROLLUPS:
+                connection.execute(f"DELETE FROM rollup_{name} WHERE bucket < ?", (now - self.retention[name],))
+        self.last_prune = now
+
+    @background
+    def run(self):
+        logging.info(f"TimeSeriesStore: Writing to {self.path} every {self.flush_interval}s")
+        connection = self.connect()
+        while True:
+            if self.retry_interval is None:
+                clock.wait(self.wake, self.flush_interval)
+            else:
+                clock.sleep(self.retry_interval)  # A full queue keeps waking the writer, don't retry any sooner
+            self.wake.clear()
+            batch = []
+            while self.pending:
+                batch.append(self.pending.popleft())
+            try:
+                if batch:
+                    self.write_batch(connection, batch)
+                if self.dropping:
+                    logging.warning(f"TimeSeriesStore: Writing again, {self.samples_dropped} samples dropped so far")
+                self.dropping = False
+                self.retry_interval = None
+            except sqlite3.Error as e:
+                self.retry_interval = min((self.retry_interval or self.flush_interval) * 2, self.max_retry_interval)
+                logging.error(f"TimeSeriesStore: Failed to write {len(batch)} samples, retrying in "
+                              f"{self.retry_interval}s - {e}")
+                # Keep them for the next flush, ahead of the samples recorded since, as far as they fit
+                room = self.pending.maxlen - len(self.pending)
+                if len(batch) > room:
+                    self.drop(len(batch) - room)
+                    batch = batch[len(batch) - room:]
+                self.pending.extendleft(reversed(batch))
+            try:
+                if clock.time() - self.last_prune > self.prune_interval:
+                    self.prune(connection)
+            except sqlite3.Error as e:
+                logging.error(f"TimeSeriesStore: Failed to apply retention - {e}")
+
+    def query(self, object_name, key, start=None, end=None, resolution="raw", limit=None):
+        """
+        Read back a series, only samples that have been flushed are returned
+        :param resolution: "raw" for [ts, value] points or a rollup ("1m", "1h") for
+                           [bucket, count, mean, min, max, last] points
+        """
+        start = 0 if start is None else start
+        end = clock.time() if end is None else end
+        limit = -1 if limit is None else int(limit)
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            if resolution == "raw":
+                rows = connection.execute(
+                    "SELECT ts, value, text FROM raw WHERE object = ? AND key = ? AND ts >= ? AND ts <= ? "
+                    "ORDER BY ts LIMIT ?", (object_name, key, start, end, limit)).fetchall()
+                return [[ts, value if text is None else json.loads(text)] for ts, value, text in rows]
+            elif resolution in ROLLUPS:
+                rows = connection.execute(
+                    f"SELECT bucket, count, sum, min, max, last FROM rollup_{resolution} WHERE object = ? "
+                    f"AND key = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket LIMIT ?",
+                    (object_name, key, start, end, limit)).fetchall()
+                return [[bucket, count, total / count, low, high, last]
+                        for bucket, count, total, low, high, last in rows]
+            else:
+                raise ValueError(f"Unknown resolution {resolution}")
+        finally:
+            connection.close()
@@ -0,0 +1,98 @@
+import threading
+
+from loguru import logger as logging
+
+from Modules.Clock import clock
+from Modules.Decorators import background
+
+
+class WheelTimer:
+
+    def __init__(self, expire_tick, callback, args):
+        self.expire_tick = expire_tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel shared by everything that needs coarse one-shot timers (e.g. "active for more than N
+    seconds"), one thread serves every timer instead of one sleeping thread per timer. Timers fire on the first
+    tick at or after their deadline, so precision is one tick. The thread sleeps until woken while no timers are
+    pending.
+    """
+
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.epoch = clock.monotonic()
+        self.ticks = 0  # Last tick processed
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.started = False
+
+    def now_tick(self):
+        return int((clock.monotonic() - self.epoch) / self.tick)
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call callback(*args) from the wheel thread after delay seconds
+        :return: A WheelTimer that can be cancelled
+        """
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.epoch = clock.monotonic()
+                self.run()
+            expire_tick = max(int((clock.monotonic() - self.epoch + delay) / self.tick) + 1, self.ticks + 1)
+            timer = WheelTimer(expire_tick, callback, args)
+            self.slots[expire_tick % len(self.slots)].append(timer)
+            self.pending += 1
+        self.wake.set()
+        return timer
+
+    def advance(self, target):
+        # Process every tick up to target, returns the timers that expired
+        expired = []
+        with self.lock:
+            if self.pending == 0:
+                self.ticks = max(self.ticks, target)
+                return expired
+            while self.ticks < target:
+                self.ticks += 1
+                slot = self.slots[self.ticks % len(self.slots)]
+                remaining = []
+                for timer in slot:
+                    if timer.cancelled:
+                        self.pending -= 1
+                    elif timer.expire_tick <= self.ticks:
+                        self.pending -= 1
+                        expired.append(timer)
+                    else:
+                        remaining.append(timer)
+                slot[:] = remaining
+        return expired
+
+    @background
+    def run(self):
+        logging.info(f"TimerWheel: Started with {self.tick}s ticks")
+        while True:
+            self.wake.clear()
+            for timer in self.advance(self.now_tick()):
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    logging.error(f"TimerWheel: Error in timer callback {timer.callback}: {e}")
+                    logging.exception(e)
+            if self.pending == 0:
+                clock.wait(self.wake)
+            else:
+                clock.wait(self.wake, (self.ticks + 1) * self.tick - (clock.monotonic() - self.epoch))
+
+
+timer_wheel = TimerWheel()
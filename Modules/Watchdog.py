@@ -0,0 +1,84 @@
+import heapq
+import itertools
+import threading
+
+from loguru import logger as logging
+
+from Modules.Clock import clock
+from Modules.Decorators import background
+
+
+class Watchdog:
+    """
+    Keeps a heap of deadlines, one per key, and calls the key's callback the moment its deadline passes. Re-arming
+    a key replaces its deadline, superseded heap entries are skipped when they reach the top. One thread serves
+    every key and sleeps exactly until the earliest deadline.
+    """
+
+    def __init__(self):
+        self.heap = []  # (deadline, sequence, key)
+        self.deadlines = {}  # key -> (deadline, callback) of the live entry
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.started = False
+
+    def arm(self, key, timeout, callback):
+        """
+        (Re)start the countdown for key, callback() is called from the watchdog thread if it isn't re-armed or
+        disarmed within timeout seconds
+        """
+        deadline = clock.monotonic() + timeout
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.run()
+            self.deadlines[key] = (deadline, callback)
+            heapq.heappush(self.heap, (deadline, next(self.sequence), key))
+        self.wake.set()
+
+    def disarm(self, key):
+        with self.lock:
+            self.deadlines.pop(key, None)
+
+    def remaining(self, key):
+        """Seconds until key's deadline, None if it isn't armed"""
+        entry = self.deadlines.get(key)
+        if entry is None:
+            return None
+        return max(entry[0] - clock.monotonic(), 0)
+
+    def next_expired(self):
+        # Pop the next expired deadline, returns (callback or None, seconds to wait before checking again)
+        with self.lock:
+            while self.heap:
+                deadline, _, key = self.heap[0]
+                live = self.deadlines.get(key)
+                if live is None or live[0] != deadline:  # Disarmed or re-armed since this entry was pushed
+                    heapq.heappop(self.heap)
+                    continue
+                wait = deadline - clock.monotonic()
+                if wait > 0:
+                    return None, wait
+                heapq.heappop(self.heap)
+                del self.deadlines[key]
+                return live[1], 0
+            return None, None
+
+    @background
+    def run(self):
+        logging.info("Watchdog: Started")
+        while True:
+            self.wake.clear()
+            callback, wait = self.next_expired()
+            if callback is not None:
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error(f"Watchdog: Error in failsafe callback {callback}: {e}")
+                    logging.exception(e)
+                continue
+            clock.wait(self.wake, wait)
+
+
+watchdog = Watchdog()
@@ -1,7 +1,12 @@
 import datetime
-import time
+import heapq
+import json
+import socket
+import threading
 
+from Modules.Clock import clock
 from Modules.Decorators import background
+from Modules.Histogram import Histogram
 from loguru import logger as logging
 
 from Modules.RoomModule import RoomModule
@@ -13,8 +18,25 @@ class SensorHost(RoomModule):
     def __init__(self, room_controller):
         super().__init__(room_controller)
         self.sensors = []
-
-        self.sensors.append(EnvironmentSensor("enviv_sensor"))
+        self.buses = {}  # type: dict[int, I2CBusScheduler]
+        self.sensor_configs = json.load(open("Configs/Sensors.json"))
+        self.diagnostics = SensorDiagnostics(f"sensor_diagnostics-{socket.gethostname()}")
+
+        for config in self.sensor_configs:
+            if config.get("type", "AHT20") != "AHT20":
+                logging.error(f"SensorHost: Unknown sensor type {config['type']} for {config['name']}")
+                continue
+            sensor = EnvironmentSensor(config["name"], config.get("bus", 1), config.get("address", 0x38),
+                                       config.get("mux"), config.get("interval", 20), config.get("values"),
+                                       config.get("minInterval", 5), config.get("maxInterval", 120),
+                                       config.get("changeThreshold"))
+            for relay_name in config.get("linkedRelays", []):
+                relay = self.room_controller.get_object(relay_name)
+                relay.attach_event_callback(sensor.on_linked_relay_switch, "on_state_update")
+            self.sensors.append(sensor)
+            if sensor.bus not in self.buses:
+                self.buses[sensor.bus] = I2CBusScheduler(sensor.bus, self.diagnostics)
+            self.buses[sensor.bus].add_sensor(sensor)
 
         self.start_sensor_reads()
 
@@ -22,10 +44,11 @@ class SensorHost(RoomModule):
             for sensor_value in sensor.get_values():
                 logging.info(f"SensorHost: Attaching sensor value {sensor_value.get_name()}")
                 self.room_controller.attach_object(sensor_value)
+        self.room_controller.attach_object(self.diagnostics)
 
     def start_sensor_reads(self):
-        for sensor in self.sensors:
-            sensor.read_sensor()  # Background task to update the sensor values
+        for bus in self.buses.values():
+            bus.run()  # Background task that reads every sensor on the bus in turn
 
     def get_sensors(self):
         return self.sensors
@@ -38,6 +61,151 @@ class SensorHost(RoomModule):
                     return sensor_value
 
 
+class I2CBusScheduler:
+    """
+    Owns a single I2C bus and performs every sensor read on it from one thread, so transactions on the same bus
+    can never overlap. Reads are staggered across the shortest poll interval and any multiplexer channel is
+    selected right before the sensor behind it is touched, with every other multiplexer on the bus disconnected so
+    sensors sharing an address on different multiplexers (or directly on the bus) never answer together.
+    """
+
+    settle_time = 0.05  # Minimum gap between two sensors' transactions on the bus
+
+    def __init__(self, bus, diagnostics=None):
+        self.bus = bus
+        self.diagnostics = diagnostics  # type: SensorDiagnostics or None
+        self.lateness = Histogram([10, 50, 100, 250, 500, 1000, 5000])  # ms a read started after it was due
+        self.select_failures = 0
+        self.sensors = []
+        self.muxes = {}  # Multiplexers on this bus, keyed by their address
+        self.schedule = []  # Heap of (due, index, sensor), entries not matching sensor.next_read are stale
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def add_sensor(self, sensor):
+        self.sensors.append(sensor)
+        sensor.scheduler = self
+        if sensor.mux is not None and sensor.mux["address"] not in self.muxes:
+            try:
+                from Drivers.TCA9548A import TCA9548A
+                self.muxes[sensor.mux["address"]] = TCA9548A.TCA9548A(self.bus, sensor.mux["address"])
+            except ImportError as e:
+                logging.error(f"I2CBusScheduler ({self.bus}): Multiplexer could not be initialised - {e}")
+                self.muxes[sensor.mux["address"]] = None
+
+    def select(self, sensor):
+        # Route the bus to the sensor, returns False if the sensor is unreachable
+        target = self.muxes.get(sensor.mux["address"]) if sensor.mux is not None else None
+        if sensor.mux is not None and target is None:
+            return False
+        try:
+            for mux in self.muxes.values():
+                if mux is not None and mux is not target:
+                    mux.disable_all()  # Only a write when the multiplexer had a channel open
+            if target is not None:
+                target.select_channel(sensor.mux["channel"])
+        except (OSError, ValueError) as e:
+            logging.error(f"I2CBusScheduler ({self.bus}): Failed to select channel for {sensor.name} - {e}")
+            for mux in self.muxes.values():
+                if mux is not None:
+                    mux.channel = None  # Unknown after a failed write, the next select writes every multiplexer
+            self.select_failures += 1
+            return False
+        return True
+
+    def get_diagnostics(self):
+        return {
+            "sensors": len(self.sensors),
+            "select_failures": self.select_failures,
+            "read_lateness_ms": self.lateness.snapshot(),
+        }
+
+    def reschedule(self, sensor):
+        # Pull a sensor's next read forward after its interval was shortened outside of a read
+        with self.lock:
+            if sensor.next_read is None:
+                return
+            due = max(sensor.last_read + sensor.interval, clock.time())
+            if due < sensor.next_read:
+                sensor.next_read = due
+                heapq.heappush(self.schedule, (due, self.sensors.index(sensor), sensor))
+                self.wake.set()
+
+    @background
+    def run(self):
+        logging.info(f"I2CBusScheduler ({self.bus}): Starting scheduler for {len(self.sensors)} sensors")
+        for sensor in self.sensors:
+            if self.select(sensor):
+                sensor.initialise()
+            else:
+                sensor.set_fault(True, "Multiplexer unavailable")
+
+        # Spread the first reads over the shortest interval so the sensors don't all come due together
+        now = clock.time()
+        stagger = min([sensor.interval for sensor in self.sensors], default=0) / max(len(self.sensors), 1)
+        with self.lock:
+            for i, sensor in enumerate(self.sensors):
+                sensor.next_read = now + i * stagger
+                heapq.heappush(self.schedule, (sensor.next_read, i, sensor))
+
+        while True:
+            with self.lock:
+                if not self.schedule:
+                    break
+                due, i, sensor = self.schedule[0]
+                if due != sensor.next_read:  # Superseded by a reschedule
+                    heapq.heappop(self.schedule)
+                    continue
+                delay = due - clock.time()
+                if delay <= 0:
+                    heapq.heappop(self.schedule)
+            if delay > 0:
+                clock.wait(self.wake, delay)
+                self.wake.clear()
+                continue
+            self.lateness.observe(-delay * 1000)
+            if not self.select(sensor):
+                sensor.set_fault(True, "Multiplexer unavailable")
+                keep_reading = True
+            else:
+                keep_reading = sensor.read_sensor()
+            if self.diagnostics:
+                self.diagnostics.publish(f"bus_{self.bus}", self.get_diagnostics())
+                self.diagnostics.publish(sensor.name, sensor.get_diagnostics())
+            with self.lock:
+                if keep_reading:
+                    sensor.next_read = max(due + sensor.interval, clock.time() + self.settle_time)
+                    heapq.heappush(self.schedule, (sensor.next_read, i, sensor))
+                else:
+                    sensor.next_read = None
+        logging.warning(f"I2CBusScheduler ({self.bus}): No sensors left to read, stopping scheduler")
+
+
+class SensorDiagnostics(RoomObject):
+    """Performance counters of every sensor and bus on this host, one value per sensor/bus"""
+
+    object_type = "SensorDiagnostics"
+
+    def __init__(self, name):
+        super().__init__(name, "SensorDiagnostics")
+
+    def publish(self, key, diagnostics):
+        super().set_value(key, diagnostics, block_event=True)
+
+    def get_state(self):
+        return self.get_values()
+
+    def get_health(self):
+        return {
+            "online": True,
+            "fault": False,
+            "reason": ""
+        }
+
+    def get_type(self):
+        return self.object_type
+
+
 class SensorValue(RoomObject):
 
     object_type = "SensorValue"
@@ -81,6 +249,8 @@ class SensorValue(RoomObject):
 
     def set_fault(self, fault, reason="Unknown"):
         # logging.warning(f"SensorValu/e ({self.name}): Setting fault to {fault}")
+        if fault and not self._fault:
+            self.emit_local_event("on_fault", reason)  # Local consumers (e.g. a Thermostat) react immediately
         self._fault = fault
         self._reason = reason
 
@@ -143,23 +313,87 @@ def convert_cel_to_fahr(cel):
 
 class EnvironmentSensor(Sensor):
 
-    def __init__(self, name):
+    # Rate of change (units per minute) above which a value counts as changing quickly
+    default_change_threshold = {"temperature": 0.5, "humidity": 2.0}
+
+    def __init__(self, name, bus=1, address=0x38, mux=None, interval=20, value_names=None,
+                 min_interval=5, max_interval=120, change_threshold=None):
         super().__init__(name)
-        self.values["temperature"] = SensorValue("room_temp", 0, "°F", True, 5)
-        self.values["humidity"] = SensorValue("room_humid", 0, "°%", True, 5)
+        value_names = value_names or {}
+        self.bus = bus  # I2C bus number
+        self.address = address  # I2C address of the sensor
+        self.mux = mux  # None or {"address": int, "channel": int} if the sensor sits behind a multiplexer
+        self.sensor = None
+        self.scheduler = None  # type: I2CBusScheduler or None
+        self.next_read = None  # Time the scheduler will next read this sensor, None = not scheduled
+        self.last_read = 0  # Time of the last read attempt
+
+        # Adaptive polling, the interval is halved to min_interval while things change and doubles back to max
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.interval = min(max(interval, self.min_interval), self.max_interval)  # Seconds until the next read
+        self.change_threshold = dict(self.default_change_threshold, **(change_threshold or {}))
+        self.last_raw = {}  # Last raw (un-averaged) readings, used to estimate the rate of change
+        self.relay_switched = False  # Set when a linked relay switches, cleared by the next read
+        self.read_stats = {"reads": 0, "zero_reads": 0, "none_reads": 0, "read_errors": 0}
+
+        self.values["temperature"] = SensorValue(value_names.get("temperature", "room_temp"), 0, "°F", True, 5)
+        self.values["humidity"] = SensorValue(value_names.get("humidity", "room_humid"), 0, "°%", True, 5)
+        self.publish_interval()
+
+    def initialise(self):
+        # Must be called by the bus scheduler with the multiplexer channel (if any) already selected
         try:  # If the controller is not running on a Raspberry Pi, this will fail
-            logging.info(f"EnvironmentSensor ({self.name}): Initialising DHT22 sensor")
+            logging.info(f"EnvironmentSensor ({self.name}): Initialising AHT20 sensor on bus {self.bus}")
             from Drivers.AHT20 import AHT20
-            self.sensor = AHT20.AHT20()
-        except ImportError as e:
-            logging.error(f"EnvironmentSensor ({self.name}): DHT22 sensor could not be initialised - {e}")
+            self.sensor = AHT20.AHT20(self.bus, self.address)
+        except (ImportError, OSError) as e:
+            logging.error(f"EnvironmentSensor ({self.name}): AHT20 sensor could not be initialised - {e}")
             self.sensor = None
 
-        # self.read_sensor()
-
     def get_sensor_values(self):
         return self.values.values()
 
+    def get_diagnostics(self):
+        diagnostics = dict(self.read_stats, poll_interval=self.interval, fault=self._fault)
+        if self.sensor is not None:
+            diagnostics.update(self.sensor.stats.snapshot())
+        return diagnostics
+
+    def publish_interval(self):
+        for value in self.values.values():
+            value.set_value("poll_interval", self.interval, block_event=True)
+
+    def on_linked_relay_switch(self, state):
+        # A linked relay (e.g. the radiator) just switched, the readings are about to start moving
+        logging.debug(f"EnvironmentSensor ({self.name}): Linked relay switched to {state}, polling faster")
+        self.relay_switched = True
+        self.interval = self.min_interval
+        self.publish_interval()
+        if self.scheduler:
+            self.scheduler.reschedule(self)
+
+    def adapt_interval(self, readings, elapsed):
+        """
+        Pick the next poll interval from the raw readings of this read
+        :param readings: Dict of value name to raw reading
+        :param elapsed: Seconds since the previous successful read
+        """
+        changing = self.relay_switched
+        if self.last_raw and elapsed > 0:
+            for key, reading in readings.items():
+                rate = abs(reading - self.last_raw[key]) / elapsed * 60
+                if rate >= self.change_threshold.get(key, float("inf")):
+                    changing = True
+        self.last_raw = readings
+        self.relay_switched = False
+
+        if changing:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        self.publish_interval()
+
     @property
     def fault(self):
         return self._fault
@@ -175,38 +409,44 @@ class EnvironmentSensor(Sensor):
         for value in self.values.values():
             value.set_fault(set_value, reason)
 
-    @background
     def read_sensor(self):
-        # Read the sensor and set the value and last_updated
-        logging.info(f"EnvironmentSensor ({self.name}): Starting background update task")
-        while True:
-            if self.sensor:
-                try:
-                    # logging.info(f"EnvironmentSensor ({self.name}): Reading sensor")
-                    humidity, temperature = self.sensor.get_humidity(), convert_cel_to_fahr(self.sensor.get_temperature())
-                    if humidity == 0 and temperature == 0:
-                        logging.warning(f"EnvironmentSensor ({self.name}): Sensor returned 0")
-                        self.set_fault(True, "Sensor returned 0")
-
-                    elif humidity is None or temperature is None:
-                        logging.warning(f"EnvironmentSensor ({self.name}): Sensor returned None")
-                        self.fault = True
-                        self.set_fault(True, "Sensor returned None")
-
-                    else:
-                        self.values["temperature"].roll_average(temperature)
-                        self.values["humidity"].roll_average(round(humidity, 2))
-                        self.last_updated = datetime.datetime.now()
-                        # logging.info(f"EnvironmentSensor ({self.name}): Sensor read successful")
-                        self.fault = False
-                except RuntimeError as error:
-                    self.set_fault(True, error.__str__())
-                    logging.error(f"EnvironmentSensor ({self.name}): DHT22 sensor read failed - {error}")
-                    print(error.args[0])
+        """
+        Read the sensor once and set the values and last_updated, called by the bus scheduler
+        :return: False if the sensor can't be read and should no longer be scheduled
+        """
+        if not self.sensor:
+            self.set_fault(True, "Initialisation failed")
+            logging.error(f"EnvironmentSensor ({self.name}): AHT20 sensor read failed "
+                          f"- AHT20 sensor not initialised")
+            return False  # If the sensor is not initialised, stop trying to read it
+        from Drivers.AHT20.AHT20 import AHT20ZeroFrame  # Already imported by initialise
+        self.last_read = clock.time()
+        self.read_stats["reads"] += 1
+        try:
+            humidity, temperature = self.sensor.get_humidity_temperature()
+            if humidity is None or temperature is None:
+                logging.warning(f"EnvironmentSensor ({self.name}): Sensor returned None")
+                self.read_stats["none_reads"] += 1
+                self.set_fault(True, "Sensor returned None")
+
             else:
-                self.set_fault(True, "Initialisation failed")
-                logging.error(f"EnvironmentSensor ({self.name}): DHT22 sensor read failed "
-                              f"- DHT22 sensor not initialised")
-                break  # If the sensor is not initialised, stop trying to read it
-            # Wait 5 seconds before reading again
-            time.sleep(20)
+                temperature = convert_cel_to_fahr(temperature)
+                now = datetime.datetime.fromtimestamp(clock.time())
+                elapsed = (now - self.last_updated).total_seconds() if self.last_updated else 0
+                self.values["temperature"].roll_average(temperature)
+                self.values["humidity"].roll_average(round(humidity, 2))
+                self.last_updated = now
+                self.fault = False
+                for value in self.values.values():
+                    # Emitted on every good read, current_value only emits when the averaged value changes
+                    value.emit_local_event("on_reading", value.value)
+                self.adapt_interval({"temperature": temperature, "humidity": humidity}, elapsed)
+        except AHT20ZeroFrame:
+            logging.warning(f"EnvironmentSensor ({self.name}): Sensor returned 0")
+            self.read_stats["zero_reads"] += 1
+            self.set_fault(True, "Sensor returned 0")
+        except (RuntimeError, OSError) as error:
+            self.read_stats["read_errors"] += 1
+            self.set_fault(True, error.__str__())
+            logging.error(f"EnvironmentSensor ({self.name}): AHT20 sensor read failed - {error}")
+        return True
@@ -1,18 +1,27 @@
+import array
+import bisect
+import collections
 import json
-import time
+import statistics
+import threading
 
 from loguru import logger as logging
 
+from Drivers.GPIO.Backend import EDGE_BOTH, EDGE_FALLING, EDGE_RISING, PULL_DOWN, get_backend
+from Modules.Clock import clock
 from Modules.Decorators import background
 from Modules.RoomModule import RoomModule
 from Modules.RoomObject import RoomObject
+from Modules.TimerWheel import timer_wheel
+
+gpio = get_backend()
+if gpio is None:
+    logging.warning("No GPIO backend found, GPIO will not be available")
 
 try:
-    import RPi.GPIO as GPIO
-    GPIO.setmode(GPIO.BOARD)
+    import numpy
 except ImportError:
-    GPIO = None
-    logging.warning("RPi.GPIO not found, GPIO will not be available")
+    numpy = None
 
 
 class PinWatcherHost(RoomModule):
@@ -26,17 +35,159 @@ class PinWatcherHost(RoomModule):
         for watcher in self.watcher_configs:
             self.pin_watchers.append(PinWatcher(watcher["name"], watcher["pin"], watcher["edge"],
                                                 watcher["debounce"],
-                                                watcher["normallyOpen"]))
+                                                watcher["normallyOpen"],
+                                                watcher.get("activeThresholds"),
+                                                watcher.get("mode", "state"),
+                                                watcher.get("counter"),
+                                                setup_pin=False))
+        self.setup_pins()
 
         for watcher in self.pin_watchers:
             self.room_controller.attach_object(watcher)
 
+    def setup_pins(self):
+        # Every watcher's pin in one call, the gpiod backend then makes a single line request for all of them
+        watchers = [watcher for watcher in self.pin_watchers if watcher.edge is not None]
+        pins_ready = False
+        if watchers:
+            try:
+                gpio.setup_inputs({watcher.pin: watcher.input_config() for watcher in watchers})
+                pins_ready = True
+            except Exception as e:
+                logging.error(f"PinWatcherHost: Failed to set up the pins together, trying one at a time - {e}")
+        for watcher in watchers:
+            watcher.start(pins_ready)
+
+
+class EdgeDispatcher:
+    """
+    Consumes the edges PinWatcher callbacks capture, off the GPIO backend's callback thread. A burst of edges on a
+    pin is debounced in software: once the pin has been quiet for its bouncetime the level is read once and the
+    state logic runs. One dispatcher thread serves every PinWatcher.
+    """
+
+    def __init__(self):
+        self.ready = collections.deque()  # PinWatchers with captured edges waiting to be drained
+        self.debouncing = {}  # PinWatcher -> monotonic ns its current burst settles at
+        self.wake = threading.Event()
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.run()
+
+    def notify(self, watcher):
+        # Called from GPIO callbacks, must stay cheap
+        self.ready.append(watcher)
+        self.wake.set()
+
+    @background
+    def run(self):
+        logging.info("EdgeDispatcher: Started")
+        while True:
+            self.wake.clear()
+            while self.ready:
+                watcher = self.ready.popleft()
+                settles = watcher.drain_edges()
+                if settles is not None:
+                    self.debouncing[watcher] = settles
+            now = clock.monotonic_ns()
+            for watcher, settles in list(self.debouncing.items()):
+                if settles <= now:
+                    del self.debouncing[watcher]
+                    try:
+                        watcher.settle()
+                    except Exception as e:
+                        logging.error(f"EdgeDispatcher: Error settling {watcher.name()}: {e}")
+                        logging.exception(e)
+            timeout = None
+            if self.debouncing:
+                timeout = max(min(self.debouncing.values()) - clock.monotonic_ns(), 0) / 1e9
+            clock.wait(self.wake, timeout)
+
+
+edge_dispatcher = EdgeDispatcher()
+
+
+class PulseRing:
+    """
+    Fixed size ring of edge timestamps (monotonic ns) in an int64 array. Only the GPIO callback writes to it, readers
+    take a snapshot so counting never holds up the callback
+    """
+
+    def __init__(self, capacity=16384):
+        self.capacity = capacity
+        self.buffer = array.array("q", bytes(8 * capacity))
+        self.total = 0  # Edges ever recorded, the next write goes to total % capacity
+
+    def append(self, timestamp):
+        self.buffer[self.total % self.capacity] = timestamp
+        self.total += 1
+
+    def snapshot(self):
+        """
+        :return: (total edges recorded, array of the timestamps still held oldest first, True if edges were lost)
+        """
+        total = self.total
+        if total <= self.capacity:
+            return total, self.buffer[:total], False
+        # The oldest slot may be overwritten while copying, so leave it out
+        head = total % self.capacity
+        return total, self.buffer[head + 1:] + self.buffer[:head], True
+
+
+def pulse_statistics(timestamps, now, windows, wrapped=False):
+    """
+    Count, frequency and period statistics over sliding windows ending at now
+    :param timestamps: Sorted int64 array of edge timestamps (monotonic ns)
+    :param now: Monotonic ns the windows end at
+    :param windows: Window lengths in seconds
+    :param wrapped: True if older edges were dropped from the ring, windows reaching past the oldest edge are then
+                    measured over the span that is still held
+    :return: {window: {"count", "frequency", "period_mean", "period_std", "period_min", "period_max"}}
+    """
+    results = {}
+    stamps = numpy.frombuffer(timestamps, dtype=numpy.int64) if numpy is not None else timestamps
+    for window in windows:
+        window_start = now - int(window * 1e9)
+        if numpy is not None:
+            start = int(numpy.searchsorted(stamps, window_start))
+            periods = numpy.diff(stamps[start:]) / 1e9
+            count = len(stamps) - start
+            period = (float(periods.mean()), float(periods.std()), float(periods.min()), float(periods.max())) \
+                if len(periods) else (None, None, None, None)
+        else:
+            start = bisect.bisect_left(stamps, window_start)
+            periods = [(b - a) / 1e9 for a, b in zip(stamps[start:], stamps[start + 1:])]
+            count = len(stamps) - start
+            period = (statistics.fmean(periods), statistics.pstdev(periods), min(periods), max(periods)) \
+                if periods else (None, None, None, None)
+
+        span = window
+        if wrapped and start == 0 and count > 1:
+            span = (now - int(stamps[0])) / 1e9
+        results[window] = {
+            "count": count,
+            "frequency": count / span if span > 0 else 0,
+            "period_mean": period[0],
+            "period_std": period[1],
+            "period_min": period[2],
+            "period_max": period[3],
+        }
+    return results
+
 
 class PinWatcher(RoomObject):
     is_promise = False
     is_sensor_only = True
+    computed_values = ("active_for",)
 
-    def __init__(self, name, pin, edge=None, bouncetime=200, normally_open=True):
+    def __init__(self, name, pin, edge=None, bouncetime=200, normally_open=True, active_thresholds=None,
+                 mode="state", counter=None, setup_pin=True):
+        """:param setup_pin: False if the caller sets up the pin from input_config() and then calls start()"""
         super().__init__(name, "PinWatcher")
         self.online = True
         self.fault = False
@@ -48,55 +199,170 @@ class PinWatcher(RoomObject):
         self._last_rising = 0  # Last time the device was triggered
         self._last_falling = 0  # Last time the device was triggered
 
+        self._edges = collections.deque()  # Monotonic ns timestamps of captured edges, appended by the callback
+        self._burst_start = None  # Timestamp of the first edge of the burst being debounced
+
+        # Seconds of continuous activity after which an "active_for_exceeded" event is emitted
+        self.active_thresholds = sorted(active_thresholds or [])
+        self._threshold_timers = []
+
         self.edge = None
         self.bouncetime = bouncetime
         self.normal_open = normally_open
 
-        if GPIO is None:
+        # Counter mode counts pulses (flow meters, meter LEDs, tachometers) instead of tracking on/off state
+        self.mode = mode
+        counter = counter or {}
+        self.pulses = PulseRing(counter.get("bufferSize", 16384)) if mode == "counter" else None
+        self.windows = counter.get("windows", [1, 10, 60])  # Sliding windows in seconds
+        self.publish_interval = counter.get("publishInterval", 5)  # Seconds between published pulse stats
+
+        if gpio is None:
             self.fault = True
-            self.fault_message = "RPi.GPIO not found"
-            logging.warning(f"PinWatcher ({name}): Not initializing, RPi.GPIO not found")
+            self.fault_message = "GPIO not available"
+            logging.warning(f"PinWatcher ({name}): Not initializing, GPIO not available")
+            return
+
+        if self.pulses is not None:
+            # Count the edge that means "active"
+            self.edge = EDGE_RISING if self.normal_open else EDGE_FALLING
+        else:
+            super().set_value("triggered", False)
+            super().set_value("last_active", 0)
+            self.edge = EDGE_RISING if edge else EDGE_BOTH
+        if setup_pin:
+            self.start()
+
+    def input_config(self):
+        """:return: The (pull, edge, callback) the pin is set up with"""
+        # Debouncing is done in software so that detection never has to be disarmed
+        return PULL_DOWN, self.edge, self._count_callback if self.pulses is not None else self._callback
+
+    def start(self, pin_ready=False):
+        """Set up the pin unless pin_ready, then read its first state"""
+        if self.pulses is not None:
+            self.start_counter(pin_ready)
             return
+        try:
+            if not pin_ready:
+                gpio.setup_input(self.pin, *self.input_config())
+            self.state = self.read_state()
+            edge_dispatcher.start()
+            logging.debug(f"PinWatcher ({self.name()}): Initialized")
+        except Exception as e:
+            self.fault = True
+            self.fault_message = str(e)
+            logging.warning(f"PinWatcher ({self.name()}): Error initializing: {e}")
+
+        super().set_value("triggered", self.state)
+        if self.state:
+            self._last_rising = clock.time()
+            self.start_threshold_timers()
+
+    def _callback(self, pin, timestamp_ns, rising):
+        # Runs on the backend's callback thread (or the event loop for gpiod), only keep the edge's timestamp and
+        # hand it to the dispatcher
+        self._edges.append(timestamp_ns)
+        edge_dispatcher.notify(self)
 
-        super().set_value("triggered", False)
-        super().set_value("active_for", 0)
-        super().set_value("last_active", 0)
+    def _count_callback(self, pin, timestamp_ns, rising):
+        # Called for every pulse in counter mode, with gpiod the timestamp comes from the kernel
+        self.pulses.append(timestamp_ns)
 
-        self.edge = GPIO.RISING if edge else GPIO.BOTH
+    def read_state(self):
+        return bool(gpio.read(self.pin)) if self.normal_open else not gpio.read(self.pin)
+
+    def start_counter(self, pin_ready=False):
+        # Published values are refreshed every publish_interval
         try:
-            GPIO.setup(self.pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-            self.state = GPIO.input(self.pin) if self.normal_open else not GPIO.input(self.pin)
-            GPIO.add_event_detect(self.pin, self.edge, callback=self._callback, bouncetime=self.bouncetime)
-            logging.debug(f"PinWatcher ({name}): Initialized")
+            if not pin_ready:
+                gpio.setup_input(self.pin, *self.input_config())
+            logging.debug(f"PinWatcher ({self.name()}): Initialized in counter mode")
         except Exception as e:
             self.fault = True
             self.fault_message = str(e)
-            logging.warning(f"PinWatcher ({name}): Error initializing: {e}")
+            logging.warning(f"PinWatcher ({self.name()}): Error initializing: {e}")
+            return
+        self.publish_pulses()
+
+    def publish_pulses(self):
+        total, timestamps, wrapped = self.pulses.snapshot()
+        results = pulse_statistics(timestamps, clock.monotonic_ns(), self.windows, wrapped)
+        super().set_value("pulse_count", total, block_event=True)
+        for window, result in results.items():
+            for key, value in result.items():
+                super().set_value(f"{key}_{window}s", value, block_event=True)
+        super().emit_event("pulse_stats", {"pulse_count": total, "windows": results})
+        timer_wheel.schedule(self.publish_interval, self.publish_pulses)
 
-        self.update_value()
+    def drain_edges(self):
+        """
+        Take the captured edges, called by the dispatcher
+        :return: Monotonic ns at which the burst is considered settled, None if there were no edges
+        """
+        last_edge = None
+        while self._edges:
+            last_edge = self._edges.popleft()
+            if self._burst_start is None:
+                self._burst_start = last_edge
+        if last_edge is None:
+            return None
+        return last_edge + self.bouncetime * 1_000_000
 
-    def _callback(self, pin):
-        self.state = GPIO.input(self.pin) if self.normal_open else not GPIO.input(self.pin)
+    def settle(self):
+        """Read the pin once the burst is over and apply the state change, called by the dispatcher"""
+        if self._burst_start is None:
+            return
+        # The change happened at the first edge of the burst, not when it settled
+        edge_time = clock.time() - (clock.monotonic_ns() - self._burst_start) / 1e9
+        self._burst_start = None
+        state = self.read_state()
+        if state == self.state:
+            return  # The pin bounced back to where it started
 
+        self.state = state
         if self.state:  # If the device is active
-            self._last_rising = time.time()
+            self._last_rising = edge_time
+            self.start_threshold_timers()
         else:
-            self._last_falling = time.time()
+            self._last_falling = edge_time
+            self.cancel_threshold_timers()
 
-        logging.debug(f"PinWatcher ({self.name()}): Pin {pin} changed state to {self.state}")
+        logging.debug(f"PinWatcher ({self.name()}): Pin {self.pin} changed state to {self.state}")
+        super().set_value("triggered", self.state)
+        super().set_value("last_active", self._last_rising)
         super().emit_event("state_change", self.get_state())
-        # Setup new event detect
-        GPIO.remove_event_detect(self.pin)
-        GPIO.add_event_detect(self.pin, self.edge, callback=self._callback, bouncetime=self.bouncetime)
 
-    @background
-    def update_value(self):
-        while True:
-            super().set_value("triggered", self.state)
-            super().set_value("active_for", 0 if not self.state else time.time() - self._last_rising,
-                              block_event=True)
-            super().set_value("last_active", self._last_rising)
-            time.sleep(1)
+    def start_threshold_timers(self):
+        self.cancel_threshold_timers()
+        active_for = self.active_for()
+        for threshold in self.active_thresholds:
+            self._threshold_timers.append(timer_wheel.schedule(threshold - active_for, self.threshold_reached,
+                                                               threshold, self._last_rising))
+
+    def cancel_threshold_timers(self):
+        for timer in self._threshold_timers:
+            timer.cancel()
+        self._threshold_timers = []
+
+    def threshold_reached(self, threshold, activated_at):
+        # Called from the timer wheel, ignore timers left over from an earlier activation
+        if not self.state or activated_at != self._last_rising:
+            return
+        logging.debug(f"PinWatcher ({self.name()}): Active for more than {threshold}s")
+        super().emit_event("active_for_exceeded", threshold)
+
+    def active_for(self):
+        return 0 if not self.state else clock.time() - self._last_rising
+
+    def get_values(self):
+        # active_for changes continuously so it is only worked out when the values are read
+        return dict(super().get_values(), active_for=self.active_for())
+
+    def get_value(self, key):
+        if key == "active_for":
+            return self.active_for()
+        return super().get_value(key)
 
     def name(self):
         return self._name
@@ -104,7 +370,7 @@ class PinWatcher(RoomObject):
     def get_state(self):
         return {
             "triggered": self.state,
-            "active_for": 0 if not self.state else time.time() - self._last_rising,
+            "active_for": self.active_for(),
             "last_active": self._last_rising,
         }
 
@@ -113,7 +379,8 @@ class PinWatcher(RoomObject):
             "name": self.name(),
             "pin": self.pin,
             "edge": self.edge,
-            "bouncetime": self.bouncetime
+            "bouncetime": self.bouncetime,
+            "mode": self.mode
         }
 
     def get_type(self):
@@ -1,18 +1,67 @@
 import json
-import time
+import os
+import threading
 
 from loguru import logger as logging
 
-from Modules.Decorators import background
+from Drivers.GPIO.Backend import HIGH, LOW, get_backend
+from Modules.Clock import clock
 from Modules.RoomModule import RoomModule
 from Modules.RoomObject import RoomObject
+from Modules.TimerWheel import timer_wheel
+from Modules.Watchdog import watchdog
 
-try:
-    import RPi.GPIO as GPIO
-    GPIO.setmode(GPIO.BOARD)
-except ImportError:
-    GPIO = None
-    logging.warning("RPi.GPIO not found, GPIO will not be available")
+gpio = get_backend()
+if gpio is None:
+    logging.warning("No GPIO backend found, GPIO will not be available")
+
+relay_lock = threading.RLock()  # Held while relay pins are written so group writes are never interleaved
+
+
+class CycleCounters:
+    """
+    Persistent switch cycle count per relay. Saves are coalesced and written atomically at most once per
+    save_delay seconds to spare the SD card
+    """
+
+    save_delay = 60
+
+    def __init__(self, path="Data/RelayCycles.json"):
+        self.path = path
+        self.counts = {}
+        self.save_timer = None
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                self.counts = json.load(open(self.path))
+            except (OSError, ValueError) as e:
+                logging.error(f"CycleCounters: Failed to load {self.path} - {e}")
+
+    def get(self, name):
+        return self.counts.get(name, 0)
+
+    def increment(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if self.save_timer is None:
+                self.save_timer = timer_wheel.schedule(self.save_delay, self.save)
+            return self.counts[name]
+
+    def save(self):
+        with self.lock:
+            self.save_timer = None
+            counts = dict(self.counts)
+        try:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.tmp", "w") as file:
+                json.dump(counts, file)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as e:
+            logging.error(f"CycleCounters: Failed to save {self.path} - {e}")
+
+
+cycle_counters = CycleCounters()
 
 
 class RelayHost(RoomModule):
@@ -23,19 +72,40 @@ class RelayHost(RoomModule):
         self.relays = []
         self.relay_configs = json.load(open("Configs/Relays.json"))
 
+        if gpio is not None:
+            # Every relay pin in one line request, so group writes are a single ioctl with the gpiod backend
+            gpio.setup_outputs({relay["pin"]: Relay.pin_level(relay["defaultState"], relay["normallyOpen"])
+                                for relay in self.relay_configs})
         for relay in self.relay_configs:
-            self.relays.append(Relay(relay["name"], relay["pin"], relay["normallyOpen"], relay["defaultState"]))
+            self.relays.append(Relay(relay["name"], relay["pin"], relay["normallyOpen"], relay["defaultState"],
+                                     relay.get("heartbeatTimeout", 120), relay.get("failsafeState", False),
+                                     relay.get("minDwell", 0)))
+
+        self.groups = []
+        self.group_configs = json.load(open("Configs/RelayGroups.json")) \
+            if os.path.exists("Configs/RelayGroups.json") else []
+        relays_by_name = {relay.name(): relay for relay in self.relays}
+        for group in self.group_configs:
+            members = [relays_by_name[name] for name in group["relays"] if name in relays_by_name]
+            if len(members) != len(group["relays"]):
+                logging.error(f"RelayHost: Group {group['name']} references unknown relays, skipping them")
+            self.groups.append(RelayGroup(group["name"], members, group.get("sequenceDelay", 0),
+                                          group.get("scenes")))
 
         for relay in self.relays:
             self.room_controller.attach_object(relay)
+        for group in self.groups:
+            self.room_controller.attach_object(group)
 
 
 class Relay(RoomObject):
 
     is_promise = False
+    computed_values = ("time_to_failsafe",)
     is_sensor_only = True
 
-    def __init__(self, name, pin, normally_open=True, default_state=False):
+    def __init__(self, name, pin, normally_open=True, default_state=False, heartbeat_timeout=120,
+                 failsafe_state=False, min_dwell=0):
         super().__init__(name, "Relay")
         logging.info(f"Relay ({name}): Initializing")
         self.online = True
@@ -44,45 +114,119 @@ class Relay(RoomObject):
         self.pin = pin  # Pin number
         self.relay_state = None  # None = Unknown, True = On, False = Off
         self._name = name  # Name of the device
-        self.last_heartbeat = time.time()
+        self.last_heartbeat = clock.time()
+        self.heartbeat_timeout = heartbeat_timeout  # Seconds without a heartbeat before the failsafe kicks in
+        self.failsafe_state = failsafe_state  # State the relay is put in when the master is lost
+
+        # Rate limiting, a relay stays in a state for at least min_dwell seconds, requests made during the dwell
+        # are coalesced and only the latest one is applied once it expires
+        self.min_dwell = min_dwell
+        self.last_switch = None  # Monotonic time of the last switch
+        self.pending_state = None  # Latest request waiting for the dwell to expire
+        self.pending_timer = None
 
         self.normal_open = normally_open
 
         super().set_value("on", None)
+        super().set_value("cycles", cycle_counters.get(self._name))
 
-        if GPIO is None:
+        if gpio is None:
             self.fault = True
-            self.fault_message = "RPi.GPIO not found"
-            logging.warning(f"Relay ({name}): Not initializing, RPi.GPIO not found")
+            self.fault_message = "GPIO not available"
+            logging.warning(f"Relay ({name}): Not initializing, GPIO not available")
             return
 
-        GPIO.setup(self.pin, GPIO.OUT)
+        # Start the pin at the default state's level so the relay doesn't click on during startup
+        gpio.setup_output(self.pin, self.level(default_state))
         self.set_relay_state(default_state)
         logging.info(f"Relay ({name}): Initialized with default state {default_state}")
         self.attach_event_callback("set_on", self.set_on)
         self.attach_event_callback("heartbeat", self.heartbeat)
-        self.check_heartbeat()
+        watchdog.arm(self, self.heartbeat_timeout, self.heartbeat_lost)
 
-    def set_relay_state(self, state):
+    @staticmethod
+    def pin_level(state, normally_open):
+        # Pin level that puts a relay in the given state
         if state:
-            GPIO.output(self.pin, GPIO.LOW if self.normal_open else GPIO.HIGH)
-        else:
-            GPIO.output(self.pin, GPIO.HIGH if self.normal_open else GPIO.LOW)
+            return LOW if normally_open else HIGH
+        return HIGH if normally_open else LOW
+
+    def level(self, state):
+        return self.pin_level(state, self.normal_open)
+
+    def drive(self, state):
+        # Only write the pin, callers must hold relay_lock
+        gpio.write(self.pin, self.level(state))
+
+    def dwell_remaining(self):
+        if self.last_switch is None:
+            return 0
+        return max(self.last_switch + self.min_dwell - clock.monotonic(), 0)
+
+    def accept_request(self, state, force=False):
+        """
+        Decide what to do with a requested state, callers must hold relay_lock
+        :return: True if the pin should be written now, False if the request was a no-op or has been deferred
+        """
+        if state == self.relay_state:
+            self.pending_state = None  # Latest request wins, even over one that was waiting
+            return False
+        remaining = self.dwell_remaining()
+        if remaining > 0 and not force:
+            logging.debug(f"Relay ({self.name()}): Deferring {state} for {remaining:.1f}s of dwell")
+            self.pending_state = state
+            if self.pending_timer is None:
+                self.pending_timer = timer_wheel.schedule(remaining, self.apply_pending)
+            return False
+        self.pending_state = None
+        return True
+
+    def record_switch(self, state):
+        # Bookkeeping for a state that has just been written to the pin
+        if self.relay_state is not None:
+            super().set_value("cycles", cycle_counters.increment(self.name()), block_event=True)
         self.relay_state = state
+        self.last_switch = clock.monotonic()
+
+    def apply_pending(self):
+        # Called from the timer wheel once the dwell has expired
+        with relay_lock:
+            self.pending_timer = None
+            state = self.pending_state
+        if state is not None:
+            self.set_relay_state(state)
+
+    def set_relay_state(self, state, force=False):
+        """
+        Switch the relay, requests for the current state do nothing and requests during the dwell are deferred
+        :param force: Skip the dwell (used by the failsafe)
+        """
+        with relay_lock:
+            if not self.accept_request(state, force):
+                return
+            self.drive(state)
+            self.record_switch(state)
         self.emit_event("on_state_update", state)
         logging.info(f"Relay ({self.name()}): State set to {state}")
         super().set_value("on", state)
         super().emit_event("state_change", self.get_state())
 
-    @background
-    def check_heartbeat(self):
-        while True:
-            if time.time() - self.last_heartbeat > 120:
-                logging.warning(f"Relay ({self.name()}): Heartbeat timeout")
-                self.fault = True
-                self.fault_message = "Heartbeat timeout"
-                self.set_relay_state(False)
-            time.sleep(120)
+    def commit_group_state(self, state):
+        # Record a state written by a RelayGroup, the group reports the change to the master for all its members
+        self.record_switch(state)
+        self.emit_local_event("on_state_update", state)
+        super().set_value("on", state, block_event=True)
+
+    def heartbeat_lost(self):
+        # Called by the watchdog the moment the heartbeat deadline passes
+        logging.warning(f"Relay ({self.name()}): Heartbeat timeout")
+        self.fault = True
+        self.fault_message = "Heartbeat timeout"
+        self.set_relay_state(self.failsafe_state, force=True)
+
+    def get_values(self):
+        # time_to_failsafe counts down continuously so it is only worked out when the values are read
+        return dict(super().get_values(), time_to_failsafe=watchdog.remaining(self))
 
     def get_state(self):
         return {
@@ -107,8 +251,132 @@ class Relay(RoomObject):
         self.set_relay_state(state)
 
     def heartbeat(self):
-        self.last_heartbeat = time.time()
+        self.last_heartbeat = clock.time()
+        watchdog.arm(self, self.heartbeat_timeout, self.heartbeat_lost)
         if self.fault:
             self.fault = False
             self.fault_message = ""
         logging.debug(f"Relay ({self.name()}): Heartbeat")
+
+
+class RelayGroup(RoomObject):
+    """
+    Switches several relays as one: every member pin is written back-to-back while holding relay_lock and the
+    group emits one aggregated state_change instead of each relay sending its own events. Without a sequence delay all
+    pins are set in a single backend call (one ioctl with the gpiod backend), an optional delay between member
+    writes limits inrush current instead; those writes are spaced out on the timer wheel, relay_lock is only held
+    for each write and the event follows the last one. Scenes are named {relay name: state} maps.
+    """
+
+    is_promise = False
+    is_sensor_only = True
+
+    def __init__(self, name, relays, sequence_delay=0, scenes=None):
+        super().__init__(name, "RelayGroup")
+        self.online = True
+        self.fault = False
+        self.fault_message = ""
+        self._name = name
+        self.relays = relays  # type: list[Relay]
+        self.sequence_delay = sequence_delay  # Seconds between member writes
+        self.scenes = scenes or {}  # type: dict[str, dict[str, bool]]
+        self.generation = 0  # Bumped by every apply, a sequenced apply stops once a newer one has started
+
+        super().set_value("members", [relay.name() for relay in self.relays])
+        super().set_value("scenes", list(self.scenes.keys()))
+        self.update_values()
+
+        if gpio is None:
+            self.fault = True
+            self.fault_message = "GPIO not available"
+            logging.warning(f"RelayGroup ({name}): Not initializing, GPIO not available")
+            return
+
+        self.attach_event_callback("set_on", self.set_on)
+        self.attach_event_callback("set_scene", self.set_scene)
+
+    def apply(self, states):
+        """
+        Write the given member states as one operation
+        :param states: Dict of Relay to state
+        """
+        with relay_lock:
+            self.generation += 1
+            if self.sequence_delay:
+                generation = self.generation
+            else:
+                # Members already in their state are skipped, members still dwelling defer their request
+                states = {relay: state for relay, state in states.items() if relay.accept_request(state)}
+                if states:
+                    gpio.write_many({relay.pin: relay.level(state) for relay, state in states.items()})
+                for relay, state in states.items():
+                    relay.commit_group_state(state)
+        if self.sequence_delay:
+            self.sequence(generation, list(states.items()), {})
+        else:
+            self.applied(states)
+
+    def sequence(self, generation, remaining, written):
+        # Write members until one is actually switched, the rest follow from the timer wheel after sequence_delay
+        while remaining:
+            relay, state = remaining.pop(0)
+            with relay_lock:
+                if generation != self.generation:
+                    break  # Superseded by a newer apply, report what was written so far
+                if not relay.accept_request(state):
+                    continue
+                relay.drive(state)
+                relay.commit_group_state(state)
+            written[relay] = state
+            if remaining:
+                timer_wheel.schedule(self.sequence_delay, self.sequence, generation, remaining, written)
+                return
+        self.applied(written)
+
+    def applied(self, states):
+        if not states:
+            return
+        logging.info(f"RelayGroup ({self.name()}): Set {', '.join(f'{r.name()}={s}' for r, s in states.items())}")
+        self.update_values()
+        super().emit_event("state_change", self.get_state())
+
+    def update_values(self):
+        states = [relay.relay_state for relay in self.relays]
+        super().set_value("on", all(states) if states and None not in states else None, block_event=True)
+        super().set_value("states", {relay.name(): relay.relay_state for relay in self.relays}, block_event=True)
+
+    def set_on(self, state):
+        self.apply({relay: state for relay in self.relays})
+
+    def set_scene(self, scene):
+        """
+        :param scene: Name of a configured scene or a {relay name: state} map
+        """
+        states = self.scenes.get(scene) if isinstance(scene, str) else scene
+        if states is None:
+            logging.warning(f"RelayGroup ({self.name()}): Unknown scene {scene}")
+            return
+        members = {relay.name(): relay for relay in self.relays}
+        unknown = [name for name in states if name not in members]
+        if unknown:
+            logging.warning(f"RelayGroup ({self.name()}): Scene {scene} has relays outside the group: {unknown}")
+        self.apply({members[name]: state for name, state in states.items() if name in members})
+
+    def get_state(self):
+        return {
+            "on": self.get_value("on"),
+            "states": self.get_value("states")
+        }
+
+    def name(self):
+        return self._name
+
+    def get_type(self):
+        return "RelayGroup"
+
+    def get_health(self):
+        return {
+            "online": self.online,
+            "fault": self.fault,
+            "fault_message": self.fault_message,
+        }
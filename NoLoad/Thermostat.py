@@ -0,0 +1,336 @@
+import json
+import os
+import threading
+
+from loguru import logger as logging
+
+from Modules.Clock import clock
+from Modules.RoomModule import RoomModule
+from Modules.RoomObject import RoomObject
+from Modules.TimerWheel import timer_wheel
+
+MODES = ("off", "hysteresis", "pid", "time_proportional")
+
+
+class ThermostatHost(RoomModule):
+
+    def __init__(self, room_controller):
+        super().__init__(room_controller)
+        self.thermostats = []
+        self.thermostat_configs = json.load(open("Configs/Thermostats.json")) \
+            if os.path.exists("Configs/Thermostats.json") else []
+        self.saved = ThermostatSettings()
+
+        for config in self.thermostat_configs:
+            thermostat = Thermostat(config["name"],
+                                    self.room_controller.get_object(config["sensor"]),
+                                    self.room_controller.get_object(config["relay"]),
+                                    config.get("mode", "off"),
+                                    config.get("setpoint", 68),
+                                    config.get("action", "heat"),
+                                    config.get("hysteresis", 1.0),
+                                    config.get("pid"),
+                                    config.get("proportionalBand", 4.0),
+                                    config.get("cycleTime", 600),
+                                    config.get("minOnTime", 60),
+                                    config.get("maxSensorAge", 300),
+                                    config.get("failsafeState", False),
+                                    config.get("tickInterval", 5),
+                                    self.saved)
+            self.thermostats.append(thermostat)
+
+        for thermostat in self.thermostats:
+            self.room_controller.attach_object(thermostat)
+            thermostat.start()
+
+
+class ThermostatSettings:
+    """Setpoints and modes changed over the network, kept so they survive a restart while the master is away"""
+
+    def __init__(self, path="Data/Thermostats.json"):
+        self.path = path
+        self.settings = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                self.settings = json.load(open(self.path))
+            except (OSError, ValueError) as e:
+                logging.error(f"ThermostatSettings: Failed to load {self.path} - {e}")
+
+    def get(self, name):
+        return self.settings.get(name, {})
+
+    def save(self, name, **settings):
+        with self.lock:
+            self.settings.setdefault(name, {}).update(settings)
+            try:
+                if os.path.dirname(self.path):
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(f"{self.path}.tmp", "w") as file:
+                    json.dump(self.settings, file)
+                os.replace(f"{self.path}.tmp", self.path)
+            except OSError as e:
+                logging.error(f"ThermostatSettings: Failed to save {self.path} - {e}")
+
+
+class Thermostat(RoomObject):
+    """
+    Closes the loop between a SensorValue and a Relay on the satellite itself, so heating keeps being controlled
+    through master outages and reacts to a reading within milliseconds instead of a network round trip.
+
+    Modes:
+        off                Not in control, the master switches the relay
+        hysteresis         On below setpoint - hysteresis / 2, off above setpoint + hysteresis / 2
+        time_proportional  Duty cycle proportional to the error across proportional_band, applied as slow PWM
+        pid                Duty cycle from a PID loop, applied as slow PWM
+
+    The master delegates the relay by setting a mode other than off (the default), and takes it back by sending
+    the relay a set_on, which switches the thermostat off so the master's command sticks. Only while delegated is
+    the relay's heartbeat fed so its master watchdog doesn't trip; if the sensor faults or stops reporting for
+    max_sensor_age seconds the relay is put in failsafe_state until readings return.
+    """
+
+    is_promise = False
+    is_sensor_only = True
+
+    def __init__(self, name, sensor, relay, mode="off", setpoint=68, action="heat", hysteresis=1.0,
+                 pid=None, proportional_band=4.0, cycle_time=600, min_on_time=60, max_sensor_age=300,
+                 failsafe_state=False, tick_interval=5, saved=None):
+        super().__init__(name, "Thermostat")
+        logging.info(f"Thermostat ({name}): Initializing")
+        self.online = True
+        self.fault = False
+        self.fault_message = ""
+        self._name = name
+        self.sensor = sensor  # SensorValue (or a promise of one)
+        self.relay = relay  # Relay (or a promise of one)
+        self.saved = saved
+
+        settings = saved.get(name) if saved else {}
+        self.mode = settings.get("mode", mode)
+        self.setpoint = settings.get("setpoint", setpoint)
+        self.action = action  # "heat" switches on below the setpoint, "cool" above it
+        self.hysteresis = hysteresis
+        pid = dict({"kp": 0.5, "ki": 0.001, "kd": 0.0}, **(pid or {}))
+        self.kp, self.ki, self.kd = pid["kp"], pid["ki"], pid["kd"]
+        self.proportional_band = proportional_band
+        self.cycle_time = cycle_time  # Seconds per slow PWM window
+        self.min_on_time = min_on_time  # Shorter on or off periods in a window are rounded away
+        self.max_sensor_age = max_sensor_age
+        self.failsafe_state = failsafe_state
+        self.tick_interval = tick_interval
+
+        self.lock = threading.RLock()
+        self.reading = None  # Last good reading
+        self.reading_time = None  # Monotonic time of the last good reading
+        self.integral = 0.0
+        self.previous = None  # (monotonic time, reading) the PID derivative and integral are worked out from
+        self.duty = 0.0  # Fraction of the window the relay is on for in the PWM modes
+        self.window_start = None  # Monotonic start of the current PWM window
+        self.window_on_time = 0  # Seconds the relay is on for in the current window
+        self.demand = None  # State the thermostat wants the relay in
+
+        if self.mode not in MODES:
+            logging.error(f"Thermostat ({name}): Unknown mode {self.mode}, using off")
+            self.mode = "off"
+
+        self.sensor.attach_event_callback(self.on_reading, "on_reading")
+        self.sensor.attach_event_callback(self.on_sensor_fault, "on_fault")
+        self.relay.attach_event_callback("set_on", self.master_override)
+        self.attach_event_callback("set_setpoint", self.set_setpoint)
+        self.attach_event_callback("set_mode", self.set_mode)
+        self.attach_event_callback("set_pid", self.set_pid)
+        self.update_values("waiting")
+
+    def start(self):
+        self.tick()
+
+    def error(self):
+        # Positive when the relay should be on
+        error = self.setpoint - self.reading
+        return error if self.action == "heat" else -error
+
+    def sensor_problem(self):
+        """:return: The reason the readings can't be trusted, None if they can"""
+        if self.reading_time is None:
+            return "No reading yet"
+        if self.sensor.get_fault():
+            return f"Sensor fault: {self.sensor.get_reason()}"
+        if clock.monotonic() - self.reading_time > self.max_sensor_age:
+            return f"No reading for {self.max_sensor_age}s"
+        return None
+
+    def on_reading(self, value):
+        # Called from the sensor's bus thread on every good read
+        with self.lock:
+            now = clock.monotonic()
+            self.reading = value
+            self.reading_time = now
+            if self.mode == "pid":
+                self.update_pid(now)
+            elif self.mode == "time_proportional":
+                self.duty = min(max(0.5 + self.error() / self.proportional_band, 0.0), 1.0)
+            self.control()
+
+    def on_sensor_fault(self, reason):
+        with self.lock:
+            self.control()
+
+    def update_pid(self, now):
+        error = self.error()
+        derivative = 0.0
+        if self.previous is not None:
+            elapsed = now - self.previous[0]
+            if elapsed > 0:
+                self.integral += self.ki * error * elapsed
+                # Derivative on the measurement so setpoint changes don't kick the output
+                change = (self.reading - self.previous[1]) / elapsed
+                derivative = -self.kd * (change if self.action == "heat" else -change)
+        # Clamp the integral to the output range so it can't wind up while the relay is saturated
+        self.integral = min(max(self.integral, 0.0), 1.0)
+        self.previous = (now, self.reading)
+        self.duty = min(max(self.kp * error + self.integral + derivative, 0.0), 1.0)
+
+    def pwm_state(self, now):
+        # Slow PWM, the duty is sampled at the start of each window
+        if self.window_start is None or now - self.window_start >= self.cycle_time:
+            self.window_start = now
+            self.window_on_time = self.duty * self.cycle_time
+            if self.window_on_time < self.min_on_time:
+                self.window_on_time = 0
+            elif self.cycle_time - self.window_on_time < self.min_on_time:
+                self.window_on_time = self.cycle_time
+        return now - self.window_start < self.window_on_time
+
+    def control(self):
+        """Work out the relay state and apply it, callers must hold self.lock"""
+        if self.mode == "off":
+            self.demand = None
+            self.update_values("off")
+            return
+
+        problem = self.sensor_problem()
+        if problem is not None:
+            if not self.fault:
+                logging.warning(f"Thermostat ({self.name()}): {problem}, relay to failsafe {self.failsafe_state}")
+            self.fault = True
+            self.fault_message = problem
+            self.window_start = None
+            self.apply(self.failsafe_state, "failsafe")
+            return
+        if self.fault:
+            logging.info(f"Thermostat ({self.name()}): Readings are back, resuming control")
+            self.fault = False
+            self.fault_message = ""
+
+        if self.mode == "hysteresis":
+            error = self.error()
+            if error > self.hysteresis / 2:
+                state = True
+            elif error < -self.hysteresis / 2:
+                state = False
+            else:
+                state = bool(self.demand)  # Inside the band, keep doing what we were doing
+        else:
+            state = self.pwm_state(clock.monotonic())
+        self.apply(state, "active" if state else "idle")
+
+    def apply(self, state, status):
+        changed = state != self.demand
+        self.demand = state
+        # No-op if the relay is already there and deferred during its dwell, except for the failsafe
+        self.relay.set_relay_state(state, force=status == "failsafe")
+        if status != "failsafe":
+            self.relay.heartbeat()  # We are the relay's controller while in control
+        self.update_values(status)
+        if changed:
+            super().emit_event("state_change", self.get_state())
+
+    def tick(self):
+        # Periodic staleness check and PWM window handling, readings drive the loop in between
+        try:
+            with self.lock:
+                self.control()
+        except Exception as e:
+            logging.error(f"Thermostat ({self.name()}): Error in control loop: {e}")
+            logging.exception(e)
+        timer_wheel.schedule(self.tick_interval, self.tick)
+
+    def update_values(self, status):
+        super().set_value("status", status, block_event=True)
+        super().set_value("mode", self.mode)
+        super().set_value("setpoint", self.setpoint)
+        super().set_value("demand", self.demand, block_event=True)
+        super().set_value("duty", round(self.duty, 3) if self.mode in ("pid", "time_proportional") else None,
+                          block_event=True)
+        super().set_value("reading", self.reading, block_event=True)
+
+    def set_setpoint(self, setpoint):
+        logging.info(f"Thermostat ({self.name()}): Setpoint set to {setpoint}")
+        with self.lock:
+            self.setpoint = float(setpoint)
+            if self.saved:
+                self.saved.save(self.name(), setpoint=self.setpoint)
+            if self.reading is not None and self.mode == "time_proportional":
+                self.duty = min(max(0.5 + self.error() / self.proportional_band, 0.0), 1.0)
+            self.window_start = None  # Start a fresh PWM window with the new target
+            self.control()
+
+    def set_mode(self, mode):
+        if mode not in MODES:
+            logging.warning(f"Thermostat ({self.name()}): Unknown mode {mode}")
+            return
+        logging.info(f"Thermostat ({self.name()}): Mode set to {mode}")
+        with self.lock:
+            self.mode = mode
+            self.integral = 0.0
+            self.previous = None
+            self.window_start = None
+            if self.saved:
+                self.saved.save(self.name(), mode=self.mode)
+            self.control()
+
+    def master_override(self, state):
+        # The master switched the relay itself, it has taken control back
+        if self.mode == "off":
+            return
+        logging.info(f"Thermostat ({self.name()}): Relay set to {state} by the master, handing control back")
+        self.set_mode("off")
+
+    def set_pid(self, kp=None, ki=None, kd=None):
+        with self.lock:
+            self.kp = self.kp if kp is None else float(kp)
+            self.ki = self.ki if ki is None else float(ki)
+            self.kd = self.kd if kd is None else float(kd)
+        logging.info(f"Thermostat ({self.name()}): PID set to kp={self.kp} ki={self.ki} kd={self.kd}")
+
+    def get_state(self):
+        return {
+            "mode": self.mode,
+            "setpoint": self.setpoint,
+            "demand": self.demand,
+            "reading": self.reading,
+        }
+
+    def get_info(self):
+        return {
+            "action": self.action,
+            "hysteresis": self.hysteresis,
+            "pid": {"kp": self.kp, "ki": self.ki, "kd": self.kd},
+            "proportional_band": self.proportional_band,
+            "cycle_time": self.cycle_time,
+            "max_sensor_age": self.max_sensor_age,
+        }
+
+    def name(self):
+        return self._name
+
+    def get_type(self):
+        return "Thermostat"
+
+    def get_health(self):
+        return {
+            "online": self.online,
+            "fault": self.fault,
+            "fault_message": self.fault_message,
+        }
@@ -0,0 +1,26 @@
+import sys
+import types
+
+from Modules.Clock import clock
+
+
+def install(clock_source=None):
+    """
+    Swap the GPIO backend and the hardware libraries (smbus2, bluetooth, bluepy.btle) for the in-memory fakes,
+    this must be called before any module that imports them is imported
+    :param clock_source: Optional clock source (e.g. Simulation.Clock.ScaledClock) for every module to run on
+    """
+    from Drivers.GPIO.Backend import FakeBackend, use_backend
+    from Simulation import FakeBLE, FakeBluetooth, FakeI2C
+
+    use_backend(FakeBackend())
+    bluepy = types.ModuleType("bluepy")
+    bluepy.btle = FakeBLE
+    sys.modules.update({
+        "smbus2": FakeI2C,
+        "bluetooth": FakeBluetooth,
+        "bluepy": bluepy,
+        "bluepy.btle": FakeBLE,
+    })
+    if clock_source is not None:
+        clock.set_source(clock_source)
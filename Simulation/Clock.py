@@ -0,0 +1,33 @@
+import time
+
+
+class ScaledClock:
+    """
+    Clock source that runs faster than real time, at speed=3600 a simulated hour passes every real second.
+    Install it with Modules.Clock.clock.set_source()
+    """
+
+    def __init__(self, speed=1.0, start=None):
+        self.speed = speed
+        self.start = time.time() if start is None else start  # Simulated epoch time at the anchor
+        self.anchor = time.monotonic()  # Real monotonic time the simulation started at
+
+    def elapsed(self):
+        # Simulated seconds since the clock was created
+        return (time.monotonic() - self.anchor) * self.speed
+
+    def time(self):
+        return self.start + self.elapsed()
+
+    def monotonic(self):
+        return self.elapsed()
+
+    def monotonic_ns(self):
+        return int(self.elapsed() * 1e9)
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def wait(self, event, timeout=None):
+        return event.wait(None if timeout is None else max(timeout, 0) / self.speed)
@@ -0,0 +1,92 @@
+"""
+In-memory stand-in for bluepy.btle, installed as bluepy.btle by Simulation.Backend.install().
+advertise() queues an advertisement on every started Scanner, like a radio each simulated satellite hears all of
+them, and the next Scanner.process() call hands it to the scanner's delegate.
+"""
+import collections
+import threading
+
+from Modules.Clock import clock
+
+PUBLIC_ADDRESS = "public"
+RANDOM_ADDRESS = "random"
+
+lock = threading.Lock()
+scanners = set()  # Started scanners, each with its own queue
+stats = {"adverts": 0, "deliveries": 0}
+
+
+class BTLEException(Exception):
+    pass
+
+
+class BTLEDisconnectError(BTLEException):
+    pass
+
+
+class DefaultDelegate:
+
+    def handleDiscovery(self, scanEntry, isNewDev, isNewData):
+        pass
+
+
+class ScanEntry:
+
+    def __init__(self, addr, rssi, addrType=PUBLIC_ADDRESS, data=None):
+        self.addr = addr.lower()
+        self.rssi = rssi
+        self.addrType = addrType
+        self.data = data or {}
+
+    def getScanData(self):
+        return [(tag, "", value) for tag, value in self.data.items()]
+
+
+def advertise(address, rssi=-60, addr_type=PUBLIC_ADDRESS, data=None):
+    entry = ScanEntry(address, rssi, addr_type, data)
+    with lock:
+        listening = list(scanners)
+        stats["adverts"] += 1
+        stats["deliveries"] += len(listening)
+    for scanner in listening:
+        scanner.adverts.append(entry)
+        scanner.advert_ready.set()
+
+
+class Scanner:
+
+    def __init__(self, iface=0):
+        self.iface = iface
+        self.delegate = DefaultDelegate()
+        self.seen = set()
+        self.adverts = collections.deque()
+        self.advert_ready = threading.Event()
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def start(self, passive=False):
+        with lock:
+            scanners.add(self)
+
+    def stop(self):
+        with lock:
+            scanners.discard(self)
+
+    def clear(self):
+        self.seen.clear()
+
+    def process(self, timeout=10):
+        clock.wait(self.advert_ready, timeout)
+        self.advert_ready.clear()
+        while self.adverts:
+            entry = self.adverts.popleft()
+            is_new = entry.addr not in self.seen
+            self.seen.add(entry.addr)
+            self.delegate.handleDiscovery(entry, is_new, True)
+
+    def scan(self, timeout=10, passive=False):
+        self.start(passive)
+        self.process(timeout)
+        self.stop()
@@ -0,0 +1,69 @@
+"""
+In-memory stand-in for the PyBluez bluetooth module, installed as bluetooth by Simulation.Backend.install().
+Which addresses are in range is set with set_present(), connects to absent devices burn connect_delay (or the
+socket timeout if shorter) of simulated time like a real page timeout does.
+"""
+import types
+
+from Modules.Clock import clock
+
+RFCOMM = 3
+L2CAP = 0
+
+present = {}  # type: dict[str, bool]
+connect_delay = 5.0  # Seconds a connect to an absent device blocks for
+stats = {"connects": 0, "refused": 0, "timeouts": 0}
+
+
+class BluetoothError(IOError):
+    pass
+
+
+btcommon = types.SimpleNamespace(BluetoothError=BluetoothError)
+
+
+def set_present(address, is_present):
+    present[address] = bool(is_present)
+
+
+class BluetoothSocket:
+
+    def __init__(self, protocol=RFCOMM):
+        self.protocol = protocol
+        self.address = None
+        self.timeout = None
+        self.closed = False
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0.0
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def connect(self, address):
+        stats["connects"] += 1
+        self.address = address[0]
+        if present.get(self.address):
+            # Phones in range refuse RFCOMM connections to unknown services
+            stats["refused"] += 1
+            raise BluetoothError(111, "Connection refused")
+        stats["timeouts"] += 1
+        if self.timeout is not None and self.timeout < connect_delay:
+            clock.sleep(self.timeout)
+            raise BluetoothError("timed out")
+        clock.sleep(connect_delay)
+        raise BluetoothError(112, "Host is down")
+
+    def getpeername(self):
+        if self.closed or not present.get(self.address):
+            raise BluetoothError(107, "Transport endpoint is not connected")
+        return self.address, 1
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        self.closed = True
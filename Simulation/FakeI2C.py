@@ -0,0 +1,118 @@
+"""
+In-memory stand-in for the smbus2 module, installed as smbus2 by Simulation.Backend.install().
+Devices are attached per (bus, address, mux channel) and answer the transactions the drivers in Drivers/ make.
+"""
+import threading
+
+from Drivers.AHT20.crc8_helper import AHT20_crc8_calculate
+
+lock = threading.Lock()
+devices = {}  # (bus, address, channel) -> device, channel is None for devices directly on the bus
+muxes = {}  # (bus, address) -> FakeTCA9548A
+stats = {"transactions": 0, "errors": 0, "collisions": 0}  # Collisions: several devices answered one address
+
+
+class FakeAHT20:
+
+    def __init__(self, temperature=21.0, humidity=40.0):
+        self.temperature = temperature  # °C
+        self.humidity = humidity  # %
+        self.data = None  # Raw 7 byte measurement replayed from a recorded trace, overrides the values above
+        self.calibrated = False
+
+    def write(self, register, data):
+        if data and data[0] == 0xBE:  # Initialize
+            self.calibrated = True
+        elif data and data[0] == 0xBA:  # Soft reset
+            self.calibrated = False
+
+    def read(self, register, length):
+        status = 0x18 if self.calibrated else 0x10
+        if length == 1:
+            return [status]
+        if self.data is not None:
+            return list(self.data[:length])
+        humidity = min(max(int(self.humidity / 100 * (1 << 20)), 0), (1 << 20) - 1)
+        temperature = min(max(int((self.temperature + 50) / 200 * (1 << 20)), 0), (1 << 20) - 1)
+        data = [status,
+                (humidity >> 12) & 0xFF,
+                (humidity >> 4) & 0xFF,
+                ((humidity & 0xF) << 4) | ((temperature >> 16) & 0xF),
+                (temperature >> 8) & 0xFF,
+                temperature & 0xFF]
+        data.append(AHT20_crc8_calculate(data))
+        return data[:length]
+
+
+class FakeTCA9548A:
+
+    def __init__(self):
+        self.channel = None
+
+
+def attach_device(bus, address, device, channel=None):
+    with lock:
+        devices[(bus, address, channel)] = device
+    return device
+
+
+def attach_mux(bus, address):
+    with lock:
+        return muxes.setdefault((bus, address), FakeTCA9548A())
+
+
+def get_device(bus, address, channel=None):
+    return devices.get((bus, address, channel))
+
+
+def set_reading(bus, address, channel=None, temperature=None, humidity=None, data=None):
+    """Update what a simulated AHT20 will report, attaching one if nothing is there yet"""
+    device = get_device(bus, address, channel)
+    if device is None:
+        device = attach_device(bus, address, FakeAHT20(), channel)
+    if temperature is not None:
+        device.temperature = temperature
+    if humidity is not None:
+        device.humidity = humidity
+    device.data = data
+
+
+class SMBus:
+
+    def __init__(self, bus=None):
+        self.bus = bus
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _device(self, address):
+        stats["transactions"] += 1
+        channels = [mux.channel for (bus, _), mux in muxes.items() if bus == self.bus and mux.channel is not None]
+        answering = [devices[(self.bus, address, channel)] for channel in channels + [None]
+                     if (self.bus, address, channel) in devices]
+        if len(answering) > 1:
+            stats["collisions"] += 1
+        if answering:
+            return answering[0]
+        stats["errors"] += 1
+        raise OSError(121, "Remote I/O error")
+
+    def write_byte(self, address, value):
+        mux = muxes.get((self.bus, address))
+        if mux is not None:
+            stats["transactions"] += 1
+            mux.channel = None if value == 0 else value.bit_length() - 1
+            return
+        self._device(address).write(None, [value])
+
+    def write_i2c_block_data(self, address, register, data):
+        self._device(address).write(register, data)
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._device(address).read(register, length)
@@ -0,0 +1,125 @@
+"""
+Load test the hardware modules against simulated hardware, many satellites at once on a fast clock
+    python -m Simulation.Fleet --satellites 50 --days 1 --speed 3600
+    python -m Simulation.Fleet --satellites 10 --trace trace.jsonl
+Every satellite is built from the configs in Configs/ and sees the same trace. Events that would be sent to the
+master are counted instead of sent.
+"""
+import argparse
+import json
+import threading
+import time
+
+from loguru import logger as logging
+
+from Simulation import Backend
+from Simulation.Clock import ScaledClock
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fleet of simulated satellites")
+    parser.add_argument("--satellites", type=int, default=10, help="Number of satellites to simulate")
+    parser.add_argument("--trace", default=None, help="Recorded trace to replay instead of the scripted day")
+    parser.add_argument("--days", type=float, default=1, help="Simulated days to run for")
+    parser.add_argument("--speed", type=float, default=3600, help="Simulated seconds per real second")
+    parser.add_argument("--report-interval", type=float, default=5, help="Real seconds between reports")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    import sys
+    logging.remove()
+    logging.add(sys.stderr, level=args.log_level)
+
+    clock_source = ScaledClock(args.speed)
+    Backend.install(clock_source)
+
+    # Only import the hardware modules once the fakes are in place
+    from main import SatelliteController
+    from Modules.BluetoothOccupancy import BluetoothDetector
+    from NoLoad.EnvironmentSensor import SensorHost
+    from NoLoad.PinWatcher import PinWatcherHost
+    from NoLoad.Relay import RelayHost
+    from Drivers.GPIO.Backend import get_backend
+    from Simulation import FakeBLE, FakeBluetooth, FakeI2C
+    from Simulation.Scenarios import occupied_day
+    from Simulation.Trace import TracePlayer, load_trace
+
+    class SimulatedSatellite(SatelliteController):
+        """A satellite that only runs the hardware hosts, with its uplink events counted instead of sent"""
+
+        def __init__(self, name, hosts):
+            self.name = name
+            self.auth = None
+            self.controllers = []
+            self.room_objects = []
+            self.events = 0
+            for host in hosts:
+                try:
+                    host(self)
+                except Exception as e:
+                    logging.error(f"SimulatedSatellite ({name}): Error creating {host.__name__}: {e}")
+            for room_object in self.room_objects:
+                room_object.network_event_hook(self.count_event)
+
+        def count_event(self, room_object, event_name, *args, **kwargs):
+            self.events += 1
+
+    sensor_configs = json.load(open("Configs/Sensors.json"))
+    for config in sensor_configs:
+        channel = None
+        if config.get("mux"):
+            FakeI2C.attach_mux(config.get("bus", 1), config["mux"]["address"])
+            channel = config["mux"]["channel"]
+        FakeI2C.attach_device(config.get("bus", 1), config.get("address", 0x38), FakeI2C.FakeAHT20(), channel)
+
+    class InProcessBluetoothDetector(BluetoothDetector):
+        # The fakes only exist in this process, so the scan engine can't run in a worker here
+        def __init__(self, room_controller):
+            super().__init__(room_controller, isolated=False)
+
+    hosts = [RelayHost, PinWatcherHost, SensorHost, InProcessBluetoothDetector]
+    satellites = [SimulatedSatellite(f"sim-{i}", hosts) for i in range(args.satellites)]
+    logging.warning(f"Fleet: Started {len(satellites)} satellites, {threading.active_count()} threads")
+
+    if args.trace:
+        events = load_trace(args.trace)
+    else:
+        stalker = satellites[0].get_object("BlueStalker2", create_if_not_found=False)
+        watchers = json.load(open("Configs/PinWatchers.json"))
+        sensor = sensor_configs[0]
+        events = occupied_day(days=max(int(args.days + 0.999), 1),
+                              motion_pin=watchers[0]["pin"] if watchers else 11,
+                              sensor=(sensor.get("bus", 1), sensor.get("address", 0x38),
+                                      sensor["mux"]["channel"] if sensor.get("mux") else None),
+                              targets=list(json.load(open("Configs/BlueStalker.json")).keys()),
+                              heartbeat=stalker.heartbeat_device if stalker else None)
+    player = TracePlayer(events, satellites, loop=True)
+    player.play()
+
+    duration = args.days * 86400
+    real_start = time.monotonic()
+    while clock_source.elapsed() < duration:
+        time.sleep(min(args.report_interval, (duration - clock_source.elapsed()) / args.speed))
+        logging.warning(f"Fleet: t={clock_source.elapsed() / 3600:.1f}h "
+                        f"events={sum(satellite.events for satellite in satellites)} "
+                        f"trace={player.played} threads={threading.active_count()} "
+                        f"gpio={get_backend().stats} i2c={FakeI2C.stats} bt={FakeBluetooth.stats} ble={FakeBLE.stats}")
+
+    elapsed = time.monotonic() - real_start
+    total_events = sum(satellite.events for satellite in satellites)
+    print(json.dumps({
+        "satellites": len(satellites),
+        "simulated_seconds": round(clock_source.elapsed()),
+        "real_seconds": round(elapsed, 2),
+        "uplink_events": total_events,
+        "uplink_events_per_satellite_day": round(total_events / len(satellites) / max(args.days, 1e-9), 1),
+        "threads": threading.active_count(),
+        "gpio": get_backend().stats,
+        "i2c": FakeI2C.stats,
+        "bluetooth": FakeBluetooth.stats,
+        "ble": FakeBLE.stats,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Record a hardware trace from a live satellite for replay in the simulator
+    python -m Simulation.Record --out trace.jsonl --duration 86400
+Pins come from Configs/PinWatchers.json, sensors from Configs/Sensors.json and Bluetooth targets from
+Configs/BlueStalker.json. Stop the satellite first, the recorder needs the pins, bus and radio to itself.
+"""
+import argparse
+import json
+import os
+import time
+
+from loguru import logger as logging
+
+from Simulation.Trace import TraceWriter
+
+
+def record_gpio(writer, configs):
+    from Drivers.GPIO.Backend import EDGE_BOTH, PULL_DOWN, get_backend
+    gpio = get_backend()
+
+    def callback(pin, timestamp_ns, rising):
+        # Edge timestamps are monotonic, traces are stamped with wall time
+        offset = time.monotonic_ns() - timestamp_ns
+        writer.write("gpio", time.time() - offset / 1e9, pin=pin, level=int(rising))
+
+    for config in configs:
+        gpio.setup_input(config["pin"], PULL_DOWN, EDGE_BOTH, callback)
+        writer.write("gpio", time.time(), pin=config["pin"], level=gpio.read(config["pin"]))
+
+
+def open_sensors(configs):
+    from Drivers.AHT20 import AHT20
+    from Drivers.TCA9548A import TCA9548A
+    sensors = []
+    muxes = {}
+    for config in configs:
+        mux = None
+        if config.get("mux"):
+            key = (config.get("bus", 1), config["mux"]["address"])
+            mux = muxes.setdefault(key, TCA9548A.TCA9548A(*key))
+            mux.select_channel(config["mux"]["channel"])
+        sensor = AHT20.AHT20(config.get("bus", 1), config.get("address", 0x38))
+        sensors.append((config, mux, sensor))
+    return sensors
+
+
+def record_sensors(writer, sensors):
+    for config, mux, sensor in sensors:
+        channel = config["mux"]["channel"] if config.get("mux") else None
+        try:
+            if mux:
+                mux.select_channel(channel)
+            writer.write("i2c", time.time(), bus=config.get("bus", 1), address=config.get("address", 0x38),
+                         channel=channel, data=sensor.get_measure())
+        except OSError as e:
+            logging.error(f"Record: Failed to read {config['name']} - {e}")
+
+
+def record_bluetooth(writer, targets):
+    import bluetooth
+    for address in targets:
+        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        sock.settimeout(10)
+        try:
+            sock.connect((address, 1))
+            present = True
+        except bluetooth.btcommon.BluetoothError as e:
+            present = "Connection refused" in str(e)  # Refusing takes a working radio in range
+        except OSError:
+            present = False
+        finally:
+            sock.close()
+        writer.write("bt", time.time(), address=address, present=present)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record a hardware trace from this satellite")
+    parser.add_argument("--out", default="trace.jsonl", help="Trace file to write")
+    parser.add_argument("--duration", type=float, default=3600, help="Seconds to record for")
+    parser.add_argument("--sensor-interval", type=float, default=20, help="Seconds between sensor reads")
+    parser.add_argument("--bt-interval", type=float, default=60, help="Seconds between Bluetooth probes")
+    parser.add_argument("--no-gpio", action="store_true")
+    parser.add_argument("--no-i2c", action="store_true")
+    parser.add_argument("--no-bt", action="store_true")
+    args = parser.parse_args()
+
+    writer = TraceWriter(args.out)
+    writer.write("start", time.time(), host=os.uname().nodename)
+    if not args.no_gpio and os.path.exists("Configs/PinWatchers.json"):
+        record_gpio(writer, json.load(open("Configs/PinWatchers.json")))
+    sensors = []
+    if not args.no_i2c and os.path.exists("Configs/Sensors.json"):
+        sensors = open_sensors(json.load(open("Configs/Sensors.json")))
+    targets = []
+    if not args.no_bt and os.path.exists("Configs/BlueStalker.json"):
+        targets = list(json.load(open("Configs/BlueStalker.json")).keys())
+
+    logging.info(f"Record: Recording {args.duration}s to {args.out}")
+    end = time.time() + args.duration
+    next_sensor = next_bt = time.time()
+    while time.time() < end:
+        if sensors and time.time() >= next_sensor:
+            record_sensors(writer, sensors)
+            next_sensor += args.sensor_interval
+        if targets and time.time() >= next_bt:
+            record_bluetooth(writer, targets)
+            next_bt += args.bt_interval
+        time.sleep(max(min(next_sensor, next_bt, end) - time.time(), 0.1))
+    writer.close()
+    logging.info("Record: Done")
+
+
+if __name__ == "__main__":
+    main()
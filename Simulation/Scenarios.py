@@ -0,0 +1,59 @@
+"""Scripted scenarios that produce the same events as a recorded trace (see Simulation/Trace.py)"""
+import math
+import random
+
+
+def occupied_day(days=1, motion_pin=11, sensor=(1, 0x38, None), targets=(), heartbeat=None,
+                 relay="Radiator", seed=0):
+    """
+    An occupant that is home from morning to night with some outings, motion while they are home, a daily
+    temperature swing, and a radiator the master switches on and off around a setpoint
+    :param days: Number of simulated days
+    :param motion_pin: GPIO pin of the motion detector
+    :param sensor: (bus, address, mux channel) of the AHT20
+    :param targets: Bluetooth addresses of the occupants
+    :param heartbeat: Bluetooth address of the heartbeat device, always present
+    :param relay: Name of the relay the master would switch, None for no relay commands
+    :param seed: Random seed so runs are repeatable
+    """
+    rng = random.Random(seed)
+    bus, address, channel = sensor
+    events = [{"t": 0, "kind": "gpio", "pin": motion_pin, "level": 0}]
+    if heartbeat:
+        events.append({"t": 0, "kind": "bt", "address": heartbeat, "present": True})
+
+    for day in range(days):
+        base = day * 86400
+        for target in targets:
+            arrive = base + rng.uniform(6, 9) * 3600
+            leave = base + rng.uniform(21, 24) * 3600
+            events.append({"t": arrive, "kind": "bt", "address": target, "present": True})
+            events.append({"t": leave, "kind": "bt", "address": target, "present": False})
+            # A couple of outings during the day
+            for _ in range(rng.randint(0, 2)):
+                out = rng.uniform(arrive + 3600, leave - 7200)
+                events.append({"t": out, "kind": "bt", "address": target, "present": False})
+                events.append({"t": out + rng.uniform(600, 5400), "kind": "bt", "address": target, "present": True})
+
+            # Motion bursts while home
+            t = arrive
+            while t < leave:
+                events.append({"t": t, "kind": "gpio", "pin": motion_pin, "level": 1})
+                events.append({"t": t + rng.uniform(2, 30), "kind": "gpio", "pin": motion_pin, "level": 0})
+                t += rng.expovariate(1 / 300)
+
+        # Temperature follows the day with some noise, the radiator is switched around 20 °C
+        heating = False
+        for minute in range(0, 1440, 1):
+            t = base + minute * 60
+            temperature = 19 + 3 * math.sin((minute / 1440 - 0.3) * 2 * math.pi) + rng.gauss(0, 0.1)
+            humidity = 45 + 5 * math.cos(minute / 1440 * 2 * math.pi) + rng.gauss(0, 0.3)
+            events.append({"t": t, "kind": "i2c", "bus": bus, "address": address, "channel": channel,
+                           "temperature": round(temperature, 2), "humidity": round(humidity, 2)})
+            if relay and (temperature < 19.5) != heating:
+                heating = temperature < 19.5
+                events.append({"t": t, "kind": "event", "object": relay, "event": "set_on", "args": [heating]})
+            if relay:
+                events.append({"t": t, "kind": "event", "object": relay, "event": "heartbeat", "args": []})
+
+    return sorted(events, key=lambda event: event["t"])
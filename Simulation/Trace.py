@@ -0,0 +1,89 @@
+"""
+Hardware traces are JSON lines files, one event per line, ordered by "t" (seconds since the start of the trace):
+    {"t": 0.0, "kind": "gpio", "pin": 11, "level": 1}
+    {"t": 0.0, "kind": "i2c", "bus": 1, "address": 56, "channel": null, "temperature": 21.4, "humidity": 40.1}
+    {"t": 0.0, "kind": "i2c", "bus": 1, "address": 56, "channel": null, "data": [28, 102, ...]}
+    {"t": 0.0, "kind": "bt", "address": "54:09:10:A7:FC:12", "present": true}
+    {"t": 0.0, "kind": "ble", "address": "54:09:10:A7:FC:12", "rssi": -61, "addr_type": "public"}
+    {"t": 0.0, "kind": "event", "object": "Radiator", "event": "set_on", "args": [true]}
+"""
+import json
+
+from loguru import logger as logging
+
+from Modules.Clock import clock
+from Modules.Decorators import background
+
+
+class TraceWriter:
+
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.start = None
+
+    def write(self, kind, timestamp, **fields):
+        if self.start is None:
+            self.start = timestamp
+        self.file.write(json.dumps({"t": round(timestamp - self.start, 4), "kind": kind, **fields}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_trace(path):
+    with open(path, "r") as file:
+        events = [json.loads(line) for line in file if line.strip()]
+    return sorted(events, key=lambda event: event["t"])
+
+
+class TracePlayer:
+    """
+    Feeds trace events into the fake devices on the simulation clock. Events of kind "event" are delivered to
+    every controller passed in as a remote event, the same way LinkHost delivers commands from the master.
+    """
+
+    def __init__(self, events, controllers=None, loop=False):
+        self.events = events
+        self.controllers = controllers or []
+        self.loop = loop
+        self.played = 0
+        self.finished = False
+
+    def apply(self, event):
+        from Drivers.GPIO.Backend import get_backend
+        from Simulation import FakeBLE, FakeBluetooth, FakeI2C
+        kind = event["kind"]
+        if kind == "gpio":
+            get_backend().inject(event["pin"], event["level"])
+        elif kind == "i2c":
+            FakeI2C.set_reading(event["bus"], event["address"], event.get("channel"),
+                                event.get("temperature"), event.get("humidity"), event.get("data"))
+        elif kind == "bt":
+            FakeBluetooth.set_present(event["address"], event["present"])
+        elif kind == "ble":
+            FakeBLE.advertise(event["address"], event.get("rssi", -60), event.get("addr_type", "public"))
+        elif kind == "start":
+            pass
+        elif kind == "event":
+            for controller in self.controllers:
+                room_object = controller.get_object(event["object"], create_if_not_found=False)
+                if room_object:
+                    room_object.remote_event(event["event"], *event.get("args", []), **event.get("kwargs", {}))
+        else:
+            logging.warning(f"TracePlayer: Unknown trace event kind {kind}")
+        self.played += 1
+
+    @background
+    def play(self):
+        length = self.events[-1]["t"] if self.events else 0
+        while True:
+            start = clock.time()
+            for event in self.events:
+                delay = start + event["t"] - clock.time()
+                if delay > 0:
+                    clock.sleep(delay)
+                self.apply(event)
+            if not self.loop or length <= 0:
+                break
+        self.finished = True
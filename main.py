@@ -125,7 +125,8 @@ async def main():
     sites = []
     for module in controller.get_modules():
         if hasattr(module, "wait_for_ready"):
-            module.wait_for_ready()
+            # Blocking, wait on a worker thread so the loop keeps serving while modules come up
+            await asyncio.get_running_loop().run_in_executor(None, module.wait_for_ready)
         # Collect any aiohttp servers and run use asyncio.gather to run them all at once
 
         if hasattr(module, "is_webserver") and getattr(module, "get_site", None) is not None: